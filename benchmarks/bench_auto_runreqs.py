@@ -0,0 +1,118 @@
+"""Compares loading devices with auto runreqs from the registry and rebuilding them.
+
+Run from the repository root with: python -m benchmarks.bench_auto_runreqs
+"""
+
+import timeit
+
+import django
+from django.conf import settings
+from django.core.management import call_command
+from django.db.models.signals import post_init
+
+
+DEVICES = 2000
+
+
+def rebuild_auto_runreq(sender, instance, **kwargs):
+    """The previous post_init handler, deriving the fields on every load."""
+    from zezere.runreqs import AUTO_RUNREQS
+
+    if not instance.auto_generated_id:
+        return
+    info = AUTO_RUNREQS[instance.auto_generated_id]
+    instance.type = info["type"]
+
+    if "compose_root" in info:
+        compose_url = f"{info['compose_root']}/compose/{info['compose_name']}/:arch:/os"
+        instance.kernel_url = f"{compose_url}/isolinux/vmlinuz"
+        instance.kernel_cmd = " ".join(
+            [
+                f"inst.repo={compose_url}",
+                "inst.ks=:urls.kickstart:",
+                "inst.ks.sendmac",
+                "noshell",
+                "inst.cmdline",
+                "inst.sshd=0",
+                "ip=dhcp",
+            ]
+        )
+        instance.initrd_url = f"{compose_url}/isolinux/initrd.img"
+
+    runreq_settings = {"clear_parts": info.get("clear_parts"), "raw": info}
+    if "next" in info:
+        runreq_settings["next"] = info["next"]
+    if info.get("install_type") == "ostree":
+        runreq_settings["type"] = "ostree"
+        runreq_settings["ostree"] = info["ostree"]
+    if info["type"] == "ef":
+        runreq_settings["efi_path"] = info["efi_path"]
+    instance._settings = runreq_settings
+
+
+def setup():
+    settings.configure(
+        INSTALLED_APPS=[
+            "django.contrib.auth",
+            "django.contrib.contenttypes",
+            "rules",
+            "zezere",
+        ],
+        DATABASES={
+            "default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}
+        },
+    )
+    django.setup()
+    call_command("migrate", verbosity=0)
+
+    from zezere.macaddr import int_to_mac
+    from zezere.models import Device, RunRequest
+    from zezere.runreqs import AUTO_RUNREQS
+
+    runreqs = [
+        RunRequest.objects.create(auto_generated_id=autoid) for autoid in AUTO_RUNREQS
+    ]
+    Device.objects.bulk_create(
+        Device(
+            mac_address=int_to_mac(0xAABBCC000000 + i),
+            mac_int=0xAABBCC000000 + i,
+            architecture="x86_64",
+            run_request=runreqs[i % len(runreqs)],
+        )
+        for i in range(DEVICES)
+    )
+
+
+def iterate():
+    from zezere.models import Device
+
+    for device in Device.objects.select_related("run_request"):
+        device.run_request.settings
+
+
+def main(number=5):
+    setup()
+
+    from zezere.models import RunRequest
+    from zezere.runreqs import generate_auto_runreq
+
+    results = {}
+    for name, handler in (
+        ("rebuild", rebuild_auto_runreq),
+        ("registry", generate_auto_runreq),
+    ):
+        post_init.disconnect(generate_auto_runreq, sender=RunRequest)
+        post_init.connect(handler, sender=RunRequest)
+        results[name] = min(timeit.repeat(iterate, number=number, repeat=5)) / number
+        post_init.disconnect(handler, sender=RunRequest)
+        post_init.connect(generate_auto_runreq, sender=RunRequest)
+
+    for name, seconds in results.items():
+        print(
+            "%-10s %8.3f ms per %d devices (%.2f us/device)"
+            % (name, seconds * 1e3, DEVICES, seconds / DEVICES * 1e6)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Compares the compiled field lists of AttributeIgnitionConfigObjectType with
+the dir() based serialization they replaced.
+
+Run from the repository root with: python -m benchmarks.bench_ignconfig
+"""
+
+import timeit
+
+from zezere import ignconfig
+
+
+def dir_generate_config(obj):
+    cfg = {}
+    for attr in dir(obj):
+        if attr.startswith("_"):
+            continue
+        val = getattr(obj, attr)
+        if callable(val):
+            continue
+        if val is None:
+            continue
+        if (
+            isinstance(val, list)
+            and len(val) > 0
+            and isinstance(val[0], ignconfig.IgnitionConfigObjectType)
+        ):
+            val = [dir_generate_config(elem) for elem in val]
+        cfg[attr] = val
+    return cfg
+
+
+def build_config(units, users):
+    cfg = ignconfig.IgnitionConfig()
+    for i in range(units):
+        unit = ignconfig.SystemdUnit("unit%d.service" % i)
+        unit.enabled = True
+        unit.contents = "[Service]\nExecStart=/usr/bin/true\n"
+        unit.add_dropin(
+            ignconfig.SystemdUnitDropin("10-env.conf", "[Service]\nEnvironment=A=1\n")
+        )
+        cfg.add_unit(unit)
+    for i in range(users):
+        user = ignconfig.PasswdUser("user%d" % i)
+        user.uid = 1000 + i
+        user.sshAuthorizedKeys = ["ssh-ed25519 AAAA user%d" % i]
+        user.groups = ["wheel"]
+        cfg.add_user(user)
+        group = ignconfig.PasswdGroup("group%d" % i)
+        group.gid = 1000 + i
+        cfg.add_group(group)
+    return cfg
+
+
+def main(number=5):
+    for units, users in ((100, 100), (2000, 2000), (5000, 10000)):
+        cfg = build_config(units, users)
+        objects = cfg.units + cfg.users + cfg.groups
+        assert [dir_generate_config(obj) for obj in objects] == [
+            obj.generate_config() for obj in objects
+        ]
+        for name, func in (
+            ("dir", lambda: [dir_generate_config(obj) for obj in objects]),
+            ("compiled", lambda: [obj.generate_config() for obj in objects]),
+            ("build", lambda: build_config(units, users)),
+        ):
+            seconds = min(timeit.repeat(func, number=number, repeat=3))
+            print(
+                "%5d units %5d users %-8s %9.3f ms/config"
+                % (units, users, name, seconds / number * 1e3)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Compares writing compiled Ignition config fragments into a response with
+JsonResponse(generate_config()).
+
+Run from the repository root with: python -m benchmarks.bench_ignition_json
+"""
+
+import json
+import timeit
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+
+from zezere import ignconfig
+
+
+def build_base(units):
+    cfg = ignconfig.IgnitionConfig()
+    for i in range(units):
+        unit = ignconfig.SystemdUnit("unit%d.service" % i)
+        unit.enabled = True
+        unit.contents = (
+            "[Unit]\nDescription=Unit %d\n\n[Service]\nExecStart=/bin/true\n" % i
+        )
+        unit.add_dropin(
+            ignconfig.SystemdUnitDropin("10-env.conf", "[Service]\nEnvironment=A=1\n")
+        )
+        cfg.add_unit(unit)
+    cfg.add_config_merge(ignconfig.FileContents(contents=b"{}" * 20000))
+    return cfg
+
+
+def build_overlay():
+    cfg = ignconfig.IgnitionConfig()
+    root = ignconfig.PasswdUser("root")
+    root.sshAuthorizedKeys = ["ssh-ed25519 AAAA key%d" % i for i in range(3)]
+    cfg.add_user(root)
+    return cfg
+
+
+def full_config(base, overlay):
+    cfg = ignconfig.IgnitionConfig()
+    cfg.units = base.units
+    cfg.config_merges = base.config_merges
+    cfg.users = overlay.users
+    return cfg
+
+
+def json_response(base, overlay, compiled_base):
+    return JsonResponse(full_config(base, overlay).generate_config()).content
+
+
+def fragments(base, overlay, compiled_base):
+    resp = HttpResponse(content_type="application/json")
+    ignconfig.write_configs_json([compiled_base, overlay.compile()], resp)
+    return resp.content
+
+
+def main(number=20):
+    settings.configure()
+    for units in (100, 500, 1000):
+        base = build_base(units)
+        overlay = build_overlay()
+        compiled_base = base.compile()
+        assert json.loads(json_response(base, overlay, compiled_base)) == json.loads(
+            fragments(base, overlay, compiled_base)
+        )
+        for func in (json_response, fragments):
+            seconds = min(
+                timeit.repeat(
+                    lambda: func(base, overlay, compiled_base), number=number, repeat=5
+                )
+            )
+            print(
+                "%5d units %-14s %8.3f ms/config"
+                % (units, func.__name__, seconds / number * 1e3)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Compares the placeholder engine with the chained str.replace calls it replaced.
+
+Run from the repository root with: python -m benchmarks.bench_placeholders
+"""
+
+import timeit
+
+from django.conf import settings
+from django.test import RequestFactory
+
+from zezere.placeholders import device_placeholders, fill_placeholders
+
+
+class FakeDevice(object):
+    mac_address = "AA:BB:CC:DD:EE:FF"
+    architecture = "x86_64"
+
+
+KICKSTART = (
+    "lang en_US.UTF-8\nkeyboard us\n" * 40
+    + "ostreesetup --ref=fedora/stable/:arch:/iot\n"
+    + "curl --fail :urls.base:netboot/postboot/:mac_addr:\n"
+)
+KERNEL_CMD = (
+    "inst.repo=https://kojipkgs.fedoraproject.org/compose/iot/latest-Fedora-IoT-33"
+    "/compose/IoT/:arch:/os inst.ks=:urls.kickstart: inst.ks.sendmac noshell "
+    "inst.cmdline inst.sshd=0 ip=dhcp"
+)
+
+
+def chained_replace(request, content, device):
+    content = content.replace(":urls.base:", request.build_absolute_uri("/"))
+    content = content.replace(
+        ":urls.kickstart:",
+        request.build_absolute_uri(f"/netboot/kickstart/{device.mac_address}"),
+    )
+    content = content.replace(":arch:", device.architecture)
+    content = content.replace(":mac_addr:", device.mac_address)
+    return content
+
+
+def engine(request, content, device):
+    return fill_placeholders(content, device_placeholders(request, device))
+
+
+def main(number=20000):
+    settings.configure(ALLOWED_HOSTS=["provision.example.com"])
+    request = RequestFactory().get("/", HTTP_HOST="provision.example.com")
+    device = FakeDevice()
+    for name, value in (("kickstart", KICKSTART), ("kernel_cmd", KERNEL_CMD)):
+        assert chained_replace(request, value, device) == engine(request, value, device)
+        for func in (chained_replace, engine):
+            seconds = min(
+                timeit.repeat(
+                    lambda: func(request, value, device), number=number, repeat=5
+                )
+            )
+            print(
+                "%-10s %-16s %8.3f us/call"
+                % (name, func.__name__, seconds / number * 1e6)
+            )
+
+
+if __name__ == "__main__":
+    main()
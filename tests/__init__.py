@@ -1,9 +1,10 @@
 from contextlib import contextmanager
 
+from django.core.cache import cache
 from django.test import TestCase as djangoTestCase
 from django.contrib.auth.models import User
 
-from zezere import models
+from zezere import checkin, models
 
 
 class TestCase(djangoTestCase):
@@ -42,6 +43,13 @@ class TestCase(djangoTestCase):
         for username in (cls.USER_1, cls.USER_2):
             User.objects.create_user(username, password="testpass")
 
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        checkin.buffer.clear()
+        # Also stops the flush timer of check-ins recorded by the test
+        self.addCleanup(checkin.buffer.clear)
+
     @contextmanager
     def loggedin_as(self, username: str = USER_1):
         self.assertIsNone(self._cur_user)
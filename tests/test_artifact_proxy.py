@@ -0,0 +1,376 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import TemporaryDirectory
+from unittest.mock import MagicMock, patch
+
+import os
+import shutil
+import threading
+import time
+
+from django.test import override_settings
+
+from . import TestCase
+
+from zezere import artifact_proxy, models
+from zezere.artifact_proxy import ArtifactProxy, ArtifactUnavailable
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    files = {}
+    requests = []
+    head_requests = []
+    # Set to make the handler pause halfway through a response
+    gate = None
+    send_length = True
+    send_etag = True
+    fail_halfway = False
+    last_modified = "Mon, 01 Jun 2020 00:00:00 GMT"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.head_requests.append(self.path)
+        contents = self.files.get(self.path)
+        if contents is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        if self.send_length:
+            self.send_header("Content-Length", str(len(contents)))
+        self.end_headers()
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("If-None-Match")))
+        contents = self.files.get(self.path)
+        if contents is None:
+            self.send_error(404)
+            return
+        etag = '"%d"' % len(contents)
+        if self.headers.get("If-None-Match") == etag or (
+            self.headers.get("If-Modified-Since") == self.last_modified
+        ):
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if self.send_etag:
+            self.send_header("ETag", etag)
+        else:
+            self.send_header("Last-Modified", self.last_modified)
+        if self.send_length:
+            self.send_header("Content-Length", str(len(contents)))
+        self.end_headers()
+        half = len(contents) // 2
+        self.wfile.write(contents[:half])
+        self.wfile.flush()
+        if self.gate is not None:
+            self.gate.wait(10)
+        if not self.fail_halfway:
+            self.wfile.write(contents[half:])
+
+
+class ArtifactProxyTestMixin(object):
+    def start_upstream(self):
+        UpstreamHandler.files = {
+            "/x86_64/vmlinuz": os.urandom(1500000),
+            "/x86_64/initrd": os.urandom(700000),
+        }
+        UpstreamHandler.requests = []
+        UpstreamHandler.head_requests = []
+        UpstreamHandler.gate = None
+        UpstreamHandler.send_length = True
+        UpstreamHandler.send_etag = True
+        UpstreamHandler.fail_halfway = False
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), UpstreamHandler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.tmpdir = TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server.server_port, path)
+
+
+class ArtifactProxyTest(ArtifactProxyTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.start_upstream()
+        self.proxy = ArtifactProxy(self.tmpdir.name, ttl=3600)
+
+    def read(self, url):
+        size, contents = self.proxy.open(url)
+        contents = b"".join(contents)
+        # The index is only updated once readers got all the contents
+        self.proxy.wait()
+        return size, contents
+
+    def objects(self):
+        return [
+            name
+            for _, _, names in os.walk(os.path.join(self.tmpdir.name, "sha256"))
+            for name in names
+        ]
+
+    def test_fetch_once(self):
+        expected = UpstreamHandler.files["/x86_64/vmlinuz"]
+        self.assertEqual(
+            self.read(self.url("/x86_64/vmlinuz")), (len(expected), expected)
+        )
+        self.assertEqual(
+            self.read(self.url("/x86_64/vmlinuz")), (len(expected), expected)
+        )
+        self.assertEqual(len(UpstreamHandler.requests), 1)
+
+        # A new proxy on the same store uses the persisted index
+        self.proxy = ArtifactProxy(self.tmpdir.name, ttl=3600)
+        self.assertEqual(
+            self.read(self.url("/x86_64/vmlinuz")), (len(expected), expected)
+        )
+        self.assertEqual(len(UpstreamHandler.requests), 1)
+
+    def test_concurrent_readers(self):
+        UpstreamHandler.gate = threading.Event()
+        expected = UpstreamHandler.files["/x86_64/vmlinuz"]
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [
+                executor.submit(self.read, self.url("/x86_64/vmlinuz"))
+                for _ in range(8)
+            ]
+            # All readers are attached while the download is in flight
+            time.sleep(0.2)
+            UpstreamHandler.gate.set()
+            results = [future.result(timeout=10) for future in futures]
+
+        for result in results:
+            self.assertEqual(result, (len(expected), expected))
+        self.assertEqual(len(UpstreamHandler.requests), 1)
+
+    def test_size(self):
+        url = self.url("/x86_64/vmlinuz")
+        self.assertEqual(self.proxy.size(url), 1500000)
+        self.assertEqual(UpstreamHandler.head_requests, ["/x86_64/vmlinuz"])
+        self.assertEqual(UpstreamHandler.requests, [])
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir.name, "sha256")))
+
+        UpstreamHandler.send_length = False
+        self.assertIsNone(self.proxy.size(url))
+
+        with self.assertRaises(ArtifactUnavailable):
+            self.proxy.size(self.url("/nowhere"))
+
+    def test_size_known(self):
+        UpstreamHandler.gate = threading.Event()
+        url = self.url("/x86_64/vmlinuz")
+        size, contents = self.proxy.open(url)
+        # While the download is in progress
+        self.assertEqual(self.proxy.size(url), 1500000)
+        UpstreamHandler.gate.set()
+        b"".join(contents)
+        self.proxy.wait()
+        # And once it is in the store
+        self.assertEqual(self.proxy.size(url), 1500000)
+        self.assertEqual(UpstreamHandler.head_requests, [])
+
+    def test_wait(self):
+        UpstreamHandler.gate = threading.Event()
+        _, contents = self.proxy.open(self.url("/x86_64/vmlinuz"))
+        threading.Timer(0.1, UpstreamHandler.gate.set).start()
+        self.proxy.wait()
+        self.assertEqual(b"".join(contents), UpstreamHandler.files["/x86_64/vmlinuz"])
+
+    def test_without_length(self):
+        UpstreamHandler.send_length = False
+        # Keep the download in progress, the size is known once it is done
+        UpstreamHandler.gate = threading.Event()
+        expected = UpstreamHandler.files["/x86_64/initrd"]
+        size, contents = self.proxy.open(self.url("/x86_64/initrd"))
+        self.assertIsNone(size)
+        UpstreamHandler.gate.set()
+        self.assertEqual(b"".join(contents), expected)
+        self.assertEqual(
+            self.read(self.url("/x86_64/initrd")), (len(expected), expected)
+        )
+
+    def test_revalidate_last_modified(self):
+        UpstreamHandler.send_etag = False
+        self.proxy.ttl = 0
+        expected = UpstreamHandler.files["/x86_64/initrd"]
+        self.assertEqual(self.read(self.url("/x86_64/initrd"))[1], expected)
+        self.assertEqual(self.read(self.url("/x86_64/initrd"))[1], expected)
+        self.assertEqual(len(UpstreamHandler.requests), 2)
+
+    def test_corrupt_index(self):
+        url = self.url("/x86_64/initrd")
+        self.read(url)
+        indexdir = os.path.join(self.tmpdir.name, "index")
+        for name in os.listdir(indexdir):
+            with open(os.path.join(indexdir, name), "w") as f:
+                f.write("{")
+
+        self.proxy = ArtifactProxy(self.tmpdir.name, ttl=3600)
+        self.assertEqual(self.read(url)[1], UpstreamHandler.files["/x86_64/initrd"])
+        self.assertEqual(len(UpstreamHandler.requests), 2)
+
+    def test_missing_object(self):
+        url = self.url("/x86_64/initrd")
+        self.read(url)
+        shutil.rmtree(os.path.join(self.tmpdir.name, "sha256"))
+
+        self.assertEqual(self.read(url)[1], UpstreamHandler.files["/x86_64/initrd"])
+        self.assertEqual(len(UpstreamHandler.requests), 2)
+
+    @patch("logging.Logger.error")
+    def test_upstream_failure_while_reading(self, mock_error):
+        UpstreamHandler.gate = threading.Event()
+        UpstreamHandler.fail_halfway = True
+        _, contents = self.proxy.open(self.url("/x86_64/vmlinuz"))
+        UpstreamHandler.gate.set()
+        with self.assertRaises(ArtifactUnavailable):
+            b"".join(contents)
+        mock_error.assert_called_once()
+
+    @patch("logging.Logger.error")
+    def test_upstream_truncated(self, mock_error):
+        # Normally caught by the HTTP client, but not all of them check
+        resp = MagicMock(status_code=200, headers={"Content-Length": "10"})
+        resp.__enter__.return_value = resp
+        resp.iter_content.return_value = [b"12345"]
+        with patch("zezere.artifact_proxy.requests.get", return_value=resp):
+            with self.assertRaises(ArtifactUnavailable):
+                _, contents = self.proxy.open(self.url("/x86_64/vmlinuz"))
+                b"".join(contents)
+        mock_error.assert_called_once()
+
+    def test_unread_contents(self):
+        url = self.url("/x86_64/initrd")
+        b"".join(self.proxy.open(url)[1])
+        with patch.object(self.proxy.store, "open") as mock_open:
+            self.proxy.open(url)
+        # Files are only opened once the contents are read
+        mock_open.assert_not_called()
+
+    def test_revalidate(self):
+        self.proxy.ttl = 0
+        expected = UpstreamHandler.files["/x86_64/initrd"]
+        self.assertEqual(self.read(self.url("/x86_64/initrd"))[1], expected)
+        self.assertEqual(self.read(self.url("/x86_64/initrd"))[1], expected)
+        self.assertEqual(
+            UpstreamHandler.requests,
+            [("/x86_64/initrd", None), ("/x86_64/initrd", '"700000"')],
+        )
+
+        UpstreamHandler.files["/x86_64/initrd"] = b"new initrd"
+        self.assertEqual(self.read(self.url("/x86_64/initrd"))[1], b"new initrd")
+
+    def test_revalidate_prunes_old_version(self):
+        self.proxy.ttl = 0
+        vmlinuz, initrd = self.url("/x86_64/vmlinuz"), self.url("/x86_64/initrd")
+        # Another URL with the same contents keeps the object alive
+        UpstreamHandler.files["/x86_64/initrd"] = UpstreamHandler.files[
+            "/x86_64/vmlinuz"
+        ]
+        self.read(vmlinuz)
+        self.read(initrd)
+        (digest,) = self.objects()
+        # Left behind by an interrupted index update
+        open(os.path.join(self.tmpdir.name, "index", "stale.json.tmp"), "w").close()
+
+        UpstreamHandler.files["/x86_64/vmlinuz"] = b"new vmlinuz"
+        self.assertEqual(self.read(vmlinuz)[1], b"new vmlinuz")
+        self.assertEqual(len(self.objects()), 2)
+        self.assertIn(digest, self.objects())
+
+        UpstreamHandler.files["/x86_64/initrd"] = b"new initrd"
+        self.assertEqual(self.read(initrd)[1], b"new initrd")
+        self.assertEqual(len(self.objects()), 2)
+        self.assertNotIn(digest, self.objects())
+
+    @patch("logging.Logger.error")
+    def test_upstream_error(self, mock_error):
+        with self.assertRaises(ArtifactUnavailable):
+            self.proxy.open(self.url("/nowhere"))
+        mock_error.assert_called_once()
+        tmpdir = os.path.join(self.tmpdir.name, "tmp")
+        self.assertFalse(os.path.exists(tmpdir) and os.listdir(tmpdir))
+
+
+class RunReqArtifactViewTest(ArtifactProxyTestMixin, TestCase):
+    fixtures = ["fedora_installed.json", "fedora_iot_runreqs.json"]
+
+    def setUp(self):
+        super().setUp()
+        self.start_upstream()
+        self.runreq = models.RunRequest(
+            owner=self.get_user(self.USER_1),
+            type=models.RunRequest.TYPE_ONLINE_KERNEL,
+            kernel_url=self.url("/:arch:/vmlinuz"),
+            initrd_url=self.url("/:arch:/initrd"),
+            kernel_cmd="ip=dhcp",
+        )
+        self.runreq.save()
+        settings_override = override_settings(ARTIFACT_CACHE_DIR=self.tmpdir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(lambda: artifact_proxy.get_proxy().wait())
+
+    def test_grubcfg(self):
+        dev = self.claim_device(self.DEVICE_1, self.USER_1)
+        dev.run_request = self.runreq
+        dev.save()
+        resp = self.client.get("/netboot/x86_64/grubcfg/%s" % self.DEVICE_1)
+        self.assertContains(resp, "linux runreq/%d/kernel ip=dhcp" % self.runreq.id)
+        self.assertContains(resp, "initrd runreq/%d/initrd" % self.runreq.id)
+
+    def test_grubcfg_without_urls(self):
+        self.runreq.initrd_url = None
+        self.runreq.save()
+        dev = self.claim_device(self.DEVICE_1, self.USER_1)
+        dev.run_request = self.runreq
+        dev.save()
+        resp = self.client.get("/netboot/x86_64/grubcfg/%s" % self.DEVICE_1)
+        self.assertContains(resp, "linux static/netboot/x86_64/vmlinuz")
+
+    def test_artifact(self):
+        for flags in ("", "debug/"):
+            resp = self.client.get(
+                "/netboot/%sx86_64/runreq/%d/kernel" % (flags, self.runreq.id)
+            )
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                b"".join(resp.streaming_content),
+                UpstreamHandler.files["/x86_64/vmlinuz"],
+            )
+        self.assertEqual(len(UpstreamHandler.requests), 1)
+
+        # HEAD requests do not download anything
+        resp = self.client.head("/netboot/x86_64/runreq/%d/initrd" % self.runreq.id)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(int(resp["Content-Length"]), 700000)
+        self.assertEqual(len(UpstreamHandler.requests), 1)
+
+        resp = self.client.head("/netboot/x86_64/runreq/%d/kernel" % self.runreq.id)
+        self.assertEqual(int(resp["Content-Length"]), 1500000)
+        self.assertEqual(UpstreamHandler.head_requests, ["/x86_64/initrd"])
+
+    @patch("logging.Logger.error")
+    def test_artifact_unavailable(self, mock_error):
+        resp = self.client.get("/netboot/aarch64/runreq/%d/kernel" % self.runreq.id)
+        self.assertEqual(resp.status_code, 502)
+        resp = self.client.head("/netboot/aarch64/runreq/%d/kernel" % self.runreq.id)
+        self.assertEqual(resp.status_code, 502)
+
+    def test_artifact_not_found(self):
+        efi = models.RunRequest.objects.get(auto_generated_id=self.RUNREQ_INSTALLED)
+        for url in (
+            "/netboot/myarch/runreq/%d/kernel" % self.runreq.id,
+            "/netboot/x86_64/runreq/%d/efi" % self.runreq.id,
+            "/netboot/x86_64/runreq/500/kernel",
+            "/netboot/x86_64/runreq/%d/kernel" % efi.id,
+        ):
+            self.assertEqual(self.client.get(url).status_code, 404, url)
@@ -0,0 +1,87 @@
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+import os
+
+from zezere.artifacts import ArtifactTable, RangeNotSatisfiable, parse_range
+
+
+class ArtifactTableTest(TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "file.efi")
+        with open(self.path, "wb") as f:
+            f.write(b"0123456789")
+
+    def test_get(self):
+        table = ArtifactTable(self.tmpdir.name)
+        artifact = table.get("file.efi")
+        self.assertEqual(artifact.size, 10)
+        self.assertEqual(b"".join(artifact.iter_range(2, 4)), b"234")
+        self.assertIs(table.get("file.efi"), artifact)
+
+    def test_get_empty(self):
+        open(os.path.join(self.tmpdir.name, "empty"), "wb").close()
+        artifact = ArtifactTable(self.tmpdir.name).get("empty")
+        self.assertEqual(artifact.size, 0)
+        self.assertEqual(b"".join(artifact.iter_range(0, -1)), b"")
+
+    def test_get_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            ArtifactTable(self.tmpdir.name).get("missing")
+
+    def test_refresh(self):
+        table = ArtifactTable(self.tmpdir.name, recheck_interval=0)
+        artifact = table.get("file.efi")
+        self.assertIs(table.get("file.efi"), artifact)
+
+        with open(self.path + ".new", "wb") as f:
+            f.write(b"abcdefghijklmnop")
+        os.replace(self.path + ".new", self.path)
+
+        refreshed = table.get("file.efi")
+        self.assertIsNot(refreshed, artifact)
+        self.assertNotEqual(refreshed.etag, artifact.etag)
+        self.assertEqual(b"".join(refreshed.iter_range(0, 2)), b"abc")
+
+    def test_removed(self):
+        table = ArtifactTable(self.tmpdir.name, recheck_interval=0)
+        table.get("file.efi")
+        os.unlink(self.path)
+        with self.assertRaises(FileNotFoundError):
+            table.get("file.efi")
+
+    def test_truncated(self):
+        artifact = ArtifactTable(self.tmpdir.name).get("file.efi")
+        # Truncated in place after it was loaded, which must not crash the server
+        with open(self.path, "r+b") as f:
+            f.truncate(6)
+        self.assertEqual(b"".join(artifact.iter_range(2, 9)), b"2345")
+
+    def test_refresh_interval(self):
+        table = ArtifactTable(self.tmpdir.name, recheck_interval=60)
+        artifact = table.get("file.efi")
+        with patch("zezere.artifacts.os.stat") as mock_stat:
+            self.assertIs(table.get("file.efi"), artifact)
+            mock_stat.assert_not_called()
+
+
+class ParseRangeTest(TestCase):
+    def test_full(self):
+        for header in (None, "", "items=0-5", "bytes=0-1,4-5", "bytes=a-b", "bytes=5"):
+            self.assertIsNone(parse_range(header, 10), header)
+
+    def test_ranges(self):
+        self.assertEqual(parse_range("bytes=0-4", 10), (0, 4))
+        self.assertEqual(parse_range("bytes=5-", 10), (5, 9))
+        self.assertEqual(parse_range("bytes=5-100", 10), (5, 9))
+        self.assertEqual(parse_range("bytes=-3", 10), (7, 9))
+        self.assertEqual(parse_range("bytes=-30", 10), (0, 9))
+        self.assertIsNone(parse_range("bytes=5-4", 10))
+
+    def test_unsatisfiable(self):
+        for header in ("bytes=10-", "bytes=-0"):
+            with self.assertRaises(RangeNotSatisfiable):
+                parse_range(header, 10)
@@ -0,0 +1,85 @@
+from unittest.mock import patch
+
+from django.core.cache import cache
+
+from . import TestCase
+
+from zezere import caching, models, views_netboot
+from zezere.macaddr import int_to_mac
+
+
+class VersionedCacheTest(TestCase):
+    def test_lookup_store(self):
+        vcache = caching.VersionedCache("test", 60)
+        deps = [("device", 1), ("user", None)]
+
+        value, token = vcache.lookup(("foo",), deps)
+        self.assertIsNone(value)
+        vcache.store(token, "bar")
+
+        value, _ = vcache.lookup(("foo",), deps)
+        self.assertEqual(value, "bar")
+        value, _ = vcache.lookup(("baz",), deps)
+        self.assertIsNone(value)
+
+    def test_bump_version(self):
+        vcache = caching.VersionedCache("test", 60)
+        deps = [("device", 1), ("runrequest", 2)]
+
+        _, token = vcache.lookup(("foo",), deps)
+        vcache.store(token, "bar")
+        caching.bump_version("runrequest", 2)
+        value, _ = vcache.lookup(("foo",), deps)
+        self.assertIsNone(value)
+
+    def test_store_stale(self):
+        vcache = caching.VersionedCache("test", 60)
+        deps = [("device", 1)]
+
+        # A change between lookup and store must not be masked
+        _, token = vcache.lookup(("foo",), deps)
+        caching.bump_version("device", 1)
+        vcache.store(token, "stale")
+        value, _ = vcache.lookup(("foo",), deps)
+        self.assertIsNone(value)
+
+    def test_evicted_version(self):
+        vcache = caching.VersionedCache("test", 60)
+        deps = [("device", 1)]
+
+        _, token = vcache.lookup(("foo",), deps)
+        vcache.store(token, "bar")
+        cache.delete("zezere:version:device:1")
+        value, _ = vcache.lookup(("foo",), deps)
+        self.assertIsNone(value)
+
+
+class FleetCacheTest(TestCase):
+    DEVICES = 400
+
+    def test_fleet_fits(self):
+        # Django's default of 300 entries evicts the entries of such a fleet
+        first = 0x020000000000
+        models.Device.objects.bulk_create(
+            models.Device(
+                mac_address=int_to_mac(first + i),
+                mac_int=first + i,
+                architecture="x86_64",
+                last_ip_address="127.0.0.1",
+            )
+            for i in range(self.DEVICES)
+        )
+        urls = [
+            "/netboot/x86_64/grubcfg/%s" % int_to_mac(first + i)
+            for i in range(self.DEVICES)
+        ]
+        for url in urls:
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+        with patch(
+            "zezere.views_netboot.render_for_device",
+            wraps=views_netboot.render_for_device,
+        ) as mock_render:
+            for url in urls:
+                self.assertEqual(self.client.get(url).status_code, 200)
+        mock_render.assert_not_called()
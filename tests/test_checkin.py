@@ -0,0 +1,106 @@
+from unittest.mock import patch
+
+import threading
+
+from django.test import override_settings
+
+from . import TestCase
+
+from zezere import checkin
+
+
+class CheckInBufferTest(TestCase):
+    def test_record_is_buffered(self):
+        dev = self.get_device(self.DEVICE_1)
+        checkin.buffer.record(dev, "10.0.0.1")
+        self.assertEqual(dev.last_ip_address, "10.0.0.1")
+        self.assertEqual(len(checkin.buffer), 1)
+        self.assertEqual(self.get_device(self.DEVICE_1).last_ip_address, "127.0.0.1")
+
+        checkin.buffer.flush()
+        self.assertEqual(len(checkin.buffer), 0)
+        self.assertEqual(self.get_device(self.DEVICE_1).last_ip_address, "10.0.0.1")
+
+    def test_record_unchanged_ip(self):
+        checkin.buffer.record(self.get_device(self.DEVICE_1), "127.0.0.1")
+        self.assertEqual(len(checkin.buffer), 0)
+
+    def test_record_pending_ip(self):
+        checkin.buffer.record(self.get_device(self.DEVICE_1), "10.0.0.1")
+        pending = checkin.buffer._pending.copy()
+        checkin.buffer.record(self.get_device(self.DEVICE_1), "10.0.0.1")
+        # The first check-in is kept, with its time
+        self.assertEqual(checkin.buffer._pending, pending)
+
+    def test_record_latest_wins(self):
+        checkin.buffer.record(self.get_device(self.DEVICE_1), "10.0.0.1")
+        checkin.buffer.record(self.get_device(self.DEVICE_1), "10.0.0.2")
+        # Moving back to the stored address must still overwrite the pending one
+        checkin.buffer.record(self.get_device(self.DEVICE_1), "127.0.0.1")
+        self.assertEqual(len(checkin.buffer), 1)
+        checkin.buffer.flush()
+        self.assertEqual(self.get_device(self.DEVICE_1).last_ip_address, "127.0.0.1")
+
+    @override_settings(CHECKIN_BUFFER_SIZE=2)
+    def test_flush_on_size(self):
+        checkin.buffer.record(self.get_device(self.DEVICE_1), "10.0.0.1")
+        self.assertEqual(len(checkin.buffer), 1)
+        dev = self.get_device(self.DEVICE_2)
+        with self.assertNumQueries(1):
+            checkin.buffer.record(dev, "10.0.0.2")
+        self.assertEqual(len(checkin.buffer), 0)
+        self.assertEqual(self.get_device(self.DEVICE_1).last_ip_address, "10.0.0.1")
+        self.assertEqual(self.get_device(self.DEVICE_2).last_ip_address, "10.0.0.2")
+
+    @override_settings(CHECKIN_FLUSH_INTERVAL=5)
+    def test_flush_on_interval(self):
+        with patch("zezere.checkin.time.monotonic", return_value=100.0):
+            checkin.buffer.record(self.get_device(self.DEVICE_1), "10.0.0.1")
+        self.assertEqual(len(checkin.buffer), 1)
+        with patch("zezere.checkin.time.monotonic", return_value=105.0):
+            checkin.buffer.record(self.get_device(self.DEVICE_2), "10.0.0.2")
+        self.assertEqual(len(checkin.buffer), 0)
+        self.assertEqual(self.get_device(self.DEVICE_1).last_ip_address, "10.0.0.1")
+
+    @override_settings(CHECKIN_FLUSH_INTERVAL=0.01)
+    def test_flush_on_timer(self):
+        flushed = threading.Event()
+        with patch.object(checkin.buffer, "flush", side_effect=flushed.set):
+            checkin.buffer.record(self.get_device(self.DEVICE_1), "10.0.0.1")
+            self.assertTrue(flushed.wait(5))
+        self.assertEqual(len(checkin.buffer), 1)
+
+    @override_settings(CHECKIN_FLUSH_INTERVAL=60)
+    def test_flush_cancels_timer(self):
+        checkin.buffer.record(self.get_device(self.DEVICE_1), "10.0.0.1")
+        timer = checkin.buffer._timer
+        self.assertTrue(timer.is_alive())
+        checkin.buffer.flush()
+        timer.join(5)
+        self.assertFalse(timer.is_alive())
+        self.assertIsNone(checkin.buffer._timer)
+
+    @override_settings(CHECKIN_FLUSH_INTERVAL=0)
+    def test_no_timer(self):
+        checkin.buffer.record(self.get_device(self.DEVICE_1), "10.0.0.1")
+        self.assertIsNone(checkin.buffer._timer)
+
+    @override_settings(CHECKIN_BUFFER_SIZE=0)
+    def test_unbuffered(self):
+        checkin.buffer.record(self.get_device(self.DEVICE_1), "10.0.0.1")
+        self.assertEqual(len(checkin.buffer), 0)
+        self.assertEqual(self.get_device(self.DEVICE_1).last_ip_address, "10.0.0.1")
+
+    @patch("logging.Logger.error")
+    def test_flush_error(self, mock_error):
+        checkin.buffer.record(self.get_device(self.DEVICE_1), "10.0.0.1")
+        with patch(
+            "zezere.models.Device.objects.bulk_update", side_effect=Exception("db")
+        ):
+            checkin.buffer.flush()
+        mock_error.assert_called_once()
+        self.assertEqual(len(checkin.buffer), 0)
+
+    def test_flush_empty(self):
+        with self.assertNumQueries(0):
+            checkin.buffer.flush()
@@ -0,0 +1,54 @@
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+import hashlib
+import os
+
+from zezere.contentstore import ContentStore
+
+
+class ContentStoreTest(TestCase):
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.store = ContentStore(self.tmpdir.name)
+
+    def test_put(self):
+        digest = self.store.put([b"foo", b"bar"])
+        self.assertEqual(digest, hashlib.sha256(b"foobar").hexdigest())
+        self.assertTrue(self.store.has(digest))
+        self.assertEqual(self.store.size(digest), 6)
+        with self.store.open(digest) as f:
+            self.assertEqual(f.read(), b"foobar")
+
+    def test_delete(self):
+        digest = self.store.put([b"foo"])
+        self.store.delete(digest)
+        self.assertFalse(self.store.has(digest))
+        # Deleting a missing object is harmless
+        self.store.delete(digest)
+
+    def test_put_error(self):
+        def chunks():
+            yield b"foo"
+            raise IOError("upstream")
+
+        with self.assertRaises(IOError):
+            self.store.put(chunks())
+        self.assertEqual(os.listdir(self.store.tmpdir), [])
+
+    def test_writer_abort(self):
+        writer = self.store.writer()
+        writer.write(b"foo")
+        writer.flush()
+        with open(writer.tmppath, "rb") as f:
+            self.assertEqual(f.read(), b"foo")
+        writer.abort()
+        self.assertFalse(os.path.exists(writer.tmppath))
+        # Aborting again is harmless
+        writer.abort()
+
+    def test_invalid_digest(self):
+        for digest in ("", "../etc/passwd", "A" * 64, hashlib.sha512().hexdigest()):
+            with self.assertRaises(ValueError):
+                self.store.path(digest)
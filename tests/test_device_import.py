@@ -0,0 +1,199 @@
+from io import StringIO
+from tempfile import NamedTemporaryFile
+from unittest.mock import patch
+
+import json
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError
+
+from . import TestCase
+
+from zezere.device_import import (
+    FORMAT_CSV,
+    FORMAT_NDJSON,
+    ImportResult,
+    RowError,
+    import_devices,
+    parse_manifest,
+)
+from zezere.models import Device
+
+
+CSV_MANIFEST = """MAC,Architecture,Hostname,Owner
+aa-bb-cc-00-00-01,aarch64,board1,testuser1
+AABBCC000002,aarch64,,
+aa:bb:cc:00:00:01,aarch64,duplicate,
+not-a-mac,aarch64,,
+aa:bb:cc:00:00:03,,,
+aa:bb:cc:00:00:04,aarch64,,nobody
+52:54:00:12:34:56,x86_64,,
+00:00:00:00:00:00,x86_64,,
+"""
+
+NDJSON_MANIFEST = """{"mac_address": "AA:BB:CC:00:00:10", "architecture": "x86_64"}
+
+{"mac": "aa:bb:cc:00:00:11", "arch": "x86_64", "hostname": "board11", "notes": 1}
+not json
+["AA:BB:CC:00:00:12"]
+"""
+
+
+class DeviceImportTest(TestCase):
+    def test_import_csv(self):
+        result = import_devices(StringIO(CSV_MANIFEST), FORMAT_CSV, batch_size=1)
+        self.assertEqual(result.rows, 8)
+        self.assertEqual(result.created, 2)
+        self.assertEqual([error.line for error in result.errors], [4, 5, 6, 7, 8, 9])
+        self.assertEqual(result.errors[0].messages, ["Duplicate MAC address"])
+        self.assertEqual(result.errors[5].messages, ["Device already exists"])
+        self.assertGreater(result.rows_per_second, 0)
+
+        device = Device.objects.by_mac("AA:BB:CC:00:00:01").get()
+        self.assertEqual(device.mac_address, "AA:BB:CC:00:00:01")
+        self.assertEqual(device.hostname, "board1")
+        self.assertEqual(device.owner, self.get_user(self.USER_1))
+        device = Device.objects.by_mac("AA:BB:CC:00:00:02").get()
+        self.assertIsNone(device.hostname)
+        self.assertIsNone(device.owner)
+
+    def test_import_ndjson(self):
+        result = import_devices(StringIO(NDJSON_MANIFEST), FORMAT_NDJSON)
+        self.assertEqual(result.created, 2)
+        self.assertEqual([error.line for error in result.errors], [4, 5])
+        self.assertEqual(
+            Device.objects.by_mac("AA:BB:CC:00:00:11").get().hostname, "board11"
+        )
+
+    def test_import_invalid_values(self):
+        manifest = "\n".join(
+            json.dumps(row)
+            for row in (
+                {"mac": 0xAABBCC000020, "arch": "x86_64"},
+                {"mac": "AA:BB:CC:00:00:21", "arch": "x86_64", "owner": ["x"]},
+                {"mac": "AA:BB:CC:00:00:22", "arch": ["x86_64"], "hostname": 22},
+                {"mac": "AA:BB:CC:00:00:23", "arch": "x86_64", "owner": None},
+                {"mac": "AA:BB:CC:00:00:24", "arch": "ARM64"},
+            )
+        )
+        result = import_devices(StringIO(manifest), FORMAT_NDJSON)
+        self.assertEqual(result.created, 1)
+        self.assertEqual(
+            result.errors,
+            [
+                RowError(1, str(0xAABBCC000020), ["mac_address must be a string"]),
+                RowError(2, "AA:BB:CC:00:00:21", ["owner must be a string"]),
+                RowError(
+                    3,
+                    "AA:BB:CC:00:00:22",
+                    ["architecture must be a string", "hostname must be a string"],
+                ),
+                RowError(5, "AA:BB:CC:00:00:24", ["Unknown architecture ARM64"]),
+            ],
+        )
+
+    def test_import_batches(self):
+        manifest = "".join(
+            json.dumps({"mac": "AA:BB:CC:00:%02X:%02X" % (i >> 8, i & 255)}) + "\n"
+            for i in range(250)
+        ).replace("}", ', "arch": "aarch64"}')
+        with self.assertNumQueries(3 * 4):
+            result = import_devices(StringIO(manifest), FORMAT_NDJSON, batch_size=100)
+        self.assertEqual(result.created, 250)
+        self.assertEqual(Device.objects.with_oui("AA:BB:CC").count(), 250)
+
+    def test_import_retry(self):
+        bulk_create = Device.objects.bulk_create
+
+        def conflict_twice(devices):
+            if mock_bulk_create.call_count <= 2:
+                raise IntegrityError()
+            return bulk_create(devices)
+
+        with patch.object(
+            Device.objects, "bulk_create", side_effect=conflict_twice
+        ) as mock_bulk_create:
+            result = import_devices(StringIO(NDJSON_MANIFEST), FORMAT_NDJSON)
+        self.assertEqual(mock_bulk_create.call_count, 3)
+        self.assertEqual(result.created, 2)
+        self.assertEqual(len(result.errors), 2)
+
+    def test_import_retry_limit(self):
+        # Conflicts that are not caused by devices of the batch are raised
+        with patch.object(
+            Device.objects, "bulk_create", side_effect=IntegrityError()
+        ) as mock_bulk_create:
+            with self.assertRaises(IntegrityError):
+                import_devices(StringIO(NDJSON_MANIFEST), FORMAT_NDJSON)
+        # One attempt per device of the batch, and a last one
+        self.assertEqual(mock_bulk_create.call_count, 3)
+        self.assertFalse(Device.objects.with_oui("AA:BB:CC").exists())
+
+    def test_command(self):
+        with NamedTemporaryFile("w", suffix=".csv") as manifest:
+            manifest.write(CSV_MANIFEST.splitlines()[0] + "\n")
+            manifest.write(CSV_MANIFEST.splitlines()[1] + "\n")
+            manifest.flush()
+            stdout = StringIO()
+            call_command("import_devices", manifest.name, stdout=stdout)
+        self.assertIn("Imported 1 of 1 devices", stdout.getvalue())
+
+    def test_command_stdin(self):
+        stdout = StringIO()
+        with patch("sys.stdin", StringIO(NDJSON_MANIFEST.splitlines()[0])):
+            call_command("import_devices", "-", format=FORMAT_NDJSON, stdout=stdout)
+        self.assertIn("Imported 1 of 1 devices", stdout.getvalue())
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            list(parse_manifest([], "xml"))
+
+    def test_empty_result(self):
+        self.assertEqual(ImportResult(0, 0, [], 0.0).rows_per_second, 0.0)
+
+    def test_command_errors(self):
+        with NamedTemporaryFile("w", suffix=".ndjson") as manifest:
+            manifest.write(NDJSON_MANIFEST)
+            manifest.flush()
+            stderr = StringIO()
+            with self.assertRaises(CommandError):
+                call_command(
+                    "import_devices", manifest.name, stdout=StringIO(), stderr=stderr
+                )
+        self.assertIn("Line 4 (None): Invalid JSON", stderr.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command("import_devices", "/nonexistent.csv")
+        with self.assertRaises(CommandError):
+            call_command("import_devices", "-", batch_size=0)
+
+    def test_api(self):
+        url = "/api/devices/import/"
+        resp = self.client.post(url, CSV_MANIFEST, content_type="text/csv")
+        self.assertEqual(resp.status_code, 403)
+
+        with self.loggedin_as():
+            resp = self.client.post(url, CSV_MANIFEST, content_type="text/csv")
+            self.assertEqual(resp.status_code, 403)
+
+        with self.loggedin_as(self.ADMIN_1):
+            resp = self.client.post(url, CSV_MANIFEST, content_type="text/csv")
+            self.assertEqual(resp.status_code, 200)
+            report = resp.json()
+            self.assertEqual(report["created"], 2)
+            self.assertEqual(len(report["errors"]), 6)
+            self.assertEqual(report["errors"][0]["line"], 4)
+
+            resp = self.client.post(
+                url, NDJSON_MANIFEST, content_type="application/x-ndjson"
+            )
+            self.assertEqual(resp.json()["created"], 2)
+
+            resp = self.client.post(url, b"\xff\n", content_type="text/csv")
+            self.assertEqual(resp.status_code, 400)
+            resp = self.client.post(url, "{}", content_type="application/json")
+            self.assertEqual(resp.status_code, 415)
+            # The test client only sets the content type of non-empty bodies
+            resp = self.client.generic("POST", url, CONTENT_TYPE="text/csv")
+            self.assertEqual(resp.json()["rows"], 0)
@@ -0,0 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+from unittest.mock import patch
+
+import time
+
+from django.core.exceptions import ValidationError
+from django.db import OperationalError, connection
+from django.test import TransactionTestCase
+
+from zezere.models import Device
+
+
+LOCK_RETRIES = 500
+
+
+class DeviceRegisterTest(TransactionTestCase):
+    WORKERS = 8
+
+    @patch("logging.Logger.error")
+    def boot_concurrently(self, macs, mock_error):
+        barrier = Barrier(len(macs))
+
+        def wait_for_locks(execute, *args):
+            # The in-memory test database fails on locked tables instead of
+            #  waiting for them like other databases, so retry for a while.
+            for _ in range(LOCK_RETRIES):
+                try:
+                    return execute(*args)
+                except OperationalError as ex:
+                    if "locked" not in str(ex):
+                        raise
+                    time.sleep(0.01)
+            return execute(*args)
+
+        def boot(mac):
+            try:
+                with connection.execute_wrapper(wait_for_locks):
+                    barrier.wait()
+                    resp = self.client_class().get("/netboot/x86_64/grubcfg/%s" % mac)
+                    return resp.status_code
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=len(macs)) as executor:
+            statuses = list(executor.map(boot, macs))
+        # Errors make the view serve the fallback config
+        mock_error.assert_not_called()
+        return statuses
+
+    def test_register(self):
+        device = Device.objects.register("aa-bb-cc-dd-ee-ff", "x86_64", "10.0.0.1")
+        self.assertEqual(device.mac_address, "AA:BB:CC:DD:EE:FF")
+        self.assertEqual(device.last_ip_address, "10.0.0.1")
+
+        with self.assertNumQueries(1):
+            again = Device.objects.register("AABBCCDDEEFF", "x86_64", "10.0.0.2")
+        self.assertEqual(again.pk, device.pk)
+
+        with self.assertRaises(ValidationError):
+            Device.objects.register("AA:BB:CC:DD:EE:FF", "aarch64", "10.0.0.1")
+        with self.assertRaises(ValidationError):
+            Device.objects.register("52:54:00:12:34:56", "x86_64", "10.0.0.1")
+        with self.assertRaises(ValidationError):
+            Device.objects.register("invalid", "x86_64", "10.0.0.1")
+
+    def test_upsert_existing(self):
+        # A concurrent request registered the device after the SELECT
+        Device.objects.register("AA:BB:CC:DD:EE:FF", "x86_64", "10.0.0.1")
+        device = Device.objects.all()._upsert(
+            Device(
+                mac_address="aa:bb:cc:dd:ee:ff",
+                architecture="x86_64",
+                last_ip_address="10.0.0.2",
+            )
+        )
+        self.assertEqual(Device.objects.count(), 1)
+        self.assertEqual(device.pk, Device.objects.get().pk)
+        self.assertEqual(device.last_ip_address, "10.0.0.2")
+
+    def test_upsert_unsupported(self):
+        with patch.object(
+            connection.features, "supports_update_conflicts_with_target", False
+        ):
+            device = Device.objects.register("AA:BB:CC:DD:EE:FF", "x86_64", "10.0.0.1")
+            existing = Device.objects.all()._upsert(
+                Device(
+                    mac_address="AA:BB:CC:DD:EE:FF",
+                    architecture="x86_64",
+                    last_ip_address="10.0.0.2",
+                )
+            )
+        self.assertEqual(existing.pk, device.pk)
+        self.assertEqual(Device.objects.count(), 1)
+
+    def test_concurrent_first_boot_same_mac(self):
+        statuses = self.boot_concurrently(["AA:BB:CC:DD:EE:FF"] * self.WORKERS)
+        self.assertEqual(statuses, [200] * self.WORKERS)
+        self.assertEqual(Device.objects.by_mac("AA:BB:CC:DD:EE:FF").count(), 1)
+
+    def test_concurrent_first_boot_different_macs(self):
+        macs = ["AA:BB:CC:DD:EE:%02X" % i for i in range(self.WORKERS)]
+        statuses = self.boot_concurrently(macs + macs)
+        self.assertEqual(statuses, [200] * len(macs) * 2)
+        self.assertEqual(Device.objects.with_oui("AA:BB:CC").count(), self.WORKERS)
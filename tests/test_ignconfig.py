@@ -1,6 +1,19 @@
+from typing import List, Optional
+from unittest.mock import patch
+
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import pathlib
+import tempfile
+
 from . import TestCase
 
 from zezere import ignconfig
+from zezere.contentstore import ContentStore
 
 
 class IgnConfigTest(TestCase):
@@ -85,6 +98,151 @@ class IgnConfigTest(TestCase):
             },
         )
 
+    def test_filecontents_contents_types(self):
+        payload = os.urandom(1000000)
+        expected = ignconfig.FileContents(contents=payload).generate_config()
+        self.assertEqual(
+            expected["source"],
+            ignconfig.DATA_URL_PREFIX + base64.b64encode(payload).decode(),
+        )
+        self.assertEqual(
+            expected["verification"]["hash"],
+            "sha512-%s" % hashlib.sha512(payload).hexdigest(),
+        )
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "payload")
+            with open(path, "wb") as f:
+                f.write(payload)
+
+            for contents in (
+                path,
+                pathlib.Path(path),
+                io.BytesIO(payload),
+                # Chunks that are not a multiple of 3 bytes
+                (payload[i : i + 1000] for i in range(0, len(payload), 1000)),
+            ):
+                self.assertEqual(
+                    ignconfig.FileContents(contents=contents).generate_config(),
+                    expected,
+                )
+
+    def test_filecontents_memoized(self):
+        payload = os.urandom(1000)
+        first = ignconfig.encode_contents(payload)
+        self.assertIs(ignconfig.encode_contents(io.BytesIO(payload)), first)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "payload")
+            with open(path, "wb") as f:
+                f.write(b"first")
+            first = ignconfig.encode_contents(path)
+            self.assertIs(ignconfig.encode_contents(path), first)
+
+            with open(path, "wb") as f:
+                f.write(b"second contents")
+            second = ignconfig.encode_contents(path)
+            self.assertEqual(
+                second.digest, hashlib.sha512(b"second contents").hexdigest()
+            )
+
+    def test_filecontents_memo_size(self):
+        payloads = [os.urandom(100) for _ in range(3)]
+        with patch.object(ignconfig, "CONTENTS_MEMO_SIZE", 2):
+            first = ignconfig.encode_contents(payloads[0])
+            for payload in payloads[1:]:
+                ignconfig.encode_contents(payload)
+            # The least recently used contents were dropped
+            again = ignconfig.encode_contents(payloads[0])
+        self.assertIsNot(again, first)
+        self.assertEqual(again, first)
+
+    def test_filecontents_compress(self):
+        payload = b"[Service]\nExecStart=/usr/bin/true\n" * 10000
+        ctsobj = ignconfig.FileContents(contents=payload, compress=True)
+        cfg = ctsobj.generate_config()
+        self.assertEqual(cfg["compression"], "gzip")
+        self.assertEqual(
+            cfg["verification"]["hash"],
+            "sha512-%s" % hashlib.sha512(payload).hexdigest(),
+        )
+        self.assertTrue(cfg["source"].startswith(ignconfig.DATA_URL_PREFIX))
+        compressed = base64.b64decode(cfg["source"][len(ignconfig.DATA_URL_PREFIX) :])
+        self.assertEqual(gzip.decompress(compressed), payload)
+        self.assertLess(len(cfg["source"]), len(payload) // 10)
+
+        # Output is reproducible, and memoized separately from uncompressed
+        self.assertEqual(
+            ignconfig.FileContents(
+                contents=io.BytesIO(payload), compress=True
+            ).generate_config(),
+            cfg,
+        )
+        self.assertNotIn(
+            "compression",
+            ignconfig.FileContents(contents=payload).generate_config(),
+        )
+
+    def test_filecontents_compress_url(self):
+        with self.assertRaises(ValueError) as ex:
+            ignconfig.FileContents(sourceURL="https://foo", compress=True)
+        self.assertEqual(ex.exception.args[0], "Only inline contents can be compressed")
+
+    def test_filecontents_offload(self):
+        payload = b"[Service]\n" * 1000
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = ContentStore(tmpdir, "sha512")
+            with ignconfig.offload_blobs(store, "https://blobs/", 1000):
+                small = ignconfig.FileContents(contents=b"small")
+                large = ignconfig.FileContents(contents=payload)
+                stream = ignconfig.FileContents(contents=[b"small"])
+                compressed = ignconfig.FileContents(contents=payload, compress=True)
+
+            self.assertTrue(small.source.startswith(ignconfig.DATA_URL_PREFIX))
+
+            digest = hashlib.sha512(payload).hexdigest()
+            self.assertEqual(
+                large.generate_config(),
+                {
+                    "source": "https://blobs/%s" % digest,
+                    "verification": {"hash": "sha512-%s" % digest},
+                },
+            )
+            with store.open(digest) as f:
+                self.assertEqual(f.read(), payload)
+
+            # Contents of unknown size are always offloaded
+            self.assertEqual(
+                stream.source,
+                "https://blobs/%s" % hashlib.sha512(b"small").hexdigest(),
+            )
+
+            self.assertEqual(compressed.digest, digest)
+            self.assertEqual(compressed.compression, "gzip")
+            with store.open(compressed.source[len("https://blobs/") :]) as f:
+                self.assertEqual(gzip.decompress(f.read()), payload)
+
+            path = os.path.join(tmpdir, "payload")
+            with open(path, "wb") as f:
+                f.write(payload)
+            with ignconfig.offload_blobs(store, "https://blobs/", 1000):
+                for contents in (path, memoryview(payload)):
+                    self.assertEqual(
+                        ignconfig.FileContents(contents=contents).source, large.source
+                    )
+
+        # Outside of the context contents are inlined again
+        self.assertTrue(
+            ignconfig.FileContents(contents=payload).source.startswith(
+                ignconfig.DATA_URL_PREFIX
+            )
+        )
+
+    def test_filecontents_empty(self):
+        self.assertEqual(
+            ignconfig.FileContents(contents=[]).source, ignconfig.DATA_URL_PREFIX
+        )
+
     def test_filecontents_init_sourceurl(self):
         ctsobj = ignconfig.FileContents(
             sourceURL="https://nowhere.foo",
@@ -122,6 +280,30 @@ class IgnConfigTest(TestCase):
             },
         )
 
+    def test_passwd_user_fields(self):
+        obj = ignconfig.PasswdUser("myusername")
+        self.assertIsNone(obj.uid)
+        self.assertEqual(
+            ignconfig.PasswdUser._fields, tuple(sorted(ignconfig.PasswdUser._fields))
+        )
+        self.assertIn("sshAuthorizedKeys", ignconfig.PasswdUser._fields)
+        self.assertNotIn("generate_config", ignconfig.PasswdUser._fields)
+        with self.assertRaises(AttributeError):
+            obj.homedir = "/home/myusername"
+
+    def test_attribute_type_inherited_fields(self):
+        class ExtendedGroup(ignconfig.PasswdGroup):
+            members: Optional[List[str]] = None
+
+        obj = ExtendedGroup("mygroup")
+        obj.gid = 42
+        obj.members = ["myusername"]
+        self.assertEqual(ExtendedGroup.__slots__, ("members",))
+        self.assertEqual(
+            obj.generate_config(),
+            {"name": "mygroup", "gid": 42, "members": ["myusername"]},
+        )
+
     def test_passwd_group_init(self):
         obj = ignconfig.PasswdGroup("mygroup")
         self.assertIsNotNone(obj)
@@ -279,3 +461,108 @@ class IgnConfigTest(TestCase):
                 },
             },
         )
+
+    def test_compiled_config_matches_generated(self):
+        obj = ignconfig.IgnitionConfig()
+        user = ignconfig.PasswdUser("testuser")
+        user.groups = ["wheel"]
+        obj.add_user(user)
+        obj.add_group(ignconfig.PasswdGroup("testgroup"))
+        unit = ignconfig.SystemdUnit("test.service")
+        unit.add_dropin(ignconfig.SystemdUnitDropin("10-test.conf", "[Service]"))
+        obj.add_unit(unit)
+        obj.add_config_merge(ignconfig.FileContents(contents=b"foo"))
+        hostname = ignconfig.StorageFile(
+            "/etc/hostname", ignconfig.FileContents(contents=b"host\n")
+        )
+        hostname.mode = 0o644
+        obj.add_file(hostname)
+
+        self.assertEqual(
+            ignconfig.assemble_configs([obj.compile()]),
+            json.dumps(obj.generate_config()).encode(),
+        )
+        self.assertEqual(
+            ignconfig.assemble_configs([ignconfig.IgnitionConfig().compile()]),
+            json.dumps(ignconfig.IgnitionConfig().generate_config()).encode(),
+        )
+
+        out = io.BytesIO()
+        obj.write_json(out)
+        self.assertEqual(out.getvalue(), json.dumps(obj.generate_config()).encode())
+
+    def test_filecontents_json_chunks(self):
+        for kwargs in (
+            {"contents": b"foo"},
+            {"contents": b"foo" * 100, "compress": True},
+            {"sourceURL": "https://foo"},
+        ):
+            obj = ignconfig.FileContents(**kwargs)
+            # Responses only write out bytes as is
+            for chunk in obj.json_chunks():
+                self.assertIs(type(chunk), bytes)
+            self.assertEqual(
+                b"".join(obj.json_chunks()), json.dumps(obj.generate_config()).encode()
+            )
+
+    def test_layered_configs(self):
+        base = ignconfig.IgnitionConfig()
+        base.add_unit(ignconfig.RawConfigObject({"name": "a.service", "mask": True}))
+        base.add_unit(ignconfig.RawConfigObject({"name": "b.service"}))
+        base.add_user(
+            ignconfig.RawConfigObject(
+                {"name": "root", "passwordHash": "hash", "groups": ["wheel"]}
+            )
+        )
+        base.add_file(ignconfig.RawConfigObject({"path": "/etc/motd", "mode": 420}))
+        base.add_config_merge(ignconfig.FileContents("https://base.ign"))
+
+        overlay = ignconfig.IgnitionConfig()
+        root = ignconfig.PasswdUser("root")
+        root.sshAuthorizedKeys = ["key"]
+        overlay.add_user(root)
+        overlay.add_unit(
+            ignconfig.RawConfigObject({"name": "a.service", "enabled": True})
+        )
+        overlay.add_config_merge(ignconfig.FileContents("https://overlay.ign"))
+        motd = ignconfig.StorageFile("/etc/motd", ignconfig.FileContents("https://m"))
+        motd.overwrite = True
+        overlay.add_file(motd)
+
+        cfg = json.loads(
+            ignconfig.assemble_configs([base.compile(), overlay.compile()])
+        )
+        # Same-named items are merged field by field
+        self.assertEqual(
+            cfg["systemd"]["units"],
+            [
+                {"name": "a.service", "mask": True, "enabled": True},
+                {"name": "b.service"},
+            ],
+        )
+        self.assertEqual(
+            cfg["passwd"]["users"],
+            [
+                {
+                    "name": "root",
+                    "passwordHash": "hash",
+                    "groups": ["wheel"],
+                    "sshAuthorizedKeys": ["key"],
+                }
+            ],
+        )
+        self.assertEqual(
+            cfg["storage"]["files"],
+            [
+                {
+                    "path": "/etc/motd",
+                    "mode": 420,
+                    "overwrite": True,
+                    "contents": {"source": "https://m"},
+                }
+            ],
+        )
+        self.assertEqual(
+            cfg["ignition"]["config"]["merges"],
+            [{"source": "https://base.ign"}, {"source": "https://overlay.ign"}],
+        )
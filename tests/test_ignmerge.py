@@ -0,0 +1,331 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase as UnitTestCase
+from unittest.mock import patch
+
+import base64
+import gzip
+import hashlib
+import json
+import socket
+import threading
+
+from django.test import override_settings
+
+from . import TestCase
+
+from zezere import ignconfig, models
+from zezere.ignmerge import MergeError, MergeFetchCache, flatten_config, merge_configs
+
+
+class ConfigHandler(BaseHTTPRequestHandler):
+    configs = {}
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("If-None-Match")))
+        config = self.configs.get(self.path)
+        if config is None:
+            self.send_error(404)
+            return
+        body = json.dumps(config).encode("utf-8")
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ConfigServerMixin(object):
+    def start_server(self):
+        ConfigHandler.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ConfigHandler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        ConfigHandler.configs = {
+            "/base.ign": {
+                "ignition": {"version": "3.0.0"},
+                "systemd": {
+                    "units": [
+                        {"name": "base.service", "enabled": True},
+                        {"name": "shared.service", "mask": True},
+                    ]
+                },
+                "passwd": {"users": [{"name": "root", "sshAuthorizedKeys": ["base"]}]},
+            },
+            "/nested.ign": {
+                "ignition": {
+                    "version": "3.0.0",
+                    "config": {"merge": [{"source": self.url("/leaf.ign")}]},
+                },
+                "systemd": {"units": [{"name": "nested.service"}]},
+            },
+            "/leaf.ign": {
+                "ignition": {"version": "3.0.0"},
+                "systemd": {"units": [{"name": "leaf.service"}]},
+            },
+            "/loop.ign": {
+                "ignition": {
+                    "version": "3.0.0",
+                    "config": {"merge": [{"source": self.url("/loop.ign")}]},
+                },
+            },
+        }
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server.server_port, path)
+
+    def reference(self, path):
+        body = json.dumps(ConfigHandler.configs.get(path)).encode("utf-8")
+        return ignconfig.FileContents(self.url(path), hashlib.sha512(body).hexdigest())
+
+
+class MergeConfigsTest(UnitTestCase):
+    def test_merge_configs(self):
+        parent = {
+            "ignition": {"version": "3.0.0", "timeouts": {"httpTotal": 10}},
+            "systemd": {
+                "units": [
+                    {"name": "a.service", "enabled": True, "contents": "[Unit]"},
+                    {"name": "b.service"},
+                ]
+            },
+            "passwd": {
+                "users": [
+                    {"name": "root", "sshAuthorizedKeys": ["key1"], "groups": ["a"]}
+                ]
+            },
+        }
+        child = {
+            "ignition": {"timeouts": {"httpResponseHeaders": 5}},
+            "systemd": {
+                "units": [
+                    {"name": "a.service", "enabled": False},
+                    {"name": "c.service"},
+                ]
+            },
+            "passwd": {
+                "users": [{"name": "root", "sshAuthorizedKeys": ["key1", "key2"]}],
+                "groups": [{"name": "wheel"}],
+            },
+        }
+        self.assertEqual(
+            merge_configs(parent, child),
+            {
+                "ignition": {
+                    "version": "3.0.0",
+                    "timeouts": {"httpTotal": 10, "httpResponseHeaders": 5},
+                },
+                "systemd": {
+                    "units": [
+                        {"name": "a.service", "enabled": False, "contents": "[Unit]"},
+                        {"name": "b.service"},
+                        {"name": "c.service"},
+                    ]
+                },
+                "passwd": {
+                    "users": [
+                        {
+                            "name": "root",
+                            "sshAuthorizedKeys": ["key1", "key2"],
+                            "groups": ["a"],
+                        }
+                    ],
+                    "groups": [{"name": "wheel"}],
+                },
+            },
+        )
+        # The inputs are left alone
+        self.assertEqual(len(parent["systemd"]["units"]), 2)
+
+
+class FlattenConfigTest(ConfigServerMixin, UnitTestCase):
+    def setUp(self):
+        self.start_server()
+
+    def config(self, *sources):
+        cfg = ignconfig.IgnitionConfig()
+        unit = ignconfig.SystemdUnit("shared.service")
+        unit.enabled = True
+        cfg.add_unit(unit)
+        root = ignconfig.PasswdUser("root")
+        root.sshAuthorizedKeys = ["device"]
+        cfg.add_user(root)
+        for source in sources:
+            if isinstance(source, bytes):
+                cfg.add_config_merge(ignconfig.FileContents(contents=source))
+            else:
+                cfg.add_config_merge(self.reference(source))
+        return json.loads(ignconfig.assemble_configs([cfg.compile()]))
+
+    def test_flatten(self):
+        cache = MergeFetchCache(ttl=60)
+        flattened = flatten_config(self.config("/base.ign"), cache)
+        self.assertEqual(flattened["ignition"]["config"], {"merges": []})
+        self.assertEqual(
+            flattened["systemd"]["units"],
+            [
+                {
+                    "name": "shared.service",
+                    "enabled": True,
+                    "mask": True,
+                    "dropins": [],
+                },
+                {"name": "base.service", "enabled": True},
+            ],
+        )
+        self.assertEqual(
+            flattened["passwd"]["users"],
+            [{"name": "root", "sshAuthorizedKeys": ["device", "base"]}],
+        )
+        self.assertEqual(flattened["ignition"]["version"], "3.0.0")
+
+        # Served from the cache
+        flatten_config(self.config("/base.ign"), cache)
+        self.assertEqual(ConfigHandler.requests, [("/base.ign", None)])
+
+    def test_revalidate(self):
+        cache = MergeFetchCache(ttl=0)
+        flatten_config(self.config("/base.ign"), cache)
+        flatten_config(self.config("/base.ign"), cache)
+        self.assertEqual(len(ConfigHandler.requests), 2)
+        self.assertIsNotNone(ConfigHandler.requests[1][1])
+
+        ConfigHandler.configs["/base.ign"]["systemd"]["units"] = []
+        flattened = flatten_config(self.config("/base.ign"), cache)
+        self.assertEqual(
+            flattened["systemd"]["units"],
+            [{"name": "shared.service", "enabled": True, "dropins": []}],
+        )
+
+    def test_nested_and_inline(self):
+        inline = json.dumps(
+            {"ignition": {"version": "3.0.0"}, "passwd": {"groups": [{"name": "g"}]}}
+        ).encode("utf-8")
+        flattened = flatten_config(
+            self.config("/nested.ign", inline), MergeFetchCache(ttl=60)
+        )
+        self.assertEqual(
+            [unit["name"] for unit in flattened["systemd"]["units"]],
+            ["shared.service", "nested.service", "leaf.service"],
+        )
+        self.assertEqual(flattened["passwd"]["groups"], [{"name": "g"}])
+
+    def test_verification(self):
+        config = self.config()
+        config["ignition"]["config"]["merges"] = [
+            {
+                "source": self.url("/base.ign"),
+                "verification": {"hash": "sha512-%s" % ("0" * 128)},
+            }
+        ]
+        with self.assertRaises(MergeError):
+            flatten_config(config, MergeFetchCache(ttl=60))
+
+    def test_not_found(self):
+        with self.assertRaises(MergeError):
+            flatten_config(self.config("/nowhere.ign"), MergeFetchCache(ttl=60))
+
+    def flatten_references(self, *references):
+        config = self.config()
+        config["ignition"]["config"]["merges"] = list(references)
+        return flatten_config(config, MergeFetchCache(ttl=60))
+
+    def data_url(self, data):
+        return "data:;base64," + base64.b64encode(data).decode("ascii")
+
+    def test_fetch_error(self):
+        # Nothing listens on a port that was just released
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        with self.assertRaisesRegex(MergeError, "Error fetching"):
+            self.flatten_references({"source": "http://127.0.0.1:%d/" % port})
+
+    def test_gzip(self):
+        data = json.dumps({"passwd": {"groups": [{"name": "g"}]}}).encode("utf-8")
+        flattened = self.flatten_references(
+            {"source": self.data_url(gzip.compress(data)), "compression": "gzip"}
+        )
+        self.assertEqual(flattened["passwd"]["groups"], [{"name": "g"}])
+
+        with self.assertRaisesRegex(MergeError, "Invalid gzip data"):
+            self.flatten_references(
+                {"source": self.data_url(data), "compression": "gzip"}
+            )
+
+    def test_invalid_config(self):
+        for data in (b"{", b"[]", b'"config"'):
+            with self.subTest(data=data):
+                with self.assertRaisesRegex(MergeError, "Invalid config"):
+                    self.flatten_references({"source": self.data_url(data)})
+
+    def test_invalid_data_url(self):
+        for url in ("data:,{}", "data:;base64,{}"):
+            with self.subTest(url=url):
+                with self.assertRaises(MergeError):
+                    self.flatten_references({"source": url})
+
+    def test_depth_limit(self):
+        with self.assertRaisesRegex(MergeError, "nested too deeply"):
+            flatten_config(self.config("/loop.ign"), MergeFetchCache(ttl=60))
+
+    def test_replace(self):
+        config = self.config()
+        config["ignition"]["config"]["replace"] = {"source": self.url("/base.ign")}
+        with self.assertRaisesRegex(MergeError, "can not be flattened"):
+            flatten_config(config, MergeFetchCache(ttl=60))
+        self.assertEqual(ConfigHandler.requests, [])
+
+
+@override_settings(IGNITION_FLATTEN_MERGES=True)
+class FlattenViewTest(ConfigServerMixin, TestCase):
+    fixtures = ["fedora_installed.json", "fedora_iot_runreqs.json"]
+
+    def setUp(self):
+        super().setUp()
+        self.start_server()
+
+    def get_ignition_config(self, path):
+        orig_get_ignition_config = models.Device.get_ignition_config
+
+        def get_ignition_config(device, request):
+            cfgobj = orig_get_ignition_config(device, request)
+            cfgobj.add_config_merge(self.reference(path))
+            return cfgobj
+
+        ignurl = "/netboot/x86_64/ignition/%s" % self.DEVICE_1
+        with patch.object(models.Device, "get_ignition_config", get_ignition_config):
+            with self.loggedin_as():
+                with self.claimed_device(self.DEVICE_1) as dev:
+                    with self.device_with_runreq(dev, self.RUNREQ_INSTALLED):
+                        resp = self.client.get(ignurl)
+        self.assertEqual(resp.status_code, 200)
+        return resp.json()
+
+    def test_flattened(self):
+        cfg = self.get_ignition_config("/base.ign")
+        self.assertEqual(cfg["ignition"]["config"]["merges"], [])
+        self.assertEqual(
+            [unit["name"] for unit in cfg["systemd"]["units"]],
+            ["base.service", "shared.service"],
+        )
+
+    @patch("logging.Logger.error")
+    def test_fallback(self, mock_error):
+        cfg = self.get_ignition_config("/nowhere.ign")
+        self.assertEqual(
+            cfg["ignition"]["config"]["merges"],
+            [self.reference("/nowhere.ign").generate_config()],
+        )
+        mock_error.assert_called_once()
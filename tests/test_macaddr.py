@@ -0,0 +1,39 @@
+from unittest import TestCase
+
+from zezere.macaddr import int_to_mac, mac_to_int, normalize_mac, oui_range
+
+
+class MacAddrTest(TestCase):
+    def test_forms(self):
+        for value in (
+            "AA:BB:CC:DD:EE:0F",
+            "aa:bb:cc:dd:ee:0f",
+            "aa-BB-cc-DD-ee-0F",
+            "aabbccddee0f",
+            " AABBCCDDEE0F\n",
+        ):
+            self.assertEqual(mac_to_int(value), 0xAABBCCDDEE0F, value)
+            self.assertEqual(normalize_mac(value), "AA:BB:CC:DD:EE:0F")
+
+    def test_invalid(self):
+        for value in (
+            "",
+            "AA:BB:CC:DD:EE",
+            "AA:BB:CC:DD:EE:FF:00",
+            "AA:BB-CC:DD:EE:FF",
+            "AA.BB.CC.DD.EE.FF",
+            "AABB:CCDD:EEFF",
+            "GG:BB:CC:DD:EE:FF",
+        ):
+            with self.assertRaises(ValueError, msg=value):
+                mac_to_int(value)
+
+    def test_int_to_mac(self):
+        self.assertEqual(int_to_mac(0), "00:00:00:00:00:00")
+        self.assertEqual(int_to_mac(0xFFFFFFFFFFFF), "FF:FF:FF:FF:FF:FF")
+
+    def test_oui_range(self):
+        self.assertEqual(oui_range("52:54:00"), (0x525400000000, 0x525400FFFFFF))
+        self.assertEqual(oui_range("525400"), oui_range("52-54-00"))
+        with self.assertRaises(ValueError):
+            oui_range("52:54")
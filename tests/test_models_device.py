@@ -0,0 +1,74 @@
+from . import TestCase
+
+from importlib import import_module
+
+from django.apps import apps
+from django.core.exceptions import ValidationError
+
+from zezere.models import Device
+
+
+class ModelsDeviceTest(TestCase):
+    MAC = "AA:BB:CC:DD:EE:0F"
+
+    def setUp(self):
+        super().setUp()
+        self.device = Device(
+            mac_address=self.MAC.replace(":", "-").lower(),
+            architecture="x86_64",
+            last_ip_address="127.0.0.1",
+        )
+        self.device.full_clean()
+        self.device.save()
+
+    def test_normalized(self):
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.mac_address, self.MAC)
+        self.assertEqual(self.device.mac_int, 0xAABBCCDDEE0F)
+
+    def test_invalid(self):
+        for mac_address in ("not-a-mac", None, 0xAABBCCDDEE0F, ["AA:BB:CC:DD:EE:0F"]):
+            with self.subTest(mac_address=mac_address):
+                with self.assertRaises(ValidationError):
+                    Device(
+                        mac_address=mac_address,
+                        architecture="x86_64",
+                        last_ip_address="127.0.0.1",
+                    ).full_clean()
+
+    def test_duplicate_spelling(self):
+        with self.assertRaises(ValidationError):
+            Device(
+                mac_address=self.MAC.replace(":", "").lower(),
+                architecture="x86_64",
+                last_ip_address="127.0.0.1",
+            ).full_clean()
+
+    def test_by_mac(self):
+        for value in (
+            self.MAC,
+            self.MAC.lower(),
+            self.MAC.replace(":", "-"),
+            self.MAC.replace(":", ""),
+        ):
+            self.assertEqual(Device.objects.by_mac(value).get(), self.device)
+        self.assertFalse(Device.objects.by_mac("invalid").exists())
+
+    def test_with_oui(self):
+        self.assertEqual(list(Device.objects.with_oui("aa:bb:cc")), [self.device])
+        self.assertEqual(list(Device.objects.with_oui("AA:BB:CD")), [])
+        self.assertFalse(Device.objects.with_oui("invalid").exists())
+
+        query = str(Device.objects.with_oui("AA:BB:CC").query)
+        self.assertIn("mac_int", query)
+        self.assertIn("BETWEEN", query)
+
+    def test_backfill_migration(self):
+        migration = import_module("zezere.migrations.0013_device_mac_int")
+        Device.objects.filter(pk=self.device.pk).update(
+            mac_address="aa-bb-cc-dd-ee-0f", mac_int=-1
+        )
+        migration.backfill_mac_int(apps, None)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.mac_address, self.MAC)
+        self.assertEqual(self.device.mac_int, 0xAABBCCDDEE0F)
@@ -1,10 +1,14 @@
 from . import TestCase
 
+import copy
 import json
 
 from django.core.exceptions import ValidationError
+from django.test import RequestFactory
 
+from zezere import ignconfig
 from zezere.models import RunRequest
+from zezere.runreqs import get_auto_runreq
 
 
 class ModelsRunReqTest(TestCase):
@@ -97,3 +101,72 @@ class ModelsRunReqTest(TestCase):
         )
         self.assertEqual(rreq.settings.foo, "bar")
         self.assertEqual(rreq.settings.baz.bar, "foo")
+
+    def test_settings_shared(self):
+        raw_settings = json.dumps({"baz": {"bar": "foo"}, "units": [{"a": 1}]})
+        rreq1 = RunRequest(type=RunRequest.TYPE_EFI, raw_settings=raw_settings)
+        rreq2 = RunRequest(type=RunRequest.TYPE_EFI, raw_settings=raw_settings)
+        self.assertIs(rreq1.settings, rreq2.settings)
+        self.assertIs(rreq1.settings.baz, rreq2.settings.baz)
+        self.assertEqual(rreq1.settings.units[0].a, 1)
+        self.assertEqual(
+            json.loads(json.dumps(rreq1.settings)), json.loads(raw_settings)
+        )
+
+        rreq1.raw_settings = json.dumps({"baz": None})
+        self.assertIsNone(rreq1.settings.baz)
+
+    def test_settings_immutable(self):
+        rreq = RunRequest(
+            type=RunRequest.TYPE_EFI, raw_settings=json.dumps({"baz": {"bar": "foo"}})
+        )
+        with self.assertRaises(TypeError):
+            rreq.settings["baz"] = None
+        with self.assertRaises(TypeError):
+            rreq.settings.baz.update(bar="bar")
+        with self.assertRaises(AttributeError):
+            rreq.settings.nothing
+        copied = copy.deepcopy(rreq.settings)
+        self.assertEqual(copied, rreq.settings)
+        with self.assertRaises(TypeError):
+            copied["baz"] = None
+
+    def test_ignition_config(self):
+        ignsettings = {
+            "units": [{"name": "a.service"}],
+            "users": [{"name": "core"}],
+            "groups": [{"name": "operators"}],
+            "merges": [{"source": "https://base.ign"}],
+            "files": [{"path": "/etc/motd"}],
+        }
+        rreq = RunRequest(
+            type=RunRequest.TYPE_EFI, raw_settings=json.dumps({"ignition": ignsettings})
+        )
+        # Unsaved runreqs are compiled without caching
+        compiled = rreq.get_compiled_ignition_config(RequestFactory().get("/"))
+        cfg = json.loads(ignconfig.assemble_configs([compiled]))
+        self.assertEqual(cfg["systemd"]["units"], ignsettings["units"])
+        self.assertEqual(cfg["passwd"]["users"], ignsettings["users"])
+        self.assertEqual(cfg["passwd"]["groups"], ignsettings["groups"])
+        self.assertEqual(cfg["ignition"]["config"]["merges"], ignsettings["merges"])
+        self.assertEqual(cfg["storage"]["files"], ignsettings["files"])
+
+    def test_settings_auto(self):
+        rreq1 = RunRequest.objects.get(auto_generated_id=self.RUNREQ_INSTALLED)
+        rreq2 = RunRequest.objects.get(auto_generated_id=self.RUNREQ_INSTALLED)
+        self.assertIs(rreq1.settings, rreq2.settings)
+        self.assertEqual(rreq1.settings.efi_path, "/EFI/fedora/grubx64.efi")
+
+    def test_auto_registry(self):
+        rreq = RunRequest.objects.get(auto_generated_id=self.RUNREQ_RAWHIDE)
+        autoreq = get_auto_runreq(self.RUNREQ_RAWHIDE)
+        self.assertIs(autoreq, get_auto_runreq(self.RUNREQ_RAWHIDE))
+        self.assertIs(rreq.settings, autoreq.settings)
+        self.assertEqual(rreq.type, RunRequest.TYPE_ONLINE_KERNEL)
+        self.assertEqual(rreq.kernel_url, autoreq.kernel_url)
+        self.assertTrue(rreq.kernel_url.endswith("/isolinux/vmlinuz"))
+        self.assertIn("inst.ks=:urls.kickstart:", rreq.kernel_cmd)
+
+        rreq = RunRequest.objects.get(auto_generated_id=self.RUNREQ_INSTALLED)
+        self.assertEqual(rreq.type, RunRequest.TYPE_EFI)
+        self.assertIsNone(get_auto_runreq(self.RUNREQ_INSTALLED).kernel_url)
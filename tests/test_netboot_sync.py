@@ -0,0 +1,358 @@
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+import hashlib
+import json
+import os
+import threading
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from zezere import download_netboot_files, netboot_sync
+from zezere.netboot_sync import NetbootFileSync
+
+
+class ArtifactHandler(BaseHTTPRequestHandler):
+    files = {}
+    requests = []
+    honor_ranges = True
+    # Sent instead of the real Content-Range of partial responses
+    content_range = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("Range")))
+        contents = self.files.get(self.path)
+        if contents is None:
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.sha256(contents).hexdigest()
+
+        start = 0
+        byterange = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if byterange and self.honor_ranges and if_range in (None, etag):
+            start = int(byterange[len("bytes=") :].rstrip("-"))
+        if start >= len(contents) and start > 0:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % len(contents))
+            self.end_headers()
+            return
+
+        body = contents[start:]
+        if start:
+            self.send_response(206)
+            self.send_header(
+                "Content-Range",
+                self.content_range
+                or "bytes %d-%d/%d" % (start, len(contents) - 1, len(contents)),
+            )
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class NetbootSyncTest(TestCase):
+    def setUp(self):
+        ArtifactHandler.files = {
+            "/x86_64/vmlinuz": os.urandom(300000),
+            "/x86_64/initrd": os.urandom(500000),
+            "/aarch64/vmlinuz": os.urandom(200000),
+        }
+        ArtifactHandler.requests = []
+        ArtifactHandler.honor_ranges = True
+        ArtifactHandler.content_range = None
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ArtifactHandler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.tmpdir = TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.files = [
+            {"url": self.url(path), "destination": "netboot%s" % path}
+            for path in sorted(ArtifactHandler.files)
+        ]
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server.server_port, path)
+
+    def dest(self, path):
+        return os.path.join(self.tmpdir.name, "netboot%s" % path)
+
+    def read(self, path):
+        with open(self.dest(path), "rb") as f:
+            return f.read()
+
+    def sync(self, files=None, **kwargs):
+        return NetbootFileSync(self.tmpdir.name, chunk_size=65536, **kwargs).sync(
+            files or self.files
+        )
+
+    def test_sync(self):
+        results = self.sync(concurrency=3)
+        self.assertEqual(
+            [result.status for result in results], [netboot_sync.STATUS_DOWNLOADED] * 3
+        )
+        for path, contents in ArtifactHandler.files.items():
+            self.assertEqual(self.read(path), contents)
+            self.assertFalse(os.path.exists(self.dest(path) + ".part"))
+
+        with open(os.path.join(self.tmpdir.name, netboot_sync.MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        self.assertEqual(
+            manifest["netboot/x86_64/initrd"]["sha256"],
+            hashlib.sha256(ArtifactHandler.files["/x86_64/initrd"]).hexdigest(),
+        )
+
+        # A second run only checks the manifest
+        ArtifactHandler.requests = []
+        results = self.sync()
+        self.assertEqual(
+            [result.status for result in results], [netboot_sync.STATUS_VERIFIED] * 3
+        )
+        self.assertEqual(ArtifactHandler.requests, [])
+
+    def test_truncated_file(self):
+        self.sync()
+        with open(self.dest("/x86_64/initrd"), "r+b") as f:
+            f.truncate(1000)
+
+        results = self.sync()
+        self.assertEqual(results[1].status, netboot_sync.STATUS_DOWNLOADED)
+        self.assertEqual(
+            self.read("/x86_64/initrd"), ArtifactHandler.files["/x86_64/initrd"]
+        )
+
+    def test_missing_file(self):
+        self.sync()
+        os.unlink(self.dest("/x86_64/initrd"))
+
+        results = self.sync()
+        self.assertEqual(results[1].status, netboot_sync.STATUS_DOWNLOADED)
+        self.assertEqual(
+            self.read("/x86_64/initrd"), ArtifactHandler.files["/x86_64/initrd"]
+        )
+
+    def test_changed_checksum(self):
+        self.sync()
+        ArtifactHandler.files["/x86_64/initrd"] = os.urandom(1000)
+        file = dict(
+            self.files[1],
+            sha256=hashlib.sha256(ArtifactHandler.files["/x86_64/initrd"]).hexdigest(),
+        )
+
+        results = self.sync([file])
+        self.assertEqual(results[0].status, netboot_sync.STATUS_DOWNLOADED)
+        self.assertEqual(
+            self.read("/x86_64/initrd"), ArtifactHandler.files["/x86_64/initrd"]
+        )
+
+    def test_full_verify(self):
+        self.sync()
+        with open(self.dest("/x86_64/initrd"), "r+b") as f:
+            f.write(b"corrupt")
+
+        self.assertEqual(self.sync()[1].status, netboot_sync.STATUS_VERIFIED)
+        self.assertEqual(
+            self.sync(full_verify=True)[1].status, netboot_sync.STATUS_DOWNLOADED
+        )
+        self.assertEqual(
+            self.read("/x86_64/initrd"), ArtifactHandler.files["/x86_64/initrd"]
+        )
+
+    def _interrupted_download(self, path, length):
+        contents = ArtifactHandler.files[path]
+        os.makedirs(os.path.dirname(self.dest(path)), exist_ok=True)
+        with open(self.dest(path) + ".part", "wb") as f:
+            f.write(contents[:length])
+        with open(self.dest(path) + ".part.json", "w") as f:
+            json.dump(
+                {
+                    "url": self.url(path),
+                    "validator": '"%s"' % hashlib.sha256(contents).hexdigest(),
+                },
+                f,
+            )
+
+    def test_resume(self):
+        self._interrupted_download("/x86_64/initrd", 123456)
+        file = {
+            "url": self.url("/x86_64/initrd"),
+            "destination": "netboot/x86_64/initrd",
+        }
+
+        results = self.sync([file])
+        self.assertEqual(results[0].status, netboot_sync.STATUS_RESUMED)
+        self.assertEqual(
+            ArtifactHandler.requests, [("/x86_64/initrd", "bytes=123456-")]
+        )
+        self.assertEqual(
+            self.read("/x86_64/initrd"), ArtifactHandler.files["/x86_64/initrd"]
+        )
+        self.assertFalse(os.path.exists(self.dest("/x86_64/initrd") + ".part.json"))
+
+    def test_resume_without_validator(self):
+        self._interrupted_download("/x86_64/initrd", 1000)
+        with open(self.dest("/x86_64/initrd") + ".part.json", "w") as f:
+            json.dump({"url": self.url("/x86_64/initrd"), "validator": None}, f)
+
+        results = self.sync([self.files[1]])
+        self.assertEqual(results[0].status, netboot_sync.STATUS_RESUMED)
+        self.assertEqual(
+            self.read("/x86_64/initrd"), ArtifactHandler.files["/x86_64/initrd"]
+        )
+
+    def test_resume_complete_part(self):
+        self._interrupted_download("/x86_64/initrd", 500000)
+        file = {
+            "url": self.url("/x86_64/initrd"),
+            "destination": "netboot/x86_64/initrd",
+        }
+
+        results = self.sync([file])
+        self.assertEqual(results[0].status, netboot_sync.STATUS_RESUMED)
+        self.assertEqual(
+            self.read("/x86_64/initrd"), ArtifactHandler.files["/x86_64/initrd"]
+        )
+
+    def test_resume_oversized_part(self):
+        contents = ArtifactHandler.files["/x86_64/initrd"]
+        self._interrupted_download("/x86_64/initrd", len(contents))
+        with open(self.dest("/x86_64/initrd") + ".part", "ab") as f:
+            f.write(b"garbage")
+
+        results = self.sync([self.files[1]])
+        self.assertEqual(results[0].status, netboot_sync.STATUS_DOWNLOADED)
+        self.assertEqual(
+            ArtifactHandler.requests,
+            [
+                ("/x86_64/initrd", "bytes=%d-" % (len(contents) + 7)),
+                ("/x86_64/initrd", None),
+            ],
+        )
+        self.assertEqual(self.read("/x86_64/initrd"), contents)
+
+    @patch("logging.Logger.error")
+    def test_resume_bad_content_range(self, mock_error):
+        for content_range, error in (
+            ("bytes 0-499999/500000", "unexpected offset"),
+            ("bytes 1000-499999/600000", "Download incomplete"),
+            ("garbage", "Invalid Content-Range"),
+        ):
+            with self.subTest(content_range=content_range):
+                ArtifactHandler.content_range = content_range
+                self._interrupted_download("/x86_64/initrd", 1000)
+
+                results = self.sync([self.files[1]])
+                self.assertEqual(results[0].status, netboot_sync.STATUS_FAILED)
+                self.assertIn(error, results[0].error)
+                self.assertFalse(os.path.exists(self.dest("/x86_64/initrd")))
+
+    def test_resume_changed_upstream(self):
+        self._interrupted_download("/x86_64/initrd", 1000)
+        ArtifactHandler.files["/x86_64/initrd"] = os.urandom(1234)
+        file = {
+            "url": self.url("/x86_64/initrd"),
+            "destination": "netboot/x86_64/initrd",
+        }
+
+        results = self.sync([file])
+        self.assertEqual(results[0].status, netboot_sync.STATUS_DOWNLOADED)
+        self.assertEqual(
+            self.read("/x86_64/initrd"), ArtifactHandler.files["/x86_64/initrd"]
+        )
+
+    def test_resume_unsupported(self):
+        ArtifactHandler.honor_ranges = False
+        self._interrupted_download("/x86_64/initrd", 1000)
+        file = {
+            "url": self.url("/x86_64/initrd"),
+            "destination": "netboot/x86_64/initrd",
+        }
+
+        results = self.sync([file])
+        self.assertEqual(results[0].status, netboot_sync.STATUS_DOWNLOADED)
+        self.assertEqual(
+            self.read("/x86_64/initrd"), ArtifactHandler.files["/x86_64/initrd"]
+        )
+
+    @patch("logging.Logger.error")
+    def test_checksum_mismatch(self, mock_error):
+        file = dict(self.files[0], sha256="0" * 64)
+
+        results = self.sync([file])
+        self.assertEqual(results[0].status, netboot_sync.STATUS_FAILED)
+        self.assertIn("Checksum mismatch", results[0].error)
+        self.assertFalse(os.path.exists(self.dest("/aarch64/vmlinuz")))
+        self.assertFalse(os.path.exists(self.dest("/aarch64/vmlinuz") + ".part"))
+        mock_error.assert_called_once()
+
+    @patch("logging.Logger.error")
+    def test_not_found(self, mock_error):
+        file = {"url": self.url("/nowhere"), "destination": "netboot/nowhere"}
+
+        results = self.sync([file])
+        self.assertEqual(results[0].status, netboot_sync.STATUS_FAILED)
+        self.assertFalse(os.path.exists(self.dest("/nowhere")))
+
+    def test_command(self):
+        stdout = StringIO()
+        with patch("zezere.EFI_FILES", self.files):
+            call_command("sync_netboot_files", destroot=self.tmpdir.name, stdout=stdout)
+        self.assertEqual(
+            self.read_static("/x86_64/vmlinuz"),
+            ArtifactHandler.files["/x86_64/vmlinuz"],
+        )
+        self.assertIn("netboot/x86_64/vmlinuz: downloaded\n", stdout.getvalue())
+        self.assertNotIn("\n\n", stdout.getvalue())
+
+    @patch("logging.Logger.error")
+    def test_command_failure(self, mock_error):
+        files = [{"url": self.url("/nowhere"), "destination": "netboot/nowhere"}]
+        with patch("zezere.EFI_FILES", files):
+            with self.assertRaises(CommandError):
+                call_command(
+                    "sync_netboot_files", destroot=self.tmpdir.name, stdout=StringIO()
+                )
+
+    @patch("logging.Logger.error")
+    def test_download_netboot_files(self, mock_error):
+        # The staticfiles finder syncs into the current directory, and fails
+        #  collectstatic if any file could not be synced
+        files = self.files + [
+            {"url": self.url("/nowhere"), "destination": "netboot/nowhere"}
+        ]
+        stdout = StringIO()
+        with patch("zezere.EFI_FILES", files):
+            with patch("os.getcwd", return_value=self.tmpdir.name):
+                with redirect_stdout(stdout):
+                    with self.assertRaises(netboot_sync.SyncError) as cm:
+                        download_netboot_files()
+        self.assertIn("netboot/nowhere", str(cm.exception))
+        self.assertIn("netboot/x86_64/vmlinuz: downloaded\n", stdout.getvalue())
+        self.assertEqual(
+            self.read_static("/x86_64/vmlinuz"),
+            ArtifactHandler.files["/x86_64/vmlinuz"],
+        )
+
+    def test_command_invalid_concurrency(self):
+        with self.assertRaises(CommandError):
+            call_command("sync_netboot_files", concurrency=0)
+
+    def read_static(self, path):
+        with open(
+            os.path.join(self.tmpdir.name, "zezere/static/netboot%s" % path), "rb"
+        ) as f:
+            return f.read()
@@ -0,0 +1,81 @@
+from unittest.mock import Mock
+
+from . import TestCase
+
+from zezere import models
+from zezere.placeholders import (
+    compile_placeholders,
+    device_placeholders,
+    fill_placeholders,
+)
+from zezere.runreqs import replace_device_strings
+
+
+class PlaceholdersTest(TestCase):
+    fixtures = ["fedora_installed.json", "fedora_iot_runreqs.json"]
+
+    def setUp(self):
+        super().setUp()
+        self.request = Mock()
+        self.request.build_absolute_uri = lambda path: "http://server" + path
+        self.device = models.Device(
+            mac_address="AA:BB:CC:DD:EE:FF", architecture="aarch64"
+        )
+
+    def test_compile(self):
+        self.assertEqual(
+            compile_placeholders("a:arch:b:mac_addr::arch:"),
+            ("a", "arch", "b", "mac_addr", "", "arch", ""),
+        )
+        self.assertEqual(
+            compile_placeholders("no:placeholders:"), ("no:placeholders:",)
+        )
+
+    def test_fill_not_memoized(self):
+        compile_placeholders.cache_clear()
+        fill_placeholders(":arch: once", {"arch": "x86_64"}, memoize=False)
+        self.assertEqual(compile_placeholders.cache_info().currsize, 0)
+        fill_placeholders(":arch: often", {"arch": "x86_64"})
+        self.assertEqual(compile_placeholders.cache_info().currsize, 1)
+
+    def test_render_not_memoized(self):
+        compile_placeholders.cache_clear()
+        with self.loggedin_as():
+            with self.claimed_device(self.DEVICE_1) as dev:
+                with self.device_with_runreq(dev, self.RUNREQ_RAWHIDE):
+                    resp = self.client.get("/netboot/kickstart/%s" % self.DEVICE_1)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(compile_placeholders.cache_info().currsize, 0)
+
+    def test_fill(self):
+        value = ":urls.base:netboot/postboot/:mac_addr: :arch: :urls.kickstart:"
+        self.assertEqual(
+            fill_placeholders(value, device_placeholders(self.request, self.device)),
+            "http://server/netboot/postboot/AA:BB:CC:DD:EE:FF aarch64 "
+            "http://server/netboot/kickstart/AA:BB:CC:DD:EE:FF",
+        )
+
+    def test_fill_without_device(self):
+        value = ":urls.base:netboot/:arch:"
+        self.assertEqual(
+            fill_placeholders(value, device_placeholders(self.request, None)),
+            "http://server/netboot/:arch:",
+        )
+
+    def test_fill_lazy_values(self):
+        base = Mock(return_value="http://server/")
+        self.assertEqual(fill_placeholders(":arch:", {"urls.base": base}), ":arch:")
+        base.assert_not_called()
+        self.assertEqual(
+            fill_placeholders(":urls.base:a :urls.base:b", {"urls.base": base}),
+            "http://server/a http://server/b",
+        )
+        base.assert_called_once()
+
+    def test_replace_device_strings(self):
+        self.assertEqual(
+            replace_device_strings(
+                self.request, ":urls.base: inst.ks=:urls.kickstart:", self.device
+            ),
+            ":urls.base: inst.ks=http://server/netboot/kickstart/AA:BB:CC:DD:EE:FF",
+        )
@@ -0,0 +1,168 @@
+from io import StringIO
+
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from . import TestCase
+
+from zezere.models import Device, Rollout, RunRequest
+
+
+class RolloutTest(TestCase):
+    fixtures = ["fedora_installed.json", "fedora_iot_runreqs.json"]
+
+    def setUp(self):
+        super().setUp()
+        self.runreq = RunRequest.objects.get(auto_generated_id=self.RUNREQ_RAWHIDE)
+        self.devices = [
+            self.get_device(mac)
+            for mac in (
+                self.DEVICE_1,
+                self.DEVICE_2,
+                self.DEVICE_3,
+                self.REMOTE_DEVICE_1,
+            )
+        ]
+
+    def rollout(self, **kwargs):
+        kwargs.setdefault("advance_percent", 50)
+        rollout = Rollout(run_request=self.runreq, **kwargs)
+        rollout.full_clean()
+        rollout.save()
+        rollout.plan(self.devices)
+        return rollout
+
+    def assigned(self):
+        return sorted(
+            Device.objects.filter(run_request=self.runreq).values_list(
+                "mac_address", flat=True
+            )
+        )
+
+    def postboot(self, mac):
+        resp = self.client.get("/netboot/postboot/%s" % mac)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_validation(self):
+        for kwargs in (
+            {},
+            {"wave_size": 1, "wave_percent": 10},
+            {"wave_size": 0},
+            {"wave_percent": 101},
+            {"wave_size": 1, "advance_percent": 101},
+        ):
+            with self.assertRaises(ValidationError, msg=kwargs):
+                Rollout(run_request=self.runreq, **kwargs).full_clean()
+
+    def test_waves(self):
+        rollout = self.rollout(wave_size=2)
+        self.assertEqual(rollout.wave_count, 2)
+        self.assertEqual(self.assigned(), [])
+
+        self.assertTrue(rollout.advance())
+        self.assertEqual(self.assigned(), [self.DEVICE_1, self.DEVICE_2])
+        # Nothing reached postboot yet
+        self.assertFalse(rollout.advance())
+        self.assertEqual(rollout.current_wave, 1)
+
+        self.postboot(self.DEVICE_1)
+        rollout.refresh_from_db()
+        self.assertEqual(rollout.current_wave, 2)
+        self.assertEqual(
+            self.assigned(), [self.DEVICE_2, self.DEVICE_3, self.REMOTE_DEVICE_1]
+        )
+        self.assertEqual(
+            Device.objects.by_mac(self.DEVICE_1).get().run_request.auto_generated_id,
+            self.RUNREQ_INSTALLED,
+        )
+
+        self.postboot(self.DEVICE_2)
+        self.postboot(self.DEVICE_3)
+        rollout.refresh_from_db()
+        self.assertTrue(rollout.is_finished)
+        self.assertFalse(rollout.advance())
+
+    def test_percentage(self):
+        rollout = self.rollout(wave_percent=25, advance_percent=100)
+        self.assertEqual(rollout.wave_count, 4)
+        rollout.advance()
+        self.assertEqual(self.assigned(), [self.DEVICE_1])
+
+    def test_postboot_outside_rollout(self):
+        rollout = self.rollout(wave_size=2)
+        rollout.advance()
+        dev = self.get_device(self.DEVICE_3)
+        dev.run_request = self.runreq
+        dev.save()
+        self.assertEqual(Rollout.record_postboot(dev, self.runreq), [])
+        self.postboot(self.DEVICE_3)
+        rollout.refresh_from_db()
+        self.assertEqual(rollout.current_wave, 1)
+
+    def test_concurrent_advance(self):
+        rollout = self.rollout(wave_size=1, advance_percent=0)
+        stale = Rollout.objects.get(pk=rollout.pk)
+        self.assertTrue(rollout.advance())
+        self.assertFalse(stale.advance())
+        self.assertEqual(stale.current_wave, 1)
+        self.assertEqual(self.assigned(), [self.DEVICE_1])
+
+    def test_admin_advance(self):
+        rollout = self.rollout(wave_size=2)
+        finished = self.rollout(wave_size=4, advance_percent=100)
+        finished.advance()
+        self.assertEqual(len(self.assigned()), 4)
+        Device.objects.update(run_request=None)
+
+        with self.loggedin_as(self.ADMIN_1):
+            resp = self.client.post(
+                "/admin/zezere/rollout/",
+                {
+                    "action": "advance",
+                    "_selected_action": [rollout.pk, finished.pk],
+                    "index": 0,
+                },
+                follow=True,
+            )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [str(message) for message in resp.context["messages"]],
+            ["Advanced 1 rollouts"],
+        )
+        self.assertEqual(self.assigned(), [self.DEVICE_1, self.DEVICE_2])
+
+    def test_command(self):
+        self.claim_device(self.DEVICE_1, self.USER_1)
+        self.claim_device(self.DEVICE_2, self.USER_1)
+        stdout = StringIO()
+        call_command(
+            "start_rollout",
+            self.RUNREQ_RAWHIDE,
+            oui=["00:00:00", "11:11:11"],
+            mac=[self.DEVICE_3],
+            owner=self.USER_1,
+            wave_size=1,
+            stdout=stdout,
+        )
+        self.assertIn("2 devices in 2 waves", stdout.getvalue())
+        self.assertEqual(self.assigned(), [self.DEVICE_1])
+
+        call_command(
+            "start_rollout",
+            str(self.runreq.pk),
+            mac=[self.DEVICE_3],
+            wave_percent=50,
+            stdout=stdout,
+        )
+        self.assertEqual(self.assigned(), [self.DEVICE_1, self.DEVICE_3])
+
+    def test_command_errors(self):
+        for args, kwargs in (
+            (["nothing"], {"mac": [self.DEVICE_1], "wave_size": 1}),
+            ([self.RUNREQ_RAWHIDE], {"mac": [self.DEVICE_1]}),
+            ([self.RUNREQ_RAWHIDE], {"wave_size": 1}),
+            ([self.RUNREQ_RAWHIDE], {"mac": [self.DEVICE_1], "owner": "nobody"}),
+        ):
+            with self.assertRaises(CommandError, msg=args):
+                call_command("start_rollout", *args, **kwargs)
@@ -0,0 +1,111 @@
+from django.contrib.auth.models import AnonymousUser
+
+import rules
+
+from . import TestCase
+
+from zezere import models
+
+
+class RulesQuerySetsTest(TestCase):
+    fixtures = ["fedora_installed.json", "fedora_iot_runreqs.json"]
+
+    def setUp(self):
+        super().setUp()
+        self.user1 = self.get_user(self.USER_1)
+        self.user2 = self.get_user(self.USER_2)
+        self.users = [
+            AnonymousUser(),
+            self.user1,
+            self.user2,
+            self.get_user(self.ADMIN_1),
+        ]
+
+        self.claim_device(self.DEVICE_1, self.USER_1)
+        self.claim_device(self.DEVICE_2, self.USER_2)
+
+        public = models.RunRequest.objects.get(auto_generated_id=self.RUNREQ_INSTALLED)
+        for user in (self.user1, self.user2):
+            models.RunRequest.objects.create(type="ok", owner=user)
+            models.SSHKey.objects.create(owner=user, key="ssh-ed25519 %s" % user)
+            models.Rollout.objects.create(
+                owner=user, run_request=public, wave_percent=50
+            )
+        models.Rollout.objects.create(run_request=public, wave_size=1)
+
+    def allows(self, user, perm, obj, has_perm):
+        if has_perm:
+            return user.has_perm(perm, obj)
+        return rules.has_perm(perm, user, obj)
+
+    def assertAgrees(self, model, perm, filtered, has_perm=False):
+        """Checks that the queryset filter gives the same answers as the rule.
+
+        The rules are tested directly, unless has_perm is set: User.has_perm
+        allows superusers anything.
+        """
+        for user in self.users:
+            with self.subTest(model=model.__name__, perm=perm, user=user):
+                allowed = {
+                    obj.pk
+                    for obj in model.objects.all()
+                    if self.allows(user, model.get_perm(perm), obj, has_perm)
+                }
+                self.assertEqual(
+                    set(filtered(user).values_list("pk", flat=True)), allowed
+                )
+
+    def test_devices(self):
+        self.assertAgrees(
+            models.Device, "view", lambda user: models.Device.objects.visible_to(user)
+        )
+        self.assertAgrees(
+            models.Device,
+            "claim",
+            lambda user: models.Device.objects.claimable_by(user),
+        )
+        for perm in ("provision", "change", "delete"):
+            self.assertAgrees(
+                models.Device,
+                perm,
+                lambda user: models.Device.objects.provisionable_by(user),
+            )
+
+    def test_runreqs(self):
+        for perm in ("view", "use"):
+            self.assertAgrees(
+                models.RunRequest,
+                perm,
+                lambda user: models.RunRequest.objects.usable_by(user),
+                has_perm=True,
+            )
+        self.assertAgrees(
+            models.RunRequest,
+            "change",
+            lambda user: models.RunRequest.objects.owned_by(user),
+        )
+
+    def test_sshkeys_and_rollouts(self):
+        for model in (models.SSHKey, models.Rollout):
+            for perm in ("view", "change", "delete"):
+                self.assertAgrees(
+                    model, perm, lambda user: model.objects.owned_by(user)
+                )
+                self.assertAgrees(
+                    model,
+                    perm,
+                    lambda user: model.objects.manageable_by(user),
+                    has_perm=True,
+                )
+
+    def test_chained(self):
+        devices = models.Device.objects.by_mac(self.DEVICE_1)
+        self.assertEqual(devices.visible_to(self.user1).count(), 1)
+        self.assertEqual(devices.visible_to(self.user2).count(), 0)
+        self.assertEqual(devices.claimable_by(self.user2).count(), 0)
+
+    def test_rules_do_not_load_owner(self):
+        device = models.Device.objects.by_mac(self.DEVICE_1).get()
+        with self.assertNumQueries(0):
+            self.assertTrue(self.user1.has_perm("zezere.provision_device", device))
+            self.assertFalse(self.user2.has_perm("zezere.view_device", device))
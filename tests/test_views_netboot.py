@@ -1,8 +1,17 @@
+from tempfile import TemporaryDirectory
 from unittest.mock import patch
 
+import base64
+import hashlib
+import json
+import os
+
+from django.http import FileResponse
+from django.test import override_settings
+
 from . import TestCase
 
-from zezere import models
+from zezere import checkin, ignconfig, models, views_netboot
 
 
 class NetbootTest(TestCase):
@@ -35,6 +44,32 @@ class NetbootTest(TestCase):
         self.assertContains(resp, 'configfile "')
         self.assertContains(resp, "set debug=all")
 
+    def test_static_grub_cfg_unknown_flags(self):
+        resp = self.client.get("/netboot/noboot+debug/x86_64/grub.cfg")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            resp["ETag"], self.client.get("/netboot/debug/x86_64/grub.cfg")["ETag"]
+        )
+
+    def test_static_grub_cfg_conditional(self):
+        resp = self.client.get("/netboot/x86_64/grub.cfg")
+        self.assertIn("max-age", resp["Cache-Control"])
+        etag = resp["ETag"]
+        self.assertNotEqual(
+            etag, self.client.get("/netboot/debug/x86_64/grub.cfg")["ETag"]
+        )
+
+        resp = self.client.get("/netboot/x86_64/grub.cfg", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp["ETag"], etag)
+        self.assertEqual(resp.content, b"")
+
+        resp = self.client.get(
+            "/netboot/debug/x86_64/grub.cfg", HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertContains(resp, "set debug=all")
+
     def test_dynamic_grub_cfg_ok(self):
         with self.loggedin_as():
             with self.claimed_device(self.DEVICE_1) as dev:
@@ -91,6 +126,7 @@ class NetbootTest(TestCase):
                         resp = self.client.get(devurl)
                         self.assertTemplateUsed(resp, "netboot/grubcfg")
                         self.assertIsNotNone(resp.context["device"])
+                    checkin.buffer.flush()
                     dev.refresh_from_db()
                     self.assertEqual(dev.last_ip_address, "127.0.0.2")
 
@@ -100,8 +136,11 @@ class NetbootTest(TestCase):
                     ):
                         devurl = "/netboot/x86_64/grubcfg/%s" % self.DEVICE_1
                         resp = self.client.get(devurl)
-                        self.assertTemplateUsed(resp, "netboot/grubcfg")
-                        self.assertIsNotNone(resp.context["device"])
+                        # The IP address is not part of the config, so this is
+                        #  served from the render cache
+                        self.assertTemplateNotUsed(resp, "netboot/grubcfg")
+                        self.assertEqual(resp.status_code, 200)
+                    checkin.buffer.flush()
                     dev.refresh_from_db()
                     self.assertEqual(dev.last_ip_address, "127.0.0.3")
 
@@ -152,6 +191,16 @@ class NetbootTest(TestCase):
         self.assertTemplateUsed(resp, "netboot/grubcfg")
         self.assertIsNotNone(resp.context["device"])
 
+    def test_dynamic_grub_cfg_mac_forms(self):
+        resp = self.client.get("/netboot/x86_64/grubcfg/ff-ee-dd-cc-bb-aa")
+        self.assertTemplateUsed(resp, "netboot/grubcfg")
+        self.assertEqual(resp.context["device"].mac_address, "FF:EE:DD:CC:BB:AA")
+
+        # The same device, served from the cache
+        resp = self.client.get("/netboot/x86_64/grubcfg/FFEEDDCCBBAA")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(models.Device.objects.with_oui("FF:EE:DD").count(), 1)
+
     def test_dynamic_grub_cfg_new_device_blacklisted_mac(self):
         devurl = "/netboot/x86_64/grubcfg/52:54:00:12:34:56"
         resp = self.client.get(devurl)
@@ -166,6 +215,67 @@ class NetbootTest(TestCase):
         self.assertTemplateUsed(resp, "netboot/grubcfg_fallback")
         mock_error.assert_called_once()
 
+    def test_dynamic_grub_cfg_cached(self):
+        devurl = "/netboot/x86_64/grubcfg/%s" % self.DEVICE_1
+        resp = self.client.get(devurl)
+        self.assertTemplateUsed(resp, "netboot/grubcfg")
+
+        with self.assertNumQueries(1):
+            cached = self.client.get(devurl)
+        self.assertTemplateNotUsed(cached, "netboot/grubcfg")
+        self.assertEqual(cached.status_code, 200)
+        self.assertEqual(cached.content, resp.content)
+
+        # Different flags are cached separately
+        resp = self.client.get("/netboot/debug/x86_64/grubcfg/%s" % self.DEVICE_1)
+        self.assertTemplateUsed(resp, "netboot/grubcfg")
+        self.assertContains(resp, "set debug=all")
+
+    def test_dynamic_grub_cfg_cache_invalidation_device(self):
+        devurl = "/netboot/x86_64/grubcfg/%s" % self.DEVICE_1
+        resp = self.client.get(devurl)
+        self.assertContains(resp, "claim this device")
+
+        self.claim_device(self.DEVICE_1, self.USER_1)
+        resp = self.client.get(devurl)
+        self.assertTemplateUsed(resp, "netboot/grubcfg")
+        self.assertContains(resp, "The device is owned by %s" % self.USER_1)
+
+    def test_dynamic_grub_cfg_cache_invalidation_user(self):
+        self.claim_device(self.DEVICE_1, self.USER_1)
+        devurl = "/netboot/x86_64/grubcfg/%s" % self.DEVICE_1
+        resp = self.client.get(devurl)
+        self.assertContains(resp, "The device is owned by %s" % self.USER_1)
+
+        user = self.get_user(self.USER_1)
+        user.username = "renameduser"
+        user.save()
+        resp = self.client.get(devurl)
+        self.assertTemplateUsed(resp, "netboot/grubcfg")
+        self.assertContains(resp, "The device is owned by renameduser")
+
+    def test_dynamic_grub_cfg_cache_invalidation_runreq(self):
+        rreq = models.RunRequest(
+            owner=self.get_user(self.USER_1),
+            type=models.RunRequest.TYPE_EFI,
+            efi_application="/first.efi",
+            raw_settings='{"efi_path": "/first.efi"}',
+        )
+        rreq.save()
+        dev = self.claim_device(self.DEVICE_1, self.USER_1)
+        dev.run_request = rreq
+        dev.save()
+
+        devurl = "/netboot/x86_64/grubcfg/%s" % self.DEVICE_1
+        resp = self.client.get(devurl)
+        self.assertContains(resp, "chainloader /first.efi")
+
+        rreq.raw_settings = '{"efi_path": "/second.efi"}'
+        rreq.save()
+        resp = self.client.get(devurl)
+        self.assertTemplateUsed(resp, "netboot/grubcfg")
+        self.assertContains(resp, "chainloader /second.efi")
+
     def test_kickstart(self):
         ksurl = "/netboot/kickstart/%s" % self.DEVICE_1
         with self.loggedin_as():
@@ -222,6 +332,13 @@ class NetbootTest(TestCase):
 
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp["Content-Type"], "application/efi")
+        # Streamed from the file, so that sendfile can be used
+        self.assertIsInstance(resp, FileResponse)
+        path = os.path.join(
+            os.path.dirname(views_netboot.__file__), "efi_binaries/x86_64/shimx64.efi"
+        )
+        with open(path, "rb") as f:
+            self.assertEqual(b"".join(resp.streaming_content), f.read())
 
     def test_arch_file_head(self, *mocks):
         resp = self.client.head("/netboot/x86_64/initial")
@@ -235,6 +352,53 @@ class NetbootTest(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp["Content-Type"], "application/efi")
 
+    def test_arch_file_conditional(self):
+        resp = self.client.get("/netboot/x86_64/initial")
+        etag = resp["ETag"]
+        self.assertEqual(resp["Accept-Ranges"], "bytes")
+        self.assertEqual(int(resp["Content-Length"]), len(resp.getvalue()))
+
+        resp = self.client.get("/netboot/x86_64/initial", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.getvalue(), b"")
+
+        resp = self.client.get("/netboot/aarch64/initial", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_arch_file_range(self):
+        full = self.client.get("/netboot/x86_64/initial").getvalue()
+
+        resp = self.client.get("/netboot/x86_64/initial", HTTP_RANGE="bytes=10-19")
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.getvalue(), full[10:20])
+        self.assertEqual(resp["Content-Range"], "bytes 10-19/%d" % len(full))
+        self.assertEqual(resp["Content-Length"], "10")
+
+        resp = self.client.get("/netboot/x86_64/initial", HTTP_RANGE="bytes=-5")
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.getvalue(), full[-5:])
+
+        resp = self.client.get(
+            "/netboot/x86_64/initial", HTTP_RANGE="bytes=%d-" % len(full)
+        )
+        self.assertEqual(resp.status_code, 416)
+        self.assertEqual(resp["Content-Range"], "bytes */%d" % len(full))
+
+    def test_arch_file_if_range(self):
+        resp = self.client.get("/netboot/x86_64/initial")
+        etag = resp["ETag"]
+
+        resp = self.client.get(
+            "/netboot/x86_64/initial", HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=etag
+        )
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(len(resp.getvalue()), 10)
+
+        resp = self.client.get(
+            "/netboot/x86_64/initial", HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"old"'
+        )
+        self.assertEqual(resp.status_code, 200)
+
     def test_arch_file_invalid_arch(self):
         resp = self.client.get("/netboot/myarch/initial")
         self.assertEqual(resp.status_code, 404)
@@ -289,3 +453,210 @@ class NetbootTest(TestCase):
                         resp["passwd"]["users"][0]["sshAuthorizedKeys"],
                         ["mykeycontents"],
                     )
+
+    def assertHostname(self, value, hostname):
+        (hostfile,) = value["storage"]["files"]
+        self.assertEqual(hostfile["path"], "/etc/hostname")
+        self.assertEqual(hostfile["mode"], 0o644)
+        self.assertTrue(hostfile["overwrite"])
+        _, _, data = hostfile["contents"]["source"].partition(";base64,")
+        self.assertEqual(base64.b64decode(data), hostname)
+
+    def test_ignition_cfg_hostname(self):
+        ignurl = "/netboot/x86_64/ignition/%s" % self.DEVICE_1
+        with self.loggedin_as():
+            with self.claimed_device(self.DEVICE_1) as dev:
+                with self.device_with_runreq(dev, self.RUNREQ_INSTALLED):
+                    # Without a hostname, the file is left alone
+                    self.assertNotIn("storage", self.client.get(ignurl).json())
+
+                    dev.hostname = "board1"
+                    dev.save()
+                    self.assertHostname(self.client.get(ignurl).json(), b"board1\n")
+
+    def test_ignition_cfg_cached(self):
+        ignurl = "/netboot/x86_64/ignition/%s" % self.DEVICE_1
+        with self.loggedin_as():
+            with self.claimed_device(self.DEVICE_1) as dev:
+                with self.device_with_runreq(dev, self.RUNREQ_INSTALLED):
+                    resp = self.client.get(ignurl)
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertEqual(resp["Content-Type"], "application/json")
+                    etag = resp["ETag"]
+
+                    # Only the device is looked up
+                    with self.assertNumQueries(1):
+                        cached = self.client.get(ignurl)
+                    self.assertEqual(cached.content, resp.content)
+                    self.assertEqual(cached["ETag"], etag)
+
+                    with self.assertNumQueries(1):
+                        resp = self.client.get(ignurl, HTTP_IF_NONE_MATCH=etag)
+                    self.assertEqual(resp.status_code, 304)
+                    self.assertEqual(resp.content, b"")
+
+    def test_ignition_cfg_cache_invalidation_sshkey(self):
+        ignurl = "/netboot/x86_64/ignition/%s" % self.DEVICE_1
+        with self.loggedin_as() as user:
+            with self.claimed_device(self.DEVICE_1) as dev:
+                with self.device_with_runreq(dev, self.RUNREQ_INSTALLED):
+                    resp = self.client.get(ignurl)
+                    etag = resp["ETag"]
+                    self.assertEqual(
+                        resp.json()["passwd"]["users"][0]["sshAuthorizedKeys"], []
+                    )
+
+                    key = models.SSHKey(owner=user, key="mykeycontents")
+                    key.save()
+                    resp = self.client.get(ignurl, HTTP_IF_NONE_MATCH=etag)
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertNotEqual(resp["ETag"], etag)
+                    self.assertEqual(
+                        resp.json()["passwd"]["users"][0]["sshAuthorizedKeys"],
+                        ["mykeycontents"],
+                    )
+
+                    key.delete()
+                    resp = self.client.get(ignurl)
+                    self.assertEqual(resp["ETag"], etag)
+
+    def test_ignition_cfg_cache_invalidation_runreq(self):
+        ignurl = "/netboot/x86_64/ignition/%s" % self.DEVICE_1
+        with self.loggedin_as():
+            with self.claimed_device(self.DEVICE_1) as dev:
+                with self.device_with_runreq(dev, self.RUNREQ_INSTALLED):
+                    self.assertEqual(self.client.get(ignurl).status_code, 200)
+                self.assertEqual(self.client.get(ignurl).status_code, 404)
+
+    def test_ignition_cfg_runreq_base(self):
+        rreq = models.RunRequest(
+            owner=self.get_user(self.USER_1),
+            type=models.RunRequest.TYPE_EFI,
+            efi_application="/test.efi",
+            raw_settings=json.dumps(
+                {
+                    "efi_path": "/test.efi",
+                    "ignition": {
+                        "units": [{"name": "first.service", "enabled": True}],
+                        "users": [
+                            {
+                                "name": "root",
+                                "passwordHash": "hash",
+                                "groups": ["wheel"],
+                            }
+                        ],
+                        "groups": [{"name": "operators"}],
+                        "files": [{"path": "/etc/hostname", "mode": 384}],
+                    },
+                }
+            ),
+        )
+        rreq.save()
+        ignurl = "/netboot/x86_64/ignition/%s" % self.DEVICE_1
+        with self.loggedin_as() as user:
+            models.SSHKey(owner=user, key="mykeycontents").save()
+            with self.claimed_device(self.DEVICE_1) as dev:
+                dev.run_request = rreq
+                dev.save()
+                resp = self.client.get(ignurl).json()
+                self.ign_cfg_sanity_check(resp)
+                self.assertEqual(
+                    resp["systemd"]["units"],
+                    [{"name": "first.service", "enabled": True}],
+                )
+                # The device overlay is merged into the root user of the base
+                self.assertEqual(
+                    resp["passwd"]["users"],
+                    [
+                        {
+                            "name": "root",
+                            "passwordHash": "hash",
+                            "groups": ["wheel"],
+                            "sshAuthorizedKeys": ["mykeycontents"],
+                        }
+                    ],
+                )
+                self.assertEqual(resp["passwd"]["groups"], [{"name": "operators"}])
+                self.assertEqual(
+                    resp["storage"]["files"], [{"path": "/etc/hostname", "mode": 384}]
+                )
+
+                # The device hostname overrides the fields set by both
+                dev.hostname = "board1"
+                dev.save()
+                self.assertHostname(self.client.get(ignurl).json(), b"board1\n")
+
+                rreq.raw_settings = json.dumps(
+                    {
+                        "efi_path": "/test.efi",
+                        "ignition": {"units": [{"name": "second.service"}]},
+                    }
+                )
+                rreq.save()
+                resp = self.client.get(ignurl).json()
+                self.assertEqual(resp["systemd"]["units"], [{"name": "second.service"}])
+                dev.run_request = None
+                dev.save()
+
+
+class IgnitionBlobTest(TestCase):
+    fixtures = ["fedora_installed.json", "fedora_iot_runreqs.json"]
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        settings_override = override_settings(
+            IGNITION_BLOB_DIR=tmpdir.name, IGNITION_BLOB_THRESHOLD=1000
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def get_ignition_config(self, contents):
+        orig_get_ignition_config = models.Device.get_ignition_config
+
+        def get_ignition_config(device, request):
+            cfgobj = orig_get_ignition_config(device, request)
+            cfgobj.add_config_merge(ignconfig.FileContents(contents=contents))
+            return cfgobj
+
+        ignurl = "/netboot/x86_64/ignition/%s" % self.DEVICE_1
+        with patch.object(models.Device, "get_ignition_config", get_ignition_config):
+            with self.loggedin_as():
+                with self.claimed_device(self.DEVICE_1) as dev:
+                    with self.device_with_runreq(dev, self.RUNREQ_INSTALLED):
+                        resp = self.client.get(ignurl)
+        self.assertEqual(resp.status_code, 200)
+        return resp.json()["ignition"]["config"]["merges"][0]
+
+    def test_small_contents_inlined(self):
+        merge = self.get_ignition_config(b"small")
+        self.assertTrue(merge["source"].startswith("data:"))
+
+    def test_blob(self):
+        contents = b"x" * 5000
+        digest = hashlib.sha512(contents).hexdigest()
+        merge = self.get_ignition_config(contents)
+        self.assertEqual(
+            merge,
+            {
+                "source": "http://testserver/netboot/blobs/sha512/%s" % digest,
+                "verification": {"hash": "sha512-%s" % digest},
+            },
+        )
+
+        bloburl = "/netboot/blobs/sha512/%s" % digest
+        resp = self.client.get(bloburl)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b"".join(resp.streaming_content), contents)
+        self.assertEqual(resp["ETag"], '"%s"' % digest)
+        self.assertIn("immutable", resp["Cache-Control"])
+
+        resp = self.client.get(bloburl, HTTP_IF_NONE_MATCH='"%s"' % digest)
+        self.assertEqual(resp.status_code, 304)
+        self.assertIn("immutable", resp["Cache-Control"])
+
+    def test_blob_not_found(self):
+        for digest in ("0" * 128, "../../etc/passwd", "abc"):
+            resp = self.client.get("/netboot/blobs/sha512/%s" % digest)
+            self.assertEqual(resp.status_code, 404, digest)
@@ -3,6 +3,7 @@ from unittest.mock import patch
 from . import TestCase
 
 from zezere import models
+from zezere.macaddr import int_to_mac
 
 
 class PortalDevicesTest(TestCase):
@@ -14,6 +15,73 @@ class PortalDevicesTest(TestCase):
             self.assertTemplateUsed(resp, "portal/devices.html")
             self.assertEqual(len(resp.context["devices"]), 0)
 
+    def test_list_devices_paginated(self):
+        user = self.get_user(self.USER_1)
+        runreq = models.RunRequest.objects.get(auto_generated_id=self.RUNREQ_INSTALLED)
+        first = 0x020000000000
+        models.Device.objects.bulk_create(
+            models.Device(
+                mac_address=int_to_mac(first + i),
+                mac_int=first + i,
+                architecture="x86_64",
+                owner=user,
+                run_request=runreq if i % 2 else None,
+            )
+            for i in range(10000)
+        )
+        # Someone else's device sorts before the owned ones
+        self.claim_device(self.DEVICE_1, self.USER_2)
+
+        with self.loggedin_as():
+            # Session, user, device page, runreq list
+            with self.assertNumQueries(4):
+                resp = self.client.get("/portal/devices/")
+            devices = resp.context["devices"]
+            self.assertEqual(len(devices), 100)
+            self.assertEqual(devices[0].mac_address, int_to_mac(first))
+            self.assertIsNone(resp.context["previous_before"])
+            self.assertEqual(resp.context["next_after"], int_to_mac(first + 99))
+            self.assertContains(resp, "?after=%s" % int_to_mac(first + 99))
+            self.assertContains(resp, str(runreq))
+
+            with self.assertNumQueries(4):
+                resp = self.client.get(
+                    "/portal/devices/", {"after": int_to_mac(first + 9949)}
+                )
+            devices = resp.context["devices"]
+            self.assertEqual(
+                [device.mac_int for device in devices],
+                list(range(first + 9950, first + 10000)),
+            )
+            self.assertEqual(resp.context["previous_before"], int_to_mac(first + 9950))
+            self.assertIsNone(resp.context["next_after"])
+
+            with self.assertNumQueries(4):
+                resp = self.client.get(
+                    "/portal/devices/", {"before": int_to_mac(first + 150)}
+                )
+            devices = resp.context["devices"]
+            self.assertEqual(
+                [device.mac_int for device in devices],
+                list(range(first + 50, first + 150)),
+            )
+            self.assertEqual(resp.context["previous_before"], int_to_mac(first + 50))
+            self.assertEqual(resp.context["next_after"], int_to_mac(first + 149))
+
+            resp = self.client.get("/portal/devices/", {"after": "invalid"})
+            self.assertEqual(resp.status_code, 404)
+
+    def test_list_devices_hides_others(self):
+        self.claim_device(self.DEVICE_1, self.USER_1)
+        self.claim_device(self.DEVICE_2, self.USER_2)
+        with self.loggedin_as():
+            resp = self.client.get("/portal/devices/")
+            self.assertEqual(
+                [device.mac_address for device in resp.context["devices"]],
+                [self.DEVICE_1],
+            )
+            self.assertNotContains(resp, self.DEVICE_2)
+
     def test_list_claimable_devices(self):
         with self.loggedin_as():
             resp = self.client.get("/portal/claim/")
@@ -100,6 +168,22 @@ class PortalDevicesTest(TestCase):
                 resp = self.client.post(dev1url, {"runrequest": rreq.id}, follow=True)
                 self.assertEqual(resp.status_code, 404)
 
+    def test_superuser_apply_nonowned_runreq(self):
+        rreq = models.RunRequest(
+            owner=self.get_user(self.USER_2),
+            type=models.RunRequest.TYPE_EFI,
+            efi_application="/nowhere.efi",
+        )
+        rreq.full_clean()
+        rreq.save()
+
+        self.claim_device(self.DEVICE_1, self.USER_1)
+        dev1url = "/portal/devices/runreq/%s/" % self.DEVICE_1
+        with self.loggedin_as(self.ADMIN_1):
+            resp = self.client.post(dev1url, {"runrequest": rreq.id})
+            self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.get_device(self.DEVICE_1).run_request, rreq)
+
     def test_apply_nonexisting_runreq(self):
         dev1url = "/portal/devices/runreq/%s/" % self.DEVICE_1
         with self.loggedin_as():
@@ -122,3 +206,135 @@ class PortalDevicesTest(TestCase):
             with self.claimed_device(self.DEVICE_1):
                 resp = self.client.post(dev1url, follow=True)
                 self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_claim(self):
+        macs = [self.DEVICE_1, self.DEVICE_2.replace(":", "-")]
+        with self.loggedin_as():
+            # Session, user, savepoint, permission SELECT, UPDATE, release
+            with self.assertNumQueries(6):
+                resp = self.client.post("/portal/claim/", {"mac_address": macs})
+            self.assertEqual(resp.status_code, 302)
+        user = self.get_user(self.USER_1)
+        self.assertEqual(self.get_device(self.DEVICE_1).owner, user)
+        self.assertEqual(self.get_device(self.DEVICE_2).owner, user)
+        self.assertIsNone(self.get_device(self.DEVICE_3).owner)
+
+    @patch("zezere.views_portal.BULK_BATCH_SIZE", 1)
+    def test_bulk_claim_batches(self):
+        macs = [self.DEVICE_1, self.DEVICE_2, self.DEVICE_3]
+        with self.loggedin_as():
+            resp = self.client.post("/portal/claim/", {"mac_address": macs})
+            self.assertEqual(resp.status_code, 302)
+        self.assertEqual(
+            models.Device.objects.filter(owner__username=self.USER_1).count(), 3
+        )
+
+    def test_bulk_claim_partly_claimed(self):
+        self.claim_device(self.DEVICE_2, self.USER_2)
+        macs = [self.DEVICE_1, self.DEVICE_2]
+        with self.loggedin_as(self.USER_1):
+            resp = self.client.post("/portal/claim/", {"mac_address": macs})
+            self.assertEqual(resp.status_code, 403)
+        # Nothing was claimed
+        self.assertIsNone(self.get_device(self.DEVICE_1).owner)
+
+    def test_bulk_claim_concurrently_claimed(self):
+        # Another request claims a device between the permission check and
+        #  the UPDATE, so fewer rows are updated than were selected
+        with patch("django.db.models.query.QuerySet.update", return_value=1):
+            with self.loggedin_as():
+                resp = self.client.post(
+                    "/portal/claim/", {"mac_address": [self.DEVICE_1, self.DEVICE_2]}
+                )
+                self.assertEqual(resp.status_code, 403)
+
+    def test_bulk_claim_unknown_device(self):
+        with self.loggedin_as():
+            for mac in ("AA:AA:AA:AA:AA:AA", "invalid"):
+                resp = self.client.post(
+                    "/portal/claim/", {"mac_address": [self.DEVICE_1, mac]}
+                )
+                self.assertEqual(resp.status_code, 404)
+        self.assertIsNone(self.get_device(self.DEVICE_1).owner)
+
+    def test_bulk_runreq(self):
+        self.claim_device(self.DEVICE_1, self.USER_1)
+        self.claim_device(self.DEVICE_2, self.USER_1)
+        rreq = models.RunRequest.objects.get(auto_generated_id=self.RUNREQ_RAWHIDE)
+        macs = [self.DEVICE_1, self.DEVICE_2]
+        with self.loggedin_as():
+            resp = self.client.get("/portal/devices/")
+            self.assertContains(resp, self.RUNREQ_RAWHIDE)
+
+            resp = self.client.post(
+                "/portal/devices/runreq/",
+                {"mac_address": macs, "runrequest": rreq.id, "action": "assign"},
+            )
+            self.assertEqual(resp.status_code, 302)
+            for mac in macs:
+                self.assertEqual(self.get_device(mac).run_request, rreq)
+
+            resp = self.client.post(
+                "/portal/devices/runreq/",
+                {"mac_address": macs, "runrequest": rreq.id, "action": "clear"},
+            )
+            self.assertEqual(resp.status_code, 302)
+            for mac in macs:
+                self.assertIsNone(self.get_device(mac).run_request)
+
+    def test_bulk_runreq_not_owned(self):
+        self.claim_device(self.DEVICE_1, self.USER_1)
+        self.claim_device(self.DEVICE_2, self.USER_2)
+        rreq = models.RunRequest.objects.get(auto_generated_id=self.RUNREQ_RAWHIDE)
+        with self.loggedin_as():
+            resp = self.client.post(
+                "/portal/devices/runreq/",
+                {"mac_address": [self.DEVICE_1, self.DEVICE_2], "runrequest": rreq.id},
+            )
+            self.assertEqual(resp.status_code, 403)
+        self.assertIsNone(self.get_device(self.DEVICE_1).run_request)
+
+    def test_bulk_runreq_nonowned_runreq(self):
+        self.claim_device(self.DEVICE_1, self.USER_1)
+        rreq = models.RunRequest(
+            owner=self.get_user(self.USER_2),
+            type=models.RunRequest.TYPE_EFI,
+            efi_application="/nowhere.efi",
+        )
+        rreq.full_clean()
+        rreq.save()
+        with self.loggedin_as():
+            resp = self.client.post(
+                "/portal/devices/runreq/",
+                {"mac_address": [self.DEVICE_1], "runrequest": rreq.id},
+            )
+            self.assertEqual(resp.status_code, 404)
+
+    def test_superuser_bulk_runreq_nonowned_runreq(self):
+        self.claim_device(self.DEVICE_1, self.ADMIN_1)
+        rreq = models.RunRequest(
+            owner=self.get_user(self.USER_2),
+            type=models.RunRequest.TYPE_EFI,
+            efi_application="/nowhere.efi",
+        )
+        rreq.full_clean()
+        rreq.save()
+        with self.loggedin_as(self.ADMIN_1):
+            resp = self.client.post(
+                "/portal/devices/runreq/",
+                {"mac_address": [self.DEVICE_1], "runrequest": rreq.id},
+            )
+            self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.get_device(self.DEVICE_1).run_request, rreq)
+
+    def test_bulk_runreq_invalidates_cache(self):
+        dev = self.claim_device(self.DEVICE_1, self.USER_1)
+        rreq = models.RunRequest.objects.get(auto_generated_id=self.RUNREQ_INSTALLED)
+        devurl = "/netboot/x86_64/grubcfg/%s" % self.DEVICE_1
+        before = self.client.get(devurl).content
+        with self.loggedin_as():
+            self.client.post(
+                "/portal/devices/runreq/",
+                {"mac_address": [dev.mac_address], "runrequest": rreq.id},
+            )
+        self.assertNotEqual(self.client.get(devurl).content, before)
@@ -70,3 +70,24 @@ class PortalSSHKeyTest(TestCase):
             resp = self.client.get("/portal/sshkeys/", follow=True)
             self.assertEqual(len(resp.context["sshkeys"]), 1)
             self.assertEqual(resp.context["sshkeys"][0], user1key)
+
+    def test_superuser_removes_other_key(self):
+        with self.loggedin_as(self.USER_1):
+            resp = self.client.post(
+                "/portal/sshkeys/add/", {"sshkey": "somekeyvalue"}, follow=True
+            )
+            user1key = resp.context["sshkeys"][0]
+
+        with self.loggedin_as(self.ADMIN_1):
+            # Only their own keys are listed
+            resp = self.client.get("/portal/sshkeys/")
+            self.assertEqual(len(resp.context["sshkeys"]), 0)
+
+            resp = self.client.post(
+                "/portal/sshkeys/delete/", {"sshkey_id": user1key.id}
+            )
+            self.assertEqual(resp.status_code, 302)
+
+        with self.loggedin_as(self.USER_1):
+            resp = self.client.get("/portal/sshkeys/")
+            self.assertEqual(len(resp.context["sshkeys"]), 0)
@@ -1,8 +1,11 @@
+from tempfile import TemporaryDirectory
 from unittest import TestCase
-from unittest.mock import patch, mock_open, call
+from unittest.mock import MagicMock, patch, mock_open, call
 
-import zezere_ignition
+import os
+import urllib.error
 
+import zezere_ignition
 
 CMDLINE_NO_URL = (
     "BOOT_IMAGE=(hd0,gpt2)/vmlinuz-5.6.0-0.rc3.git0.1.fc32.x86_64 "
@@ -113,9 +116,16 @@ virbr0	007AA8C0	00000000	0001	0	0	0	00FFFFF0
     def test_run_ignition_stage(self):
         with patch("zezere_ignition.print") as pp:
             with patch("zezere_ignition.sp_run") as spp:
-                zezere_ignition.run_ignition_stage("/some/config", "fetch")
+                spp.return_value.returncode = 0
+                self.assertTrue(
+                    zezere_ignition.run_ignition_stage("/some/config", "fetch")
+                )
+                spp.return_value.returncode = 1
+                self.assertFalse(
+                    zezere_ignition.run_ignition_stage("/some/config", "fetch")
+                )
 
-        pp.assert_called_once()
+        self.assertEqual(pp.call_count, 2)
         self.assertListEqual(
             spp.call_args[0][0],
             [
@@ -128,23 +138,122 @@ virbr0	007AA8C0	00000000	0001	0	0	0	00FFFFF0
             ],
         )
 
+    def run_ignition(self, config, etag='"etag1"', failed_stage=None, **kwargs):
+        with patch("zezere_ignition.fetch_config", return_value=config) as fcp:
+            if config is not None:
+                fcp.return_value = (config, etag)
+            with patch(
+                "zezere_ignition.run_ignition_stage",
+                side_effect=lambda config_file, stage: stage != failed_stage,
+            ) as risp:
+                with patch("zezere_ignition.print"):
+                    zezere_ignition.run_ignition(
+                        "http://someurl", self.tmpdir.name, **kwargs
+                    )
+        return fcp, risp
+
     def test_run_ignition(self):
-        with patch("zezere_ignition.NamedTemporaryFile", mock_open()) as ntfp:
-            ntfp.return_value.name = "/some/file"
-            with patch("zezere_ignition.run_ignition_stage") as risp:
-                zezere_ignition.run_ignition("http://someurl")
+        self.tmpdir = TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        configpath = os.path.join(self.tmpdir.name, "config.ign")
 
-        ntfp.assert_called_once()
+        fcp, risp = self.run_ignition(b'{"ignition": {}}')
+        fcp.assert_called_once_with("http://someurl", None)
         risp.assert_has_calls(
             [
-                call("/some/file", "disks"),
-                call("/some/file", "fetch"),
-                call("/some/file", "files"),
-                call("/some/file", "mount"),
-                call("/some/file", "umount"),
-            ],
-            any_order=True,
+                call(configpath + ".new", "fetch"),
+                call(configpath + ".new", "disks"),
+                call(configpath + ".new", "mount"),
+                call(configpath + ".new", "files"),
+                call(configpath + ".new", "umount"),
+            ]
+        )
+        with open(configpath, "rb") as f:
+            self.assertEqual(f.read(), b'{"ignition": {}}')
+        self.assertFalse(os.path.exists(configpath + ".new"))
+
+        # Not modified
+        fcp, risp = self.run_ignition(None)
+        fcp.assert_called_once_with("http://someurl", b'"etag1"')
+        risp.assert_not_called()
+
+        # Same contents under a new ETag
+        fcp, risp = self.run_ignition(b'{"ignition": {}}', '"etag2"')
+        risp.assert_not_called()
+        fcp, risp = self.run_ignition(None)
+        fcp.assert_called_once_with("http://someurl", b'"etag2"')
+
+        # Changed
+        fcp, risp = self.run_ignition(b'{"ignition": {"x": 1}}', '"etag3"')
+        self.assertEqual(risp.call_count, 5)
+
+        # Forced
+        fcp, risp = self.run_ignition(b'{"ignition": {"x": 1}}', force=True)
+        fcp.assert_called_once_with("http://someurl", None)
+        self.assertEqual(risp.call_count, 5)
+
+    def test_run_ignition_failed_stage(self):
+        self.tmpdir = TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        configpath = os.path.join(self.tmpdir.name, "config.ign")
+
+        fcp, risp = self.run_ignition(b'{"ignition": {}}', failed_stage="files")
+        self.assertEqual(risp.call_count, 5)
+        self.assertFalse(os.path.exists(configpath))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir.name, "config.etag")))
+
+        # The config is fetched and applied again on the next run
+        fcp, risp = self.run_ignition(b'{"ignition": {}}')
+        fcp.assert_called_once_with("http://someurl", None)
+        self.assertEqual(risp.call_count, 5)
+        with open(configpath, "rb") as f:
+            self.assertEqual(f.read(), b'{"ignition": {}}')
+
+        # A failure when applying a changed config keeps the old one
+        fcp, risp = self.run_ignition(
+            b'{"ignition": {"x": 1}}', '"etag2"', failed_stage="fetch"
         )
+        with open(configpath, "rb") as f:
+            self.assertEqual(f.read(), b'{"ignition": {}}')
+        fcp, risp = self.run_ignition(None)
+        fcp.assert_called_once_with("http://someurl", b'"etag1"')
+
+    def test_run_ignition_fetch_error(self):
+        self.tmpdir = TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        with patch(
+            "zezere_ignition.fetch_config",
+            side_effect=urllib.error.HTTPError("http://someurl", 404, "", {}, None),
+        ):
+            with patch("zezere_ignition.run_ignition_stage") as risp:
+                with patch("zezere_ignition.print"):
+                    zezere_ignition.run_ignition("http://someurl", self.tmpdir.name)
+        risp.assert_not_called()
+
+    def test_fetch_config(self):
+        resp = MagicMock()
+        resp.__enter__.return_value.read.return_value = b"{}"
+        resp.__enter__.return_value.headers = {"ETag": '"etag1"'}
+        with patch("zezere_ignition.urllib.request.urlopen", return_value=resp) as up:
+            self.assertEqual(
+                zezere_ignition.fetch_config("http://someurl", b'"etag0"'),
+                (b"{}", '"etag1"'),
+            )
+        self.assertEqual(up.call_args[0][0].get_header("If-none-match"), '"etag0"')
+
+        with patch(
+            "zezere_ignition.urllib.request.urlopen",
+            side_effect=urllib.error.HTTPError("http://someurl", 304, "", {}, None),
+        ):
+            self.assertIsNone(
+                zezere_ignition.fetch_config("http://someurl", b'"etag0"')
+            )
+
+    def test_fetch_config_scheme(self):
+        with patch("zezere_ignition.urllib.request.urlopen") as up:
+            with self.assertRaises(urllib.error.URLError):
+                zezere_ignition.fetch_config("file:///etc/shadow", None)
+        up.assert_not_called()
 
     def test_update_banner_no_devid(self):
         with patch("zezere_ignition.open", mock_open()) as bp:
@@ -170,6 +279,8 @@ virbr0	007AA8C0	00000000	0001	0	0	0	00FFFFF0
         args = zezere_ignition.get_args([])
         self.assertEqual(args.update_banner, True)
         self.assertEqual(args.only_update_banner, False)
+        self.assertEqual(args.state_dir, zezere_ignition.STATE_DIR)
+        self.assertEqual(args.force, False)
 
     def test_get_args(self):
         args = zezere_ignition.get_args(["--no-update-banner"])
@@ -231,4 +342,8 @@ virbr0	007AA8C0	00000000	0001	0	0	0	00FFFFF0
         zezere_ignition.main(zezere_ignition.get_args([]))
 
         ubp.assert_called_once_with("http://someserver", "defmac")
-        rip.assert_called_once_with("http://someserver/netboot/x86_64/ignition/defmac")
+        rip.assert_called_once_with(
+            "http://someserver/netboot/x86_64/ignition/defmac",
+            zezere_ignition.STATE_DIR,
+            False,
+        )
@@ -1,7 +1,5 @@
 from django.contrib.staticfiles.finders import BaseFinder
-import requests
 
-from pathlib import Path
 import os
 import os.path
 import sys
@@ -39,30 +37,35 @@ EFI_FILES = [
 ]
 
 
-def download_netboot_files(destroot=None):  # pragma: no cover
+def download_netboot_files(
+    destroot=None, concurrency=4, full_verify=False, stdout=None
+):
+    from .netboot_sync import STATUS_FAILED, NetbootFileSync, SyncError
+
     if not destroot:
         destroot = os.getcwd()
 
-    for file in EFI_FILES:
-        dir, destfile = os.path.split(file["destination"])
-        destdir = os.path.join("zezere/static/", dir)
-        url = file["url"]
-
-        destfile = os.path.join(destdir, destfile)
-
-        destfile = os.path.join(destroot, destfile)
-
-        print("Downloading %s to %s" % (url, destfile))
-
-        if not os.path.exists(destfile):
-            Path(destdir).mkdir(parents=True, exist_ok=True)
-
-            with requests.get(url, stream=True) as dlf:
-                dlf.raise_for_status()
-                with open(destfile, "wb") as f:
-                    for chunk in dlf.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
+    sync = NetbootFileSync(
+        os.path.join(destroot, "zezere/static/"),
+        concurrency=concurrency,
+        full_verify=full_verify,
+    )
+    results = sync.sync(EFI_FILES)
+    for result in results:
+        message = "%s: %s" % (result.destination, result.status)
+        if stdout is None:
+            print(message)
+        else:
+            stdout.write(message)
+    failed = [result for result in results if result.status == STATUS_FAILED]
+    if failed:
+        raise SyncError(
+            "Failed to sync: %s"
+            % ", ".join(
+                "%s (%s)" % (result.destination, result.error) for result in failed
+            )
+        )
+    return results
 
 
 class django_staticfiles_netboot_finder(BaseFinder):  # pragma: no cover
@@ -2,7 +2,7 @@ from django.contrib import admin
 
 from rules.contrib.admin import ObjectPermissionsModelAdmin
 
-from zezere.models import Device, RunRequest
+from zezere.models import Device, Rollout, RolloutDevice, RunRequest
 
 
 class RunRequestAdmin(ObjectPermissionsModelAdmin):
@@ -13,5 +13,29 @@ class DeviceAdmin(ObjectPermissionsModelAdmin):
     pass
 
 
+class RolloutDeviceInline(admin.TabularInline):
+    model = RolloutDevice
+    fields = ["device", "wave", "assigned", "completed"]
+    readonly_fields = ["device", "wave", "assigned", "completed"]
+    extra = 0
+    can_delete = False
+
+
+class RolloutAdmin(ObjectPermissionsModelAdmin):
+    list_display = ["__str__", "current_wave", "wave_count", "created"]
+    readonly_fields = ["current_wave"]
+    inlines = [RolloutDeviceInline]
+    actions = ["advance"]
+
+    def advance(self, request, queryset):
+        advanced = [rollout for rollout in queryset if rollout.advance()]
+        self.message_user(request, "Advanced %d rollouts" % len(advanced))
+
+    advance.short_description = (  # type: ignore
+        "Assign the next wave of the selected rollouts"
+    )
+
+
 admin.site.register(RunRequest, RunRequestAdmin)
 admin.site.register(Device, DeviceAdmin)
+admin.site.register(Rollout, RolloutAdmin)
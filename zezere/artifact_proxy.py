@@ -0,0 +1,274 @@
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
+
+import hashlib
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+
+from django.conf import settings
+import requests
+
+from .contentstore import ContentStore
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+
+
+class ArtifactUnavailable(Exception):
+    pass
+
+
+class _Fetch(object):
+    """A download of an upstream artifact into the content store.
+
+    The download runs in a background thread. Any number of readers can stream
+    the artifact while it is being downloaded: they read from the partial file
+    and wait for more data to arrive until the download is complete.
+    """
+
+    def __init__(self, proxy: "ArtifactProxy", url: str, previous: Optional[dict]):
+        self.proxy = proxy
+        self.url = url
+        self.previous = previous
+        self.cond = threading.Condition()
+        self.started = False
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.size: Optional[int] = None
+        self.written = 0
+        self.tmppath: Optional[str] = None
+        self.digest: Optional[str] = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        try:
+            self._download()
+        except Exception as ex:
+            logger.error("Error fetching artifact %s", self.url, exc_info=True)
+            with self.cond:
+                self.error = ex
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+            self.proxy._fetch_done(self)
+
+    def _download(self):
+        headers = {}
+        if self.previous is not None:
+            if self.previous.get("etag"):
+                headers["If-None-Match"] = self.previous["etag"]
+            if self.previous.get("last_modified"):
+                headers["If-Modified-Since"] = self.previous["last_modified"]
+
+        with requests.get(
+            self.url, headers=headers, stream=True, timeout=self.proxy.timeout
+        ) as resp:
+            if resp.status_code == 304 and self.previous is not None:
+                self.proxy._store_index(self.url, self.previous)
+                with self.cond:
+                    self.digest = self.previous["digest"]
+                    self.size = self.proxy.store.size(self.digest)
+                    self.started = True
+                return
+            resp.raise_for_status()
+
+            with self.proxy.store.writer() as writer:
+                with self.cond:
+                    if "Content-Length" in resp.headers:
+                        self.size = int(resp.headers["Content-Length"])
+                    self.tmppath = writer.tmppath
+                    self.started = True
+                    self.cond.notify_all()
+
+                for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                    writer.write(chunk)
+                    writer.flush()
+                    with self.cond:
+                        self.written = writer.size
+                        self.cond.notify_all()
+
+                if self.size is not None and writer.size != self.size:
+                    raise ArtifactUnavailable("Upstream download was truncated")
+
+                # Readers open either the temporary or the final path, commit
+                #  under the lock so they never see neither.
+                with self.cond:
+                    self.digest = writer.commit()
+                    self.size = writer.size
+
+            self.proxy._store_index(
+                self.url,
+                {
+                    "digest": self.digest,
+                    "etag": resp.headers.get("ETag"),
+                    "last_modified": resp.headers.get("Last-Modified"),
+                },
+            )
+
+    def open(self) -> Tuple[Optional[int], Iterator[bytes]]:
+        with self.cond:
+            while not self.started and not self.done:
+                self.cond.wait()
+            if self.error is not None:
+                raise ArtifactUnavailable(str(self.error))
+            if self.digest is not None:
+                return self.size, _read_file(self.proxy.store, self.digest)
+            assert self.tmppath is not None
+            return self.size, self._follow(open(self.tmppath, "rb"))
+
+    def _follow(self, f: BinaryIO) -> Iterator[bytes]:
+        with f:
+            pos = 0
+            while True:
+                with self.cond:
+                    while self.written <= pos and not self.done:
+                        self.cond.wait()
+                    available = self.written
+                    if self.error is not None:
+                        raise ArtifactUnavailable(str(self.error))
+                while pos < available:
+                    chunk = f.read(min(CHUNK_SIZE, available - pos))
+                    pos += len(chunk)
+                    yield chunk
+                if self.done and pos >= self.written:
+                    return
+
+
+def _read_file(store: ContentStore, digest: str) -> Iterator[bytes]:
+    # Only opened once the response is sent, so unsent responses leak nothing
+    with store.open(digest) as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            yield chunk
+
+
+class ArtifactProxy(object):
+    """Caching proxy for the kernels and initrds of RunRequests.
+
+    Every upstream URL is downloaded once into a content-addressed store, and
+    revalidated with a conditional request once its entry is older than ttl
+    seconds. Concurrent requests for an artifact that is still being
+    downloaded share the single upstream download. When a new version of an
+    artifact is stored, the previous one is deleted unless another URL still
+    references it.
+    """
+
+    def __init__(self, root: str, ttl: int, timeout: int = 60):
+        self.store = ContentStore(root)
+        self.indexdir = os.path.join(root, "index")
+        self.ttl = ttl
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._index: Dict[str, dict] = {}
+        self._fetches: Dict[str, _Fetch] = {}
+
+    def _index_path(self, url: str) -> str:
+        return os.path.join(
+            self.indexdir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json"
+        )
+
+    def _read_index(self, path: str) -> Optional[dict]:
+        try:
+            with open(path, "r") as f:
+                entry: dict = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return entry
+
+    def _load_index(self, url: str) -> Optional[dict]:
+        entry = self._index.get(url)
+        if entry is None:
+            entry = self._read_index(self._index_path(url))
+            if entry is None:
+                return None
+            self._index[url] = entry
+        if not self.store.has(entry["digest"]):
+            return None
+        return entry
+
+    def _store_index(self, url: str, entry: dict):
+        entry = dict(entry, url=url, fetched=time.time())
+        os.makedirs(self.indexdir, exist_ok=True)
+        path = self._index_path(url)
+        with self._lock:
+            previous = self._read_index(path)
+            with open(path + ".tmp", "w") as f:
+                json.dump(entry, f)
+            os.replace(path + ".tmp", path)
+            self._index[url] = entry
+            if previous is not None and previous.get("digest") != entry["digest"]:
+                self._prune(previous["digest"])
+
+    def _prune(self, digest: str):
+        """Deletes the object with digest unless an index entry references it."""
+        for name in os.listdir(self.indexdir):
+            if not name.endswith(".json"):
+                continue
+            entry = self._read_index(os.path.join(self.indexdir, name))
+            if entry is not None and entry.get("digest") == digest:
+                return
+        self.store.delete(digest)
+
+    def _fetch_done(self, fetch: _Fetch):
+        with self._lock:
+            del self._fetches[fetch.url]
+
+    def open(self, url: str) -> Tuple[Optional[int], Iterator[bytes]]:
+        """Returns the size (if known) and contents of the artifact at url."""
+        with self._lock:
+            fetch = self._fetches.get(url)
+            if fetch is None:
+                entry = self._load_index(url)
+                if entry is not None and time.time() - entry["fetched"] < self.ttl:
+                    digest = entry["digest"]
+                    return self.store.size(digest), _read_file(self.store, digest)
+                fetch = _Fetch(self, url, entry)
+                self._fetches[url] = fetch
+                fetch.start()
+        return fetch.open()
+
+    def size(self, url: str) -> Optional[int]:
+        """Returns the size of the artifact at url, if known, without fetching it.
+
+        Cached artifacts are not revalidated, and for others only the headers
+        are requested upstream.
+        """
+        with self._lock:
+            fetch = self._fetches.get(url)
+            if fetch is not None and fetch.size is not None:
+                return fetch.size
+            entry = self._load_index(url)
+            if entry is not None:
+                return self.store.size(entry["digest"])
+        try:
+            resp = requests.head(url, allow_redirects=True, timeout=self.timeout)
+            resp.raise_for_status()
+        except requests.RequestException as ex:
+            raise ArtifactUnavailable(str(ex))
+        if "Content-Length" not in resp.headers:
+            return None
+        return int(resp.headers["Content-Length"])
+
+    def wait(self):
+        """Waits for all downloads in progress to finish."""
+        with self._lock:
+            fetches = list(self._fetches.values())
+        for fetch in fetches:
+            fetch.thread.join()
+
+
+_proxies: Dict[str, ArtifactProxy] = {}
+
+
+def get_proxy() -> ArtifactProxy:
+    root = settings.ARTIFACT_CACHE_DIR
+    if root not in _proxies:
+        _proxies[root] = ArtifactProxy(root, settings.ARTIFACT_CACHE_TTL)
+    return _proxies[root]
@@ -0,0 +1,123 @@
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional, Tuple
+
+import hashlib
+import os
+import os.path
+import threading
+import time
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Artifact(object):
+    """The metadata and ETag of a file that is served.
+
+    The contents are read from the file for every response, so that the server
+    can use sendfile for them, and so that changes to the file while it is
+    being served at most cut a response short.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        digest = hashlib.sha256()
+        with self.open() as f:
+            stat = os.fstat(f.fileno())
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.stat_key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        self.etag = '"%s"' % digest.hexdigest()
+        self.checked = time.monotonic()
+
+    def open(self) -> BinaryIO:
+        return open(self.path, "rb")
+
+    def iter_range(self, start: int, end: int) -> Iterator[bytes]:
+        """Yields bytes start up to and including end, in chunks."""
+        with self.open() as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+class ArtifactTable(object):
+    """Table of the files served from a directory.
+
+    Files are hashed when they are first requested (or by preload),
+    and are reloaded when their stat information changes. To keep the per
+    request overhead low, files are stat'ed at most once per recheck_interval.
+    """
+
+    def __init__(self, root: str, recheck_interval: float = 1.0):
+        self.root = root
+        self.recheck_interval = recheck_interval
+        self._artifacts: Dict[str, Artifact] = {}
+        self._lock = threading.Lock()
+
+    def preload(self, names: Iterable[str]):
+        for name in names:
+            self.get(name)
+
+    def get(self, name: str) -> Artifact:
+        artifact = self._artifacts.get(name)
+        if artifact is not None:
+            if time.monotonic() - artifact.checked < self.recheck_interval:
+                return artifact
+            if self._is_current(artifact):
+                artifact.checked = time.monotonic()
+                return artifact
+
+        with self._lock:
+            current = self._artifacts.get(name)
+            if current is None or current is artifact:
+                current = Artifact(os.path.join(self.root, name))
+                self._artifacts[name] = current
+            return current
+
+    def _is_current(self, artifact: Artifact) -> bool:
+        try:
+            stat = os.stat(artifact.path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns) == artifact.stat_key
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parses a Range header into an inclusive (start, end) tuple.
+
+    Returns None if the whole file should be served, which is the case for
+    missing, malformed and multi-range headers.
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+    spec = header[len("bytes=") :].strip()
+    if "," in spec or "-" not in spec:
+        return None
+    first, last = (part.strip() for part in spec.split("-", 1))
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0 or size == 0:
+                raise RangeNotSatisfiable()
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    if start < 0 or end < start:
+        return None
+    return start, min(end, size - 1)
@@ -0,0 +1,103 @@
+from typing import Any, Iterable, List, Optional, Tuple
+
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Version stamps are random tokens rather than counters, so an evicted stamp
+#  can never come back with a value that old cache entries were stored under.
+def _version_key(kind: str, pk: Any) -> str:
+    return f"zezere:version:{kind}:{pk}"
+
+
+def bump_version(kind: str, pk: Any):
+    cache.set(_version_key(kind, pk), uuid.uuid4().hex, None)
+
+
+def bump_versions(kind: str, pks: Iterable[Any]):
+    """Bumps the versions of many objects, for changes that send no signals."""
+    cache.set_many(
+        {_version_key(kind, pk): uuid.uuid4().hex for pk in pks if pk is not None},
+        None,
+    )
+
+
+def version_bumper(kind: str, field: str = "pk"):
+    """Returns a signal receiver bumping the version of the sent instance.
+
+    If field is given, the version of the object referenced by that field of
+    the instance is bumped instead.
+    """
+
+    def receiver(sender, instance, **kwargs):
+        pk = getattr(instance, field)
+        if pk is not None:
+            bump_version(kind, pk)
+
+    return receiver
+
+
+Dependencies = Iterable[Tuple[str, Any]]
+Token = Tuple[str, Tuple[Optional[str], ...]]
+
+
+class VersionedCache(object):
+    """Cache for rendered objects, invalidated through version stamps.
+
+    Every entry is stored along with the version stamps of the objects
+    ("device", "runrequest", "user", ...) it was generated from. A lookup
+    fetches the entry and the current stamps in a single cache round trip, and
+    only returns the entry if none of the stamps changed since it was stored.
+    """
+
+    def __init__(self, name: str, timeout: Optional[int] = None):
+        self.name = name
+        self.timeout = timeout
+
+    def _key(self, parts: Iterable[Any]) -> str:
+        digest = hashlib.sha256(
+            "\0".join(str(part) for part in parts).encode("utf-8")
+        ).hexdigest()
+        return f"zezere:{self.name}:{digest}"
+
+    def lookup(self, parts: Iterable[Any], deps: Dependencies) -> Tuple[Any, Token]:
+        key = self._key(parts)
+        version_keys = [_version_key(kind, pk) for kind, pk in deps if pk is not None]
+        found = cache.get_many([key] + version_keys)
+
+        missing = [vkey for vkey in version_keys if vkey not in found]
+        if missing:
+            # Initialize, unless someone else just did, and reread
+            for vkey in missing:
+                cache.add(vkey, uuid.uuid4().hex, None)
+            found.update(cache.get_many(missing))
+
+        versions = tuple(found.get(vkey) for vkey in version_keys)
+        token = (key, versions)
+
+        entry = found.get(key)
+        if missing or entry is None:
+            return None, token
+        stored_versions, value = entry
+        if stored_versions != versions:
+            return None, token
+        return value, token
+
+    def store(self, token: Token, value: Any, timeout: Optional[int] = None):
+        key, versions = token
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            timeout = settings.RENDER_CACHE_TIMEOUT
+        cache.set(key, (versions, value), timeout)
+
+
+def device_dependencies(device) -> List[Tuple[str, Any]]:
+    return [
+        ("device", device.pk),
+        ("user", device.owner_id),
+        ("runrequest", device.run_request_id),
+    ]
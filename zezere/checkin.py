@@ -0,0 +1,127 @@
+from typing import Dict, NamedTuple, Optional
+
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from .models import Device
+
+
+logger = logging.getLogger(__name__)
+
+
+class CheckIn(NamedTuple):
+    device_id: int
+    mac_address: str
+    ip_address: str
+    timestamp: float
+
+
+class CheckInBuffer(object):
+    """Per-process write-behind buffer for device check-ins.
+
+    Netboot requests record the IP address a device was last seen at here
+    instead of saving the Device on the request path. Pending check-ins are
+    written with batched UPDATEs once CHECKIN_BUFFER_SIZE devices are pending,
+    or by a timer CHECKIN_FLUSH_INTERVAL seconds after the first pending
+    check-in, so the last check-ins of a quiet fleet are written too. Only the
+    latest check-in per device is kept.
+
+    Every process has its own buffer, so with multiple processes a check-in
+    can take up to CHECKIN_FLUSH_INTERVAL seconds to be visible to the others.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[int, CheckIn] = {}
+        self._oldest: Optional[float] = None
+        self._timer: Optional[threading.Timer] = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def record(self, device: Device, ip_address: str):
+        # Make sure the rest of this request sees the current address
+        stored_ip = device.last_ip_address
+        device.last_ip_address = ip_address
+
+        if settings.CHECKIN_BUFFER_SIZE <= 0:
+            if stored_ip != ip_address:
+                Device.objects.filter(pk=device.pk).update(last_ip_address=ip_address)
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            pending = self._pending.get(device.pk)
+            if pending is None and stored_ip == ip_address:
+                return
+            if pending is not None and pending.ip_address == ip_address:
+                return
+
+            self._pending[device.pk] = CheckIn(
+                device.pk, device.mac_address, ip_address, now
+            )
+            if self._oldest is None:
+                self._oldest = now
+                self._start_timer()
+
+            should_flush = (
+                len(self._pending) >= settings.CHECKIN_BUFFER_SIZE
+                or now - self._oldest >= settings.CHECKIN_FLUSH_INTERVAL
+            )
+
+        if should_flush:
+            self.flush()
+
+    def _start_timer(self):
+        if settings.CHECKIN_FLUSH_INTERVAL <= 0:
+            return
+        self._timer = threading.Timer(
+            settings.CHECKIN_FLUSH_INTERVAL, self._timed_flush
+        )
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        finally:
+            # The timer thread has its own database connection
+            connection.close()
+
+    def _take(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._oldest = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        return pending
+
+    def clear(self):
+        self._take()
+
+    def flush(self):
+        pending = self._take()
+        if not pending:
+            return
+
+        devices = [
+            Device(pk=checkin.device_id, last_ip_address=checkin.ip_address)
+            for checkin in pending.values()
+        ]
+        try:
+            Device.objects.bulk_update(devices, ["last_ip_address"])
+        except Exception:
+            logger.error(
+                "Error flushing %d device check-ins", len(devices), exc_info=True
+            )
+
+
+buffer = CheckInBuffer()
+atexit.register(buffer.flush)
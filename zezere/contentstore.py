@@ -0,0 +1,100 @@
+from typing import BinaryIO, Iterable, Optional
+
+import hashlib
+import os
+import os.path
+import re
+import tempfile
+
+
+class ContentWriter(object):
+    """Writes a new object into a ContentStore.
+
+    Data is written to a temporary file and hashed while it is written. On
+    commit the file is moved into place under its digest.
+    """
+
+    def __init__(self, store: "ContentStore"):
+        self.store = store
+        os.makedirs(store.tmpdir, exist_ok=True)
+        fd, self.tmppath = tempfile.mkstemp(dir=store.tmpdir)
+        self.file = os.fdopen(fd, "wb")
+        self.hash = hashlib.new(store.algorithm)
+        self.size = 0
+        self.digest: Optional[str] = None
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+
+    def flush(self):
+        self.file.flush()
+
+    def commit(self) -> str:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        digest = self.hash.hexdigest()
+        path = self.store.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.tmppath, path)
+        self.digest = digest
+        return digest
+
+    def abort(self):
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.tmppath):
+            os.unlink(self.tmppath)
+
+    def __enter__(self) -> "ContentWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.digest is None:
+            self.abort()
+
+
+class ContentStore(object):
+    """A directory of immutable objects, addressed by the hash of their contents."""
+
+    def __init__(self, root: str, algorithm: str = "sha256"):
+        self.root = root
+        self.algorithm = algorithm
+        self.tmpdir = os.path.join(root, "tmp")
+        self._digest_re = re.compile(
+            "^[0-9a-f]{%d}$" % (hashlib.new(algorithm).digest_size * 2)
+        )
+
+    def is_valid_digest(self, digest: str) -> bool:
+        return self._digest_re.match(digest) is not None
+
+    def path(self, digest: str) -> str:
+        if not self.is_valid_digest(digest):
+            raise ValueError("Invalid %s digest" % self.algorithm)
+        return os.path.join(self.root, self.algorithm, digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def open(self, digest: str) -> BinaryIO:
+        return open(self.path(digest), "rb")
+
+    def size(self, digest: str) -> int:
+        return os.path.getsize(self.path(digest))
+
+    def delete(self, digest: str):
+        try:
+            os.unlink(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+    def writer(self) -> ContentWriter:
+        return ContentWriter(self)
+
+    def put(self, chunks: Iterable[bytes]) -> str:
+        with self.writer() as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+            return writer.commit()
@@ -0,0 +1,235 @@
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import csv
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+
+from . import caching
+from .macaddr import int_to_mac, mac_to_int
+from .models import Device
+from .views_netboot import ARCHES
+
+
+BATCH_SIZE = 500
+
+FORMAT_CSV = "csv"
+FORMAT_NDJSON = "ndjson"
+FORMATS = (FORMAT_CSV, FORMAT_NDJSON)
+
+# Manifest columns, by the names they can appear as
+COLUMNS = {
+    "mac_address": "mac_address",
+    "mac": "mac_address",
+    "architecture": "architecture",
+    "arch": "architecture",
+    "hostname": "hostname",
+    "owner": "owner",
+}
+
+# Imported devices have not checked in yet
+VALIDATION_EXCLUDE = ["last_ip_address", "owner"]
+
+
+class RowError(NamedTuple):
+    line: int
+    mac_address: Optional[str]
+    messages: List[str]
+
+
+class ImportResult(NamedTuple):
+    rows: int
+    created: int
+    errors: List[RowError]
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        if not self.seconds:
+            return 0.0
+        return self.rows / self.seconds
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "rows": self.rows,
+            "created": self.created,
+            "seconds": round(self.seconds, 3),
+            "rows_per_second": round(self.rows_per_second, 1),
+            "errors": [error._asdict() for error in self.errors],
+        }
+
+
+ManifestRow = Tuple[int, Dict[str, Any]]
+
+
+def guess_format(filename: str) -> str:
+    if filename.endswith(".csv"):
+        return FORMAT_CSV
+    return FORMAT_NDJSON
+
+
+def parse_manifest(lines: Iterable[str], fmt: str) -> Iterator[ManifestRow]:
+    """Yields the line number and values of every row of a manifest.
+
+    CSV manifests start with a header row. Rows that can not be parsed are
+    yielded with only an "error" value.
+    """
+    if fmt == FORMAT_CSV:
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, _columns(row)
+    elif fmt == FORMAT_NDJSON:
+        for lineno, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as ex:
+                yield lineno, {"error": "Invalid JSON: %s" % ex}
+                continue
+            if not isinstance(row, dict):
+                yield lineno, {"error": "Rows must be objects"}
+                continue
+            yield lineno, _columns(row)
+    else:
+        raise ValueError("Unknown manifest format %s" % fmt)
+
+
+def _columns(row: Dict[str, Any]) -> Dict[str, Any]:
+    values = {}
+    for key, value in row.items():
+        column = COLUMNS.get((key or "").strip().lower())
+        if column is None:
+            continue
+        if isinstance(value, str):
+            value = value.strip()
+        values[column] = value if value != "" else None
+    return values
+
+
+class DeviceImporter(object):
+    """Pre-registers devices from manifest rows.
+
+    Every row is validated with the Device validators. Valid rows are inserted
+    with one bulk_create per batch, each batch in its own transaction.
+    """
+
+    def __init__(self, batch_size: int = BATCH_SIZE):
+        self.batch_size = batch_size
+        self._owners: Dict[str, Optional[User]] = {}
+
+    def run(self, rows: Iterable[ManifestRow]) -> ImportResult:
+        start = time.monotonic()
+        total = 0
+        created = 0
+        errors: List[RowError] = []
+        seen = set()
+        batch: List[Tuple[int, Device]] = []
+
+        for lineno, values in rows:
+            total += 1
+            try:
+                device = self._build(values)
+            except ValidationError as ex:
+                mac_address = values.get("mac_address")
+                if mac_address is not None:
+                    mac_address = str(mac_address)
+                errors.append(RowError(lineno, mac_address, ex.messages))
+                continue
+            if device.mac_int in seen:
+                errors.append(
+                    RowError(lineno, device.mac_address, ["Duplicate MAC address"])
+                )
+                continue
+            seen.add(device.mac_int)
+            batch.append((lineno, device))
+            if len(batch) >= self.batch_size:
+                created += self._insert(batch, errors)
+                batch = []
+        if batch:
+            created += self._insert(batch, errors)
+
+        errors.sort(key=lambda error: error.line)
+        return ImportResult(total, created, errors, time.monotonic() - start)
+
+    def _owner(self, username: Optional[str]) -> Optional[User]:
+        if username is None:
+            return None
+        if username not in self._owners:
+            self._owners[username] = User.objects.filter(username=username).first()
+        owner = self._owners[username]
+        if owner is None:
+            raise ValidationError("Unknown owner %s" % username)
+        return owner
+
+    def _build(self, values: Dict[str, Any]) -> Device:
+        if "error" in values:
+            raise ValidationError(values["error"])
+        # NDJSON manifests can contain any JSON value
+        invalid = [
+            column
+            for column, value in values.items()
+            if value is not None and not isinstance(value, str)
+        ]
+        if invalid:
+            raise ValidationError(
+                ["%s must be a string" % column for column in sorted(invalid)]
+            )
+        # Devices that boot with another architecture are not served
+        architecture = values.get("architecture")
+        if architecture and architecture not in ARCHES:
+            raise ValidationError("Unknown architecture %s" % architecture)
+        device = Device(
+            mac_address=values.get("mac_address") or "",
+            architecture=values.get("architecture") or "",
+            hostname=values.get("hostname"),
+            last_ip_address="",
+        )
+        device.full_clean(exclude=VALIDATION_EXCLUDE, validate_unique=False)
+        device.owner = self._owner(values.get("owner"))
+        device.mac_int = mac_to_int(device.mac_address)
+        device.mac_address = int_to_mac(device.mac_int)
+        return device
+
+    def _insert(self, batch: List[Tuple[int, Device]], errors: List[RowError]) -> int:
+        # Every conflict is a device of this batch that booted since it was
+        #  checked, which the next attempt skips.
+        for _ in range(len(batch)):
+            try:
+                return self._insert_new(batch, errors)
+            except IntegrityError:
+                pass
+        return self._insert_new(batch, errors)
+
+    def _insert_new(
+        self, batch: List[Tuple[int, Device]], errors: List[RowError]
+    ) -> int:
+        new = []
+        batch_errors = []
+        with transaction.atomic():
+            existing = set(
+                Device.objects.filter(
+                    mac_int__in=[device.mac_int for _, device in batch]
+                ).values_list("mac_int", flat=True)
+            )
+            for lineno, device in batch:
+                if device.mac_int in existing:
+                    batch_errors.append(
+                        RowError(lineno, device.mac_address, ["Device already exists"])
+                    )
+                else:
+                    new.append(device)
+            Device.objects.bulk_create(new)
+        errors.extend(batch_errors)
+        # bulk_create does not send post_save, and ids can be reused
+        caching.bump_versions("device", [device.pk for device in new])
+        return len(new)
+
+
+def import_devices(
+    lines: Iterable[str], fmt: str, batch_size: int = BATCH_SIZE
+) -> ImportResult:
+    return DeviceImporter(batch_size).run(parse_manifest(lines, fmt))
@@ -1,48 +1,299 @@
-from typing import Union, Mapping, List, Optional, Any, Dict
-
-from abc import ABC, abstractmethod
+from typing import (
+    Union,
+    Mapping,
+    List,
+    Optional,
+    Any,
+    Dict,
+    Tuple,
+    BinaryIO,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    cast,
+)
+
+from abc import ABC, ABCMeta, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
 import base64
 import hashlib
+import json
+import os
+import threading
+import zlib
 
 
 # Used for type assertions
 # https://github.com/python/typing/issues/182
 JSON = Union[str, int, float, bool, None, Mapping[str, Any], List[Any]]
 
+# File contents can be given as bytes, a path, a binary file or byte chunks
+Contents = Union[bytes, str, os.PathLike, BinaryIO, Iterable[bytes]]
+# Chunks of contents are hashed and encoded without copying them to bytes
+Buffer = Union[bytes, bytearray, memoryview]
+
 
 # Helper
 class IgnitionConfigObjectType(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def generate_config(self) -> JSON:
         pass  # pragma: no cover
 
+    def json_chunks(self) -> Iterator[bytes]:
+        """Yields the serialized JSON of the generated config."""
+        yield json.dumps(self.generate_config()).encode("utf-8")
+
     def recursive_generate_config(self, value):
         return list(map(lambda x: x.generate_config(), value))
 
 
-class AttributeIgnitionConfigObjectType(IgnitionConfigObjectType):
+class AttributeObjectMeta(ABCMeta):
+    """Compiles the annotated fields of a class into a field list.
+
+    The public fields (including inherited ones) are stored sorted in _fields,
+    and their class-level defaults are moved to _defaults so the fields can be
+    backed by __slots__.
+    """
+
+    def __new__(mcls, name, bases, namespace, **kwargs):
+        fields: Dict[str, Any] = {}
+        for base in reversed(bases):
+            fields.update(getattr(base, "_defaults", {}))
+        slots = []
+        for field in namespace.get("__annotations__", {}):
+            if field.startswith("_"):
+                continue
+            if field not in fields:
+                slots.append(field)
+            fields[field] = namespace.pop(field, fields.get(field))
+        namespace["__slots__"] = tuple(slots)
+        namespace["_fields"] = tuple(sorted(fields))
+        namespace["_defaults"] = fields
+        return super().__new__(mcls, name, bases, namespace, **kwargs)
+
+
+class AttributeIgnitionConfigObjectType(
+    IgnitionConfigObjectType, metaclass=AttributeObjectMeta
+):
+    _fields: Tuple[str, ...]
+    _defaults: Dict[str, Any]
+
+    def __new__(cls, *args, **kwargs):
+        obj = super().__new__(cls)
+        for field, default in cls._defaults.items():
+            setattr(obj, field, default)
+        return obj
+
     def generate_config(self) -> JSON:
         cfg = {}
-        for attr in dir(self):
-            if attr.startswith("_"):
-                continue
+        for attr in self._fields:
             val = getattr(self, attr)
-            if callable(val):
-                continue
             if val is None:
                 continue
             if (
                 isinstance(val, list)
-                and len(val) > 0
+                and val
                 and isinstance(val[0], IgnitionConfigObjectType)
             ):
                 val = [elem.generate_config() for elem in val]
+            elif isinstance(val, IgnitionConfigObjectType):
+                val = val.generate_config()
             cfg[attr] = val
         return cfg
 
 
+# Multiple of 3, so every chunk can be base64 encoded on its own
+CONTENTS_CHUNK_SIZE = 3 * 64 * 1024
+CONTENTS_MEMO_SIZE = 32
+DATA_URL_PREFIX = "data:text/plain;charset=utf-8;base64,"
+GZIP_LEVEL = 6
+
+
+class EncodedContents(NamedTuple):
+    # The digest is always of the uncompressed contents
+    digest: str
+    data: bytes
+    compression: Optional[str] = None
+
+    @property
+    def memo_key(self) -> Tuple[str, Optional[str]]:
+        return self.digest, self.compression
+
+
+_contents_memo: "OrderedDict[Any, EncodedContents]" = OrderedDict()
+_contents_memo_lock = threading.Lock()
+
+
+def _memo_get(key: Any) -> Optional[EncodedContents]:
+    with _contents_memo_lock:
+        encoded = _contents_memo.get(key)
+        if encoded is not None:
+            _contents_memo.move_to_end(key)
+        return encoded
+
+
+def _memo_put(keys: Iterable[Any], encoded: EncodedContents) -> EncodedContents:
+    """Memoizes encoded under keys, returns the already memoized copy if any."""
+    with _contents_memo_lock:
+        encoded = _contents_memo.get(encoded.memo_key, encoded)
+        for key in keys:
+            _contents_memo[key] = encoded
+            _contents_memo.move_to_end(key)
+        while len(_contents_memo) > CONTENTS_MEMO_SIZE:
+            _contents_memo.popitem(last=False)
+        return encoded
+
+
+def _read_chunks(fileobj: BinaryIO) -> Iterable[bytes]:
+    return iter(lambda: fileobj.read(CONTENTS_CHUNK_SIZE), b"")
+
+
+class _Base64Buffer(object):
+    def __init__(self):
+        self.data = bytearray()
+        self.carry = b""
+
+    def write(self, chunk: Buffer):
+        if self.carry:
+            chunk = self.carry + chunk
+        cut = len(chunk) - len(chunk) % 3
+        self.data += base64.b64encode(memoryview(chunk)[:cut])
+        self.carry = bytes(chunk[cut:])
+
+    def finish(self) -> bytes:
+        self.data += base64.b64encode(self.carry)
+        self.carry = b""
+        # Immutable, so it can be shared and written out as is
+        data = bytes(self.data)
+        self.data = bytearray()
+        return data
+
+
+def _encode_chunks(chunks: Iterable[Buffer], compress: bool = False) -> EncodedContents:
+    hasher = hashlib.sha512()
+    output = _Base64Buffer()
+    # wbits=31 writes a gzip header, with a zero mtime so output is reproducible
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None
+    for chunk in chunks:
+        hasher.update(chunk)
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        output.write(chunk)
+    if compressor is not None:
+        output.write(compressor.flush())
+    return EncodedContents(
+        hasher.hexdigest(), output.finish(), "gzip" if compress else None
+    )
+
+
+def _iter_contents(contents: Contents) -> Iterator[Buffer]:
+    if isinstance(contents, (bytes, bytearray, memoryview)):
+        yield contents
+    elif isinstance(contents, (str, os.PathLike)):
+        with open(contents, "rb") as fileobj:
+            yield from _read_chunks(fileobj)
+    elif hasattr(contents, "read"):
+        yield from _read_chunks(cast(BinaryIO, contents))
+    else:
+        yield from contents
+
+
+def _contents_size(contents: Contents) -> Optional[int]:
+    if isinstance(contents, (bytes, bytearray)):
+        return len(contents)
+    if isinstance(contents, memoryview):
+        return contents.nbytes
+    if isinstance(contents, (str, os.PathLike)):
+        return os.path.getsize(contents)
+    return None
+
+
+def encode_contents(contents: Contents, compress: bool = False) -> EncodedContents:
+    """Computes the SHA512 digest and base64 encoding of contents.
+
+    The contents are read and encoded in chunks, and gzip compressed before
+    encoding if compress is set. Results are memoized by digest (and by path
+    and stat information for files given by path), so identical contents share
+    a single encoded copy.
+    """
+    if isinstance(contents, (bytes, bytearray, memoryview)):
+        encoded = _encode_chunks([contents], compress)
+        return _memo_put([encoded.memo_key], encoded)
+    if isinstance(contents, (str, os.PathLike)):
+        with open(contents, "rb") as fileobj:
+            stat = os.fstat(fileobj.fileno())
+            key = (
+                os.path.realpath(contents),
+                stat.st_ino,
+                stat.st_size,
+                stat.st_mtime_ns,
+                compress,
+            )
+            memoized = _memo_get(key)
+            if memoized is not None:
+                return memoized
+            encoded = _encode_chunks(_read_chunks(fileobj), compress)
+        return _memo_put([key, encoded.memo_key], encoded)
+    encoded = _encode_chunks(_iter_contents(contents), compress)
+    return _memo_put([encoded.memo_key], encoded)
+
+
+class BlobOffload(NamedTuple):
+    # Any object with a put(chunks) method that stores the chunks and returns
+    #  their SHA512 digest, like a sha512 contentstore.ContentStore
+    store: Any
+    url_prefix: str
+    threshold: int
+
+
+class _OffloadState(threading.local):
+    # Each request is handled on a single thread
+    blob_offload: Optional[BlobOffload] = None
+
+
+_offload_state = _OffloadState()
+
+
+@contextmanager
+def offload_blobs(store: Any, url_prefix: str, threshold: int):
+    """Stores large inline contents in store instead of embedding them.
+
+    FileContents created in this context with contents larger than threshold
+    bytes (or of unknown size) put them in the store, and reference them with
+    url_prefix followed by the SHA512 digest of the stored blob.
+    """
+    previous = _offload_state.blob_offload
+    _offload_state.blob_offload = BlobOffload(store, url_prefix, threshold)
+    try:
+        yield
+    finally:
+        _offload_state.blob_offload = previous
+
+
+def _offload_contents(
+    contents: Contents, compress: bool, offload: BlobOffload
+) -> Tuple[str, str]:
+    """Stores contents as a blob, returns its URL and the contents digest."""
+    hasher = hashlib.sha512()
+
+    def chunks():
+        compressor = (
+            zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None
+        )
+        for chunk in _iter_contents(contents):
+            hasher.update(chunk)
+            yield compressor.compress(chunk) if compressor is not None else chunk
+        if compressor is not None:
+            yield compressor.flush()
+
+    blob_digest = offload.store.put(chunks())
+    return offload.url_prefix + blob_digest, hasher.hexdigest()
+
+
 class FileContents(IgnitionConfigObjectType):
-    source: str
     digest: Optional[str] = None
     compression: Optional[str] = None
 
@@ -52,11 +303,24 @@ class FileContents(IgnitionConfigObjectType):
         self,
         sourceURL: Optional[str] = None,
         digest: Optional[str] = None,
-        contents: Optional[bytes] = None,
+        contents: Optional[Contents] = None,
         compression: Optional[str] = None,
+        compress: bool = False,
     ):
+        """Creates a file source, either from a URL or inline contents.
+
+        With compress, inline contents are gzip compressed before they are
+        embedded. The digest is always of the uncompressed contents. Inside
+        offload_blobs, large contents are referenced by URL instead.
+        """
+        self._source_url = sourceURL
+        self._encoded: Optional[EncodedContents] = None
         if sourceURL is not None and contents is not None:
             raise ValueError("Instantiating with source and contents")
+        if compress and contents is None:
+            raise ValueError("Only inline contents can be compressed")
+        if compress:
+            compression = compression or "gzip"
         if sourceURL is not None:
             if sourceURL.startswith("http://") and digest is None:
                 raise ValueError("HTTP URL included without verification")
@@ -69,20 +333,50 @@ class FileContents(IgnitionConfigObjectType):
                 raise ValueError("Compression is not allowed with s3 source")
             self.compression = compression
         if contents is not None:
-            computed_digest = hashlib.sha512(contents).hexdigest()
+            offload = _offload_state.blob_offload
+            size = _contents_size(contents)
+            if offload is not None and (size is None or size > offload.threshold):
+                self._source_url, computed_digest = _offload_contents(
+                    contents, compress, offload
+                )
+            else:
+                self._encoded = encode_contents(contents, compress)
+                computed_digest = self._encoded.digest
             if digest is not None and digest != computed_digest:
                 raise ValueError("Digest does not match recomputed digest")
-            contents = base64.b64encode(contents)
-            self.source = f"data:text/plain;charset=utf-8;base64,{contents.decode()}"
             self.digest = computed_digest
         elif sourceURL is not None:
-            self.source = sourceURL
             self.digest = digest
         else:
             raise ValueError("Instantiating without source and contents")
 
+    @property
+    def source(self) -> str:
+        # Data URLs are only built when serialized, and never kept around
+        if self._encoded is not None:
+            return DATA_URL_PREFIX + self._encoded.data.decode("ascii")
+        # Either contents or a source URL is required on creation
+        assert self._source_url is not None
+        return self._source_url
+
     def generate_config(self) -> JSON:
         cfg: Dict[str, Any] = {"source": self.source}
+        cfg.update(self.generate_config_without_source())
+        return cfg
+
+    def json_chunks(self) -> Iterator[bytes]:
+        if self._encoded is None:
+            yield from super().json_chunks()
+            return
+        # Write the encoded contents as is, base64 never needs JSON escaping
+        yield b'{"source": "' + DATA_URL_PREFIX.encode("ascii")
+        yield self._encoded.data
+        # Inline contents always have a digest, so more fields follow
+        cfg = self.generate_config_without_source()
+        yield b'", ' + json.dumps(cfg)[1:].encode("utf-8")
+
+    def generate_config_without_source(self) -> Dict[str, Any]:
+        cfg: Dict[str, Any] = {}
         if self.compression is not None:
             cfg["compression"] = self.compression
         if self.digest is not None:
@@ -140,14 +434,176 @@ class SystemdUnit(AttributeIgnitionConfigObjectType):
         self.dropins.append(dropin)
 
 
+class StorageFile(AttributeIgnitionConfigObjectType):
+    path: str
+    overwrite: Optional[bool] = None
+    mode: Optional[int] = None
+    contents: Optional[FileContents] = None
+
+    def __init__(self, path: str, contents: Optional[FileContents] = None):
+        self.path = path
+        self.contents = contents
+
+
+class RawConfigObject(IgnitionConfigObjectType):
+    """A config object given as its already generated config."""
+
+    def __init__(self, config: Mapping[str, Any]):
+        self.config = config
+
+    def generate_config(self) -> JSON:
+        return self.config
+
+
+# The field identifying the entries of keyed lists, by the name of the list
+LIST_KEYS = {
+    "units": "name",
+    "dropins": "name",
+    "users": "name",
+    "groups": "name",
+    "files": "path",
+    "directories": "path",
+    "links": "path",
+    "disks": "device",
+    "filesystems": "device",
+    "raid": "name",
+}
+
+
+def merge_configs(parent: Any, child: Any, field: Optional[str] = None) -> Any:
+    """Merges child into parent following the Ignition 3 merge semantics.
+
+    Values of the child override the values of the parent. Objects are merged
+    recursively, entries of keyed lists (units, files, ...) are merged with the
+    parent entry with the same key, and other list items are appended unless
+    they are already present.
+    """
+    if isinstance(parent, dict) and isinstance(child, dict):
+        merged = dict(parent)
+        for key, value in child.items():
+            if key in merged:
+                merged[key] = merge_configs(merged[key], value, key)
+            else:
+                merged[key] = value
+        return merged
+
+    if isinstance(parent, list) and isinstance(child, list):
+        merged_list = list(parent)
+        keyfield = LIST_KEYS.get(field or "")
+        for item in child:
+            if keyfield is not None and isinstance(item, dict) and keyfield in item:
+                for i, existing in enumerate(merged_list):
+                    if (
+                        isinstance(existing, dict)
+                        and existing.get(keyfield) == item[keyfield]
+                    ):
+                        merged_list[i] = merge_configs(existing, item)
+                        break
+                else:
+                    merged_list.append(item)
+            elif item not in merged_list:
+                merged_list.append(item)
+        return merged_list
+
+    return child
+
+
+Fragment = Tuple[Optional[str], Tuple[bytes, ...]]
+
+
+class CompiledIgnitionConfig(NamedTuple):
+    """The items of an IgnitionConfig, serialized to JSON fragments.
+
+    Every fragment is stored with the key of its item (the name, or the path
+    for files), so that layered configs can merge items of earlier layers.
+    """
+
+    merges: Tuple[Fragment, ...]
+    units: Tuple[Fragment, ...]
+    users: Tuple[Fragment, ...]
+    groups: Tuple[Fragment, ...]
+    files: Tuple[Fragment, ...] = ()
+
+
+def _item_key(item: IgnitionConfigObjectType, keyfield: str) -> Optional[str]:
+    if isinstance(item, RawConfigObject):
+        return item.config.get(keyfield)
+    return getattr(item, keyfield, None)
+
+
+def _compile_items(
+    items: Iterable[IgnitionConfigObjectType], keyfield: str = "name"
+) -> Tuple[Fragment, ...]:
+    return tuple(
+        (_item_key(item, keyfield), tuple(item.json_chunks())) for item in items
+    )
+
+
+def _iter_fragments(layers: Iterable[Tuple[Fragment, ...]]) -> Iterator[bytes]:
+    fragments: Dict[Any, Tuple[bytes, ...]] = {}
+    for layer in layers:
+        for key, chunks in layer:
+            if key is None:
+                # Unkeyed items never merge with each other
+                fragments[object()] = chunks
+            elif key in fragments:
+                # Only items present in several layers are parsed again
+                merged = merge_configs(
+                    json.loads(b"".join(fragments[key])), json.loads(b"".join(chunks))
+                )
+                fragments[key] = (json.dumps(merged).encode("utf-8"),)
+            else:
+                fragments[key] = chunks
+    for i, chunks in enumerate(fragments.values()):
+        if i:
+            yield b", "
+        yield from chunks
+
+
+def iter_configs_json(layers: Iterable[CompiledIgnitionConfig]) -> Iterator[bytes]:
+    """Yields the JSON document of the layered configs in chunks.
+
+    Items of later layers are merged field by field into the items with the
+    same key of earlier layers, as Ignition merges configs. Without such items
+    the result is identical to serializing a single IgnitionConfig holding all
+    items with json.dumps.
+    """
+    layers = list(layers)
+    yield b'{"ignition": {"version": %s, "config": {"merges": [' % json.dumps(
+        IgnitionConfig.CFGVERSION
+    ).encode("utf-8")
+    yield from _iter_fragments(layer.merges for layer in layers)
+    yield b']}}, "systemd": {"units": ['
+    yield from _iter_fragments(layer.units for layer in layers)
+    yield b']}, "passwd": {"users": ['
+    yield from _iter_fragments(layer.users for layer in layers)
+    yield b'], "groups": ['
+    yield from _iter_fragments(layer.groups for layer in layers)
+    if any(layer.files for layer in layers):
+        yield b']}, "storage": {"files": ['
+        yield from _iter_fragments(layer.files for layer in layers)
+    yield b"]}}"
+
+
+def write_configs_json(layers: Iterable[CompiledIgnitionConfig], out: BinaryIO):
+    """Writes the JSON document of the layered configs to a file-like out."""
+    for chunk in iter_configs_json(layers):
+        out.write(chunk)
+
+
+def assemble_configs(layers: Iterable[CompiledIgnitionConfig]) -> bytes:
+    return b"".join(iter_configs_json(layers))
+
+
 # Top-level
 class IgnitionConfig(IgnitionConfigObjectType):
     CFGVERSION = "3.0.0"
 
-    units: List[SystemdUnit]
-    users: List[PasswdUser]
-    groups: List[PasswdGroup]
-    config_merges: List[FileContents]
+    units: List[IgnitionConfigObjectType]
+    users: List[IgnitionConfigObjectType]
+    groups: List[IgnitionConfigObjectType]
+    config_merges: List[IgnitionConfigObjectType]
+    files: List[IgnitionConfigObjectType]
 
     def __init__(self):
         super()
@@ -155,21 +611,26 @@ class IgnitionConfig(IgnitionConfigObjectType):
         self.users = []
         self.groups = []
         self.config_merges = []
+        self.files = []
 
-    def add_unit(self, unit: SystemdUnit):
+    # Items are SystemdUnit, PasswdUser, ... or the equivalent RawConfigObject
+    def add_unit(self, unit: IgnitionConfigObjectType):
         self.units.append(unit)
 
-    def add_user(self, user: PasswdUser):
+    def add_user(self, user: IgnitionConfigObjectType):
         self.users.append(user)
 
-    def add_group(self, group: PasswdGroup):
+    def add_group(self, group: IgnitionConfigObjectType):
         self.groups.append(group)
 
-    def add_config_merge(self, config: FileContents):
+    def add_config_merge(self, config: IgnitionConfigObjectType):
         self.config_merges.append(config)
 
+    def add_file(self, file: IgnitionConfigObjectType):
+        self.files.append(file)
+
     def generate_config(self) -> JSON:
-        return {
+        cfg: Dict[str, Any] = {
             "ignition": {
                 "version": IgnitionConfig.CFGVERSION,
                 "config": {
@@ -182,3 +643,19 @@ class IgnitionConfig(IgnitionConfigObjectType):
                 "groups": self.recursive_generate_config(self.groups),
             },
         }
+        # Only configs with files have a storage section
+        if self.files:
+            cfg["storage"] = {"files": self.recursive_generate_config(self.files)}
+        return cfg
+
+    def write_json(self, out: BinaryIO):
+        write_configs_json([self.compile()], out)
+
+    def compile(self) -> CompiledIgnitionConfig:
+        return CompiledIgnitionConfig(
+            merges=_compile_items(self.config_merges),
+            units=_compile_items(self.units),
+            users=_compile_items(self.users),
+            groups=_compile_items(self.groups),
+            files=_compile_items(self.files, "path"),
+        )
@@ -0,0 +1,168 @@
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional
+
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+import requests
+
+from .ignconfig import merge_configs
+
+
+logger = logging.getLogger(__name__)
+
+FETCH_TIMEOUT = 30
+MAX_DEPTH = 10
+DATA_URL_PREFIX = "data:"
+
+# Merge references in the configs generated by Zezere, and in standard configs
+MERGE_FIELDS = ("merges", "merge")
+
+
+class MergeError(Exception):
+    pass
+
+
+class _FetchedConfig(NamedTuple):
+    config: Dict[str, Any]
+    etag: Optional[str]
+    fetched: float
+
+
+class MergeFetchCache(object):
+    """Cache of the remote configs referenced by config merges.
+
+    Configs are reused for ttl seconds, after which they are revalidated with
+    a conditional request using their ETag.
+    """
+
+    def __init__(self, ttl: int, timeout: int = FETCH_TIMEOUT):
+        self.ttl = ttl
+        self.timeout = timeout
+        self._configs: Dict[str, _FetchedConfig] = {}
+        self._lock = threading.Lock()
+
+    def get(self, reference: Mapping[str, Any]) -> Dict[str, Any]:
+        source = reference["source"]
+        digest = reference.get("verification", {}).get("hash")
+        key = f"{source}\0{digest}"
+        if source.startswith(DATA_URL_PREFIX):
+            return self._parse(_decode_data_url(source), reference)
+
+        with self._lock:
+            cached = self._configs.get(key)
+        if cached is not None and time.time() - cached.fetched < self.ttl:
+            return cached.config
+
+        headers = {}
+        if cached is not None and cached.etag:
+            headers["If-None-Match"] = cached.etag
+        try:
+            resp = requests.get(source, headers=headers, timeout=self.timeout)
+        except requests.RequestException as ex:
+            raise MergeError("Error fetching %s: %s" % (source, ex))
+        if resp.status_code == 304 and cached is not None:
+            fetched = cached._replace(fetched=time.time())
+        elif resp.status_code == 200:
+            fetched = _FetchedConfig(
+                self._parse(resp.content, reference),
+                resp.headers.get("ETag"),
+                time.time(),
+            )
+        else:
+            raise MergeError("Error fetching %s: %d" % (source, resp.status_code))
+
+        with self._lock:
+            self._configs[key] = fetched
+        return fetched.config
+
+    def _parse(self, data: bytes, reference: Mapping[str, Any]) -> Dict[str, Any]:
+        if reference.get("compression") == "gzip":
+            try:
+                data = gzip.decompress(data)
+            except OSError as ex:
+                raise MergeError("Invalid gzip data: %s" % ex)
+        expected = reference.get("verification", {}).get("hash")
+        if expected is not None:
+            algorithm, _, value = expected.partition("-")
+            if algorithm != "sha512" or hashlib.sha512(data).hexdigest() != value:
+                raise MergeError("Verification of %s failed" % reference["source"])
+        try:
+            config = json.loads(data)
+        except ValueError as ex:
+            raise MergeError("Invalid config: %s" % ex)
+        if not isinstance(config, dict):
+            raise MergeError("Invalid config: not an object")
+        return config
+
+
+def _decode_data_url(url: str) -> bytes:
+    header, _, data = url.partition(",")
+    if not header.endswith(";base64"):
+        raise MergeError("Only base64 data URLs can be merged")
+    try:
+        return base64.b64decode(data, validate=True)
+    except ValueError as ex:
+        raise MergeError("Invalid data URL: %s" % ex)
+
+
+def flatten_config(
+    config: Dict[str, Any], cache: MergeFetchCache, depth: int = 0
+) -> Dict[str, Any]:
+    """Resolves the config merges of config into a single config.
+
+    As Ignition does, the referenced configs are merged in order on top of the
+    config itself, after their own merges were resolved.
+    """
+    if depth > MAX_DEPTH:
+        raise MergeError("Config merges nested too deeply")
+    cfgsection = config.get("ignition", {}).get("config", {})
+    references: List[Mapping[str, Any]] = []
+    for field in MERGE_FIELDS:
+        references.extend(cfgsection.get(field, []))
+    if cfgsection.get("replace"):
+        raise MergeError("Replaced configs can not be flattened")
+
+    flattened = dict(config)
+    flattened["ignition"] = dict(config.get("ignition", {}))
+    flattened["ignition"]["config"] = {
+        key: value for key, value in cfgsection.items() if key not in MERGE_FIELDS
+    }
+    if "merges" in cfgsection:
+        # Keep the document shape of Zezere generated configs
+        flattened["ignition"]["config"]["merges"] = []
+    for reference in references:
+        child = flatten_config(cache.get(reference), cache, depth + 1)
+        child = dict(child)
+        child["ignition"] = {
+            key: value
+            for key, value in child.get("ignition", {}).items()
+            if key not in ("version", "config")
+        }
+        flattened = merge_configs(flattened, child)
+    return flattened
+
+
+_caches: Dict[int, MergeFetchCache] = {}
+
+
+def get_fetch_cache() -> MergeFetchCache:
+    ttl = settings.IGNITION_MERGE_CACHE_TTL
+    if ttl not in _caches:
+        _caches[ttl] = MergeFetchCache(ttl)
+    return _caches[ttl]
+
+
+def flatten_document(document: bytes) -> bytes:
+    """Returns the flattened JSON document, or the original on errors."""
+    try:
+        flattened = flatten_config(json.loads(document), get_fetch_cache())
+    except MergeError:
+        logger.error("Error flattening config merges", exc_info=True)
+        return document
+    return json.dumps(flattened).encode("utf-8")
@@ -0,0 +1,47 @@
+from typing import Tuple
+
+import re
+
+
+MAC_BITS = 48
+OUI_BITS = 24
+
+_SEPARATORS_RE = re.compile("[:-]")
+_GROUPED_RE = re.compile("^[0-9a-fA-F]{2}([:-][0-9a-fA-F]{2}){5}$")
+_BARE_RE = re.compile("^[0-9a-fA-F]{12}$")
+_OUI_RE = re.compile("^[0-9a-fA-F]{2}([:-]?[0-9a-fA-F]{2}){2}$")
+
+
+def mac_to_int(value: str) -> int:
+    """Parses a MAC address in colon, dash or bare form, in any case.
+
+    Raises ValueError for anything else. Separators can not be mixed.
+    """
+    value = value.strip()
+    if _GROUPED_RE.match(value):
+        if ":" in value and "-" in value:
+            raise ValueError("Invalid MAC address: %s" % value)
+        value = _SEPARATORS_RE.sub("", value)
+    elif not _BARE_RE.match(value):
+        raise ValueError("Invalid MAC address: %s" % value)
+    return int(value, 16)
+
+
+def int_to_mac(value: int) -> str:
+    """Returns the canonical display form, like AA:BB:CC:DD:EE:FF."""
+    digits = "%012X" % value
+    return ":".join(digits[i : i + 2] for i in range(0, 12, 2))
+
+
+def normalize_mac(value: str) -> str:
+    return int_to_mac(mac_to_int(value))
+
+
+def oui_range(prefix: str) -> Tuple[int, int]:
+    """Returns the first and last MAC address integers of an OUI prefix."""
+    prefix = prefix.strip()
+    if not _OUI_RE.match(prefix):
+        raise ValueError("Invalid OUI: %s" % prefix)
+    shift = MAC_BITS - OUI_BITS
+    oui = int(_SEPARATORS_RE.sub("", prefix), 16)
+    return oui << shift, ((oui + 1) << shift) - 1
@@ -0,0 +1,50 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from zezere.device_import import BATCH_SIZE, FORMATS, guess_format, import_devices
+
+
+class Command(BaseCommand):
+    help = "Pre-register devices from a CSV or NDJSON manifest"
+
+    def add_arguments(self, parser):
+        parser.add_argument("manifest", help="Manifest file, or - for stdin")
+        parser.add_argument(
+            "--format",
+            choices=FORMATS,
+            default=None,
+            help="Manifest format (default: guessed from the file name)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=BATCH_SIZE,
+            help="Number of devices inserted per transaction",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("Batch size must be at least 1")
+        fmt = options["format"] or guess_format(options["manifest"])
+
+        if options["manifest"] == "-":
+            result = import_devices(sys.stdin, fmt, options["batch_size"])
+        else:
+            try:
+                with open(options["manifest"], "r", newline="") as manifest:
+                    result = import_devices(manifest, fmt, options["batch_size"])
+            except OSError as ex:
+                raise CommandError("Error reading manifest: %s" % ex)
+
+        for error in result.errors:
+            self.stderr.write(
+                "Line %d (%s): %s"
+                % (error.line, error.mac_address, "; ".join(error.messages))
+            )
+        self.stdout.write(
+            "Imported %d of %d devices in %.2f seconds (%.0f rows/s)"
+            % (result.created, result.rows, result.seconds, result.rows_per_second)
+        )
+        if result.errors:
+            raise CommandError("%d rows were not imported" % len(result.errors))
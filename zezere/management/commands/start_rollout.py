@@ -0,0 +1,74 @@
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from zezere.models import Device, Rollout, RunRequest
+
+
+class Command(BaseCommand):
+    help = "Assign a runreq to a set of devices in waves"
+
+    def add_arguments(self, parser):
+        parser.add_argument("runrequest", help="Runreq ID or auto generated ID")
+        parser.add_argument(
+            "--mac", action="append", default=[], help="MAC address of a device"
+        )
+        parser.add_argument(
+            "--oui", action="append", default=[], help="OUI prefix of devices"
+        )
+        parser.add_argument("--owner", help="Only roll out to devices of this user")
+        parser.add_argument("--wave-size", type=int, help="Devices per wave")
+        parser.add_argument(
+            "--wave-percent", type=int, help="Percentage of the devices per wave"
+        )
+        parser.add_argument(
+            "--advance-percent",
+            type=int,
+            default=90,
+            help="Percentage of a wave that must reach postboot before the next",
+        )
+
+    def handle(self, *args, **options):
+        runreq_id = options["runrequest"]
+        runreqs = RunRequest.objects.filter(auto_generated_id=runreq_id)
+        if runreq_id.isdigit():
+            runreqs = runreqs | RunRequest.objects.filter(pk=int(runreq_id))
+        runreq = runreqs.first()
+        if runreq is None:
+            raise CommandError("Unknown runreq %s" % runreq_id)
+
+        devices = Device.objects.none()
+        for mac in options["mac"]:
+            devices = devices | Device.objects.by_mac(mac)
+        for oui in options["oui"]:
+            devices = devices | Device.objects.with_oui(oui)
+        owner = None
+        if options["owner"]:
+            owner = User.objects.filter(username=options["owner"]).first()
+            if owner is None:
+                raise CommandError("Unknown user %s" % options["owner"])
+            devices = devices.filter(owner=owner)
+        devices = list(devices)
+        if not devices:
+            raise CommandError("No devices selected")
+
+        rollout = Rollout(
+            owner=owner,
+            run_request=runreq,
+            wave_size=options["wave_size"],
+            wave_percent=options["wave_percent"],
+            advance_percent=options["advance_percent"],
+        )
+        try:
+            rollout.full_clean()
+        except ValidationError as ex:
+            raise CommandError("; ".join(ex.messages))
+        with transaction.atomic():
+            rollout.save()
+            rollout.plan(devices)
+        rollout.advance()
+        self.stdout.write(
+            "Started %s: %d devices in %d waves"
+            % (rollout, len(devices), rollout.wave_count)
+        )
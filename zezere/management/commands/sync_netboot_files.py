@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from zezere import download_netboot_files
+from zezere.netboot_sync import SyncError
+
+
+class Command(BaseCommand):
+    help = "Download, resume and verify the netboot kernel and initrd images"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--destroot",
+            default=None,
+            help="Directory containing zezere/static (default: current directory)",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=4,
+            help="Maximum number of parallel downloads",
+        )
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="Recompute checksums of files that are already downloaded",
+        )
+
+    def handle(self, *args, **options):
+        if options["concurrency"] < 1:
+            raise CommandError("Concurrency must be at least 1")
+        try:
+            download_netboot_files(
+                options["destroot"],
+                concurrency=options["concurrency"],
+                full_verify=options["verify"],
+                stdout=self.stdout,
+            )
+        except SyncError as ex:
+            raise CommandError(str(ex))
@@ -0,0 +1,39 @@
+from django.db import migrations, models
+
+
+def backfill_mac_int(apps, schema_editor):
+    from zezere.macaddr import int_to_mac, mac_to_int
+
+    Device = apps.get_model("zezere", "Device")
+    devices = list(Device.objects.only("mac_address"))
+    for device in devices:
+        device.mac_int = mac_to_int(device.mac_address)
+        device.mac_address = int_to_mac(device.mac_int)
+    Device.objects.bulk_update(devices, ["mac_int", "mac_address"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("zezere", "0012_auto_20200323_1130"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="device",
+            name="mac_int",
+            field=models.BigIntegerField(
+                editable=False, null=True, verbose_name="Device MAC Address as integer"
+            ),
+        ),
+        migrations.RunPython(backfill_mac_int, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="device",
+            name="mac_int",
+            field=models.BigIntegerField(
+                editable=False,
+                unique=True,
+                verbose_name="Device MAC Address as integer",
+            ),
+        ),
+    ]
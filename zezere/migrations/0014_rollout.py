@@ -0,0 +1,127 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:10
+
+import django.db.models.deletion
+import rules.contrib.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("zezere", "0013_device_mac_int"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Rollout",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "wave_size",
+                    models.PositiveIntegerField(
+                        blank=True, null=True, verbose_name="Devices per wave"
+                    ),
+                ),
+                (
+                    "wave_percent",
+                    models.PositiveSmallIntegerField(
+                        blank=True,
+                        null=True,
+                        verbose_name="Percentage of the devices per wave",
+                    ),
+                ),
+                (
+                    "advance_percent",
+                    models.PositiveSmallIntegerField(
+                        default=90,
+                        verbose_name="Percentage of a wave that must reach postboot",
+                    ),
+                ),
+                (
+                    "current_wave",
+                    models.PositiveIntegerField(default=0, verbose_name="Current wave"),
+                ),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "owner",
+                    models.ForeignKey(
+                        blank=True,
+                        default=None,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "run_request",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="zezere.runrequest",
+                    ),
+                ),
+            ],
+            bases=(rules.contrib.models.RulesModelMixin, models.Model),
+        ),
+        migrations.CreateModel(
+            name="RolloutDevice",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("wave", models.PositiveIntegerField(verbose_name="Wave")),
+                (
+                    "assigned",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="Runreq assigned"
+                    ),
+                ),
+                (
+                    "completed",
+                    models.DateTimeField(
+                        blank=True, null=True, verbose_name="Reached postboot"
+                    ),
+                ),
+                (
+                    "device",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="rollouts",
+                        to="zezere.device",
+                    ),
+                ),
+                (
+                    "rollout",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="devices",
+                        to="zezere.rollout",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["rollout", "wave"],
+                        name="zezere_roll_rollout_d7e5cb_idx",
+                    )
+                ],
+                "unique_together": {("rollout", "device")},
+            },
+        ),
+    ]
@@ -1,29 +1,112 @@
-from typing import Optional
+from typing import Any, BinaryIO, Iterable, List, Optional, TypeVar, Union, cast
 
+from functools import lru_cache
 import json
+import math
 
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
 from django.core.validators import RegexValidator
-from django.contrib.auth.models import User
+from django.contrib.auth.models import AnonymousUser, User
 from django.http import HttpRequest
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from rules.contrib.models import RulesModel
 from rest_framework import serializers
 
+from . import caching
 from . import rules
 from .runreqs import validate_runreq_autoid, generate_auto_runreq
 from . import ignconfig
+from .macaddr import int_to_mac, mac_to_int, oui_range
 
 
-class AttrDict(dict):
-    def __getattr__(self, name):
-        ret = self[name]
-        if isinstance(ret, dict):
-            ret = AttrDict(ret)
-        return ret
+ignition_base_cache = caching.VersionedCache("ignition-base")
+
+
+SETTINGS_CACHE_SIZE = 256
+
+
+def _frozen(value: Any) -> Any:
+    if isinstance(value, dict):
+        return FrozenSettings(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_frozen(item) for item in value)
+    return value
+
+
+class FrozenSettings(dict):
+    """Immutable RunRequest settings, with attribute access to the keys.
+
+    Nested objects and lists are frozen once on construction, so reading them
+    does not allocate. Being a dict, it still serializes to JSON as-is.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, values: Any = ()):
+        super().__init__((key, _frozen(value)) for key, value in dict(values).items())
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __reduce__(self):
+        return (FrozenSettings, (dict(self),))
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("RunRequest settings are immutable")
+
+    __setitem__ = __delitem__ = __setattr__ = __delattr__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+@lru_cache(maxsize=SETTINGS_CACHE_SIZE)
+def compile_settings(raw_settings: Optional[str]) -> FrozenSettings:
+    """Returns the parsed settings, shared by all runreqs with these settings."""
+    return FrozenSettings(json.loads(raw_settings or "{}"))
+
+
+AnyUser = Union[User, AnonymousUser]
+_QuerySet = TypeVar("_QuerySet", bound="OwnedQuerySet")
+
+
+class OwnedQuerySet(models.QuerySet):
+    """Set-based versions of the rules on the owner of objects.
+
+    The filters must give the same answers as the rules for single objects,
+    or as User.has_perm (which allows superusers anything) where noted.
+    tests/test_rules_querysets.py checks that they do.
+    """
+
+    def owned_by(self: _QuerySet, user: AnyUser) -> _QuerySet:
+        """Like rules.owns_device, owns_runreq, owns_sshkey and owns_rollout."""
+        if not user.is_authenticated:
+            return self.none()
+        return self.filter(rules.is_owned_filter() & rules.is_owner_filter(user))
+
+    def owned_by_or_unowned(self: _QuerySet, user: AnyUser) -> _QuerySet:
+        if not user.is_authenticated:
+            return self.none()
+        return self.filter(rules.is_owner_filter(user) | ~rules.is_owned_filter())
+
+    def manageable_by(self: _QuerySet, user: AnyUser) -> _QuerySet:
+        """Filters on the objects user can change or delete, like User.has_perm."""
+        if user.is_superuser:
+            return self.all()
+        return self.owned_by(user)
+
+
+class RunRequestQuerySet(OwnedQuerySet):
+    def usable_by(self, user: AnyUser) -> "RunRequestQuerySet":
+        """Filters on the runreqs that user can use, like User.has_perm."""
+        if user.is_superuser:
+            return self.all()
+        return self.owned_by_or_unowned(user)
 
 
 class RunRequest(RulesModel):
@@ -79,14 +162,16 @@ class RunRequest(RulesModel):
         "JSON-encoded settings", null=True, blank=True
     )
 
+    objects = RunRequestQuerySet.as_manager()
+
     _auto_generated_settings = None
-    _settings: Optional[AttrDict] = None
+    _settings: Optional[FrozenSettings] = None
 
     @property
-    def settings(self):
-        if self._settings is None:
-            self._settings = json.loads(self.raw_settings)
-        return AttrDict(self._settings)
+    def settings(self) -> FrozenSettings:
+        if self._settings is not None:
+            return self._settings
+        return compile_settings(self.raw_settings)
 
     @property
     def is_auto_generated(self):
@@ -99,6 +184,41 @@ class RunRequest(RulesModel):
         elif self.type == RunRequest.TYPE_EFI:
             return "EFI"
 
+    def get_ignition_config(self) -> ignconfig.IgnitionConfig:
+        """Returns the Ignition config shared by all devices of this runreq.
+
+        The items are taken from the "ignition" setting, which can contain
+        lists of "units", "users", "groups", "files" and config "merges".
+        """
+        cfgobj = ignconfig.IgnitionConfig()
+        ignsettings = self.settings.get("ignition", {})
+        for unit in ignsettings.get("units", []):
+            cfgobj.add_unit(ignconfig.RawConfigObject(unit))
+        for user in ignsettings.get("users", []):
+            cfgobj.add_user(ignconfig.RawConfigObject(user))
+        for group in ignsettings.get("groups", []):
+            cfgobj.add_group(ignconfig.RawConfigObject(group))
+        for merge in ignsettings.get("merges", []):
+            cfgobj.add_config_merge(ignconfig.RawConfigObject(merge))
+        for file in ignsettings.get("files", []):
+            cfgobj.add_file(ignconfig.RawConfigObject(file))
+        return cfgobj
+
+    def get_compiled_ignition_config(
+        self, request: HttpRequest
+    ) -> ignconfig.CompiledIgnitionConfig:
+        """Returns the compiled shared config, cached per runreq version."""
+        if self.pk is None:
+            return self.get_ignition_config().compile()
+        compiled: Optional[ignconfig.CompiledIgnitionConfig]
+        compiled, token = ignition_base_cache.lookup(
+            (self.pk, request.build_absolute_uri("/")), [("runrequest", self.pk)]
+        )
+        if compiled is None:
+            compiled = self.get_ignition_config().compile()
+            ignition_base_cache.store(token, compiled)
+        return compiled
+
     def __str__(self):
         if self.is_auto_generated:
             return "Auto: %s: %s" % (self.typestr, self.auto_generated_id)
@@ -127,6 +247,8 @@ class RunRequest(RulesModel):
 
 
 models.signals.post_init.connect(generate_auto_runreq, sender=RunRequest)
+for signal in (models.signals.post_save, models.signals.post_delete):
+    signal.connect(caching.version_bumper("runrequest"), sender=RunRequest, weak=False)
 
 
 class SSHKey(RulesModel):
@@ -143,12 +265,102 @@ class SSHKey(RulesModel):
     )
     key: models.CharField = models.CharField("SSH Key", max_length=1024)
 
+    objects = OwnedQuerySet.as_manager()
+
+
+# Ignition configs contain the SSH keys of the device owner
+for signal in (models.signals.post_save, models.signals.post_delete):
+    signal.connect(
+        caching.version_bumper("user", "owner_id"), sender=SSHKey, weak=False
+    )
+
 
 def validator_disallow_blacklisted_mac(value):
     if value == "52:54:00:12:34:56":
         raise ValidationError("Default LibVirt MAC address cannot be used")
 
 
+class DeviceQuerySet(OwnedQuerySet):
+    def by_mac(self, mac_addr: str) -> "DeviceQuerySet":
+        """Filters on a MAC address in any accepted form, using the integer index."""
+        try:
+            return self.filter(mac_int=mac_to_int(mac_addr))
+        except ValueError:
+            return self.none()
+
+    def with_oui(self, prefix: str) -> "DeviceQuerySet":
+        """Filters on the devices whose MAC address starts with an OUI prefix."""
+        try:
+            first, last = oui_range(prefix)
+        except ValueError:
+            return self.none()
+        return self.filter(mac_int__range=(first, last))
+
+    def visible_to(self, user: AnyUser) -> "DeviceQuerySet":
+        """Filters on the devices that user can view, owned or claimable."""
+        return self.owned_by_or_unowned(user)
+
+    def claimable_by(self, user: AnyUser) -> "DeviceQuerySet":
+        """Filters on the devices that user can claim, like rules.can_claim."""
+        if not user.is_authenticated:
+            return self.none()
+        return self.filter(~rules.is_owned_filter())
+
+    def provisionable_by(self, user: AnyUser) -> "DeviceQuerySet":
+        """Filters on the devices that user can provision, like rules.owns_device."""
+        return self.owned_by(user)
+
+    def register(self, mac_addr: str, architecture: str, ip_address: str) -> "Device":
+        """Returns the device with this MAC address, registering it if it is new.
+
+        Known devices cost a single SELECT. New devices are inserted with an
+        upsert where the database supports it, so concurrent first boots of a
+        device all get the same row instead of an IntegrityError.
+        """
+        try:
+            device = cast("Device", self.by_mac(mac_addr).get())
+        except self.model.DoesNotExist:
+            device = self.model(
+                mac_address=mac_addr,
+                architecture=architecture,
+                last_ip_address=ip_address,
+            )
+            device.full_clean(validate_unique=False)
+            device = self._upsert(device)
+        if device.architecture != architecture:
+            raise ValidationError(
+                {"mac_address": _("Device with this MAC address already exists")}
+            )
+        return device
+
+    def _upsert(self, device: "Device") -> "Device":
+        features = connections[self.db].features
+        # Conflict targets are only known to Django 4.1 and later
+        if not getattr(features, "supports_update_conflicts_with_target", False):
+            try:
+                with transaction.atomic(using=self.db):
+                    device.save(using=self.db)
+            except IntegrityError:
+                return cast("Device", self.by_mac(device.mac_address).get())
+            return device
+
+        device.mac_int = mac_to_int(device.mac_address)
+        device.mac_address = int_to_mac(device.mac_int)
+        # Updating the row on conflict refreshes the IP address of a device
+        #  registered by a concurrent request.
+        self.bulk_create(
+            [device],
+            update_conflicts=True,
+            unique_fields=["mac_int"],
+            update_fields=["last_ip_address"],
+        )
+        # On a conflict the other fields are those of the existing row
+        device = cast("Device", self.by_mac(device.mac_address).get())
+        # A new row might reuse the id of a deleted device
+        caching.bump_version("device", device.pk)
+        return device
+
+
 class Device(RulesModel):
     class Meta:
         rules_permissions = {
@@ -172,6 +384,10 @@ class Device(RulesModel):
             validator_disallow_blacklisted_mac,
         ],
     )
+    # The MAC address as a 48-bit integer, used for all lookups
+    mac_int: models.BigIntegerField = models.BigIntegerField(
+        "Device MAC Address as integer", unique=True, editable=False
+    )
     architecture: models.CharField = models.CharField("Architecture", max_length=50)
     hostname: models.CharField = models.CharField(
         "Device hostname", max_length=200, default=None, blank=True, null=True
@@ -186,8 +402,23 @@ class Device(RulesModel):
         RunRequest, on_delete=models.SET_NULL, default=None, blank=True, null=True
     )
 
-    def get_ignition_config(self, request: HttpRequest) -> ignconfig.IgnitionConfig:
+    objects = DeviceQuerySet.as_manager()
+
+    def clean_fields(self, exclude=None):
+        try:
+            self.mac_address = int_to_mac(mac_to_int(self.mac_address))
+        except (ValueError, TypeError, AttributeError):
+            # Reported by the validators of the field
+            pass
+        super().clean_fields(exclude)
 
+    def save(self, *args, **kwargs):
+        self.mac_int = mac_to_int(self.mac_address)
+        self.mac_address = int_to_mac(self.mac_int)
+        super().save(*args, **kwargs)
+
+    def get_ignition_config(self, request: HttpRequest) -> ignconfig.IgnitionConfig:
+        """Returns the device specific part of the Ignition config."""
         cfgobj = ignconfig.IgnitionConfig()
 
         # Add owner SSH keys to root
@@ -197,11 +428,195 @@ class Device(RulesModel):
         ]
         cfgobj.add_user(rootuser)
 
+        if self.hostname:
+            hostname = ignconfig.StorageFile(
+                "/etc/hostname",
+                ignconfig.FileContents(contents=b"%s\n" % self.hostname.encode()),
+            )
+            hostname.mode = 0o644
+            hostname.overwrite = True
+            cfgobj.add_file(hostname)
+
         return cfgobj
 
+    def write_ignition_config(self, request: HttpRequest, out: BinaryIO):
+        """Writes the JSON Ignition config of the device to out.
+
+        The config is assembled from the compiled config of the run request,
+        with the device specific config merged on top. The root user and, if
+        the device has a hostname, its hostname file are merged with those of
+        the run request, so fields the device does not set are kept.
+        """
+        layers = []
+        if self.run_request is not None:
+            layers.append(self.run_request.get_compiled_ignition_config(request))
+        layers.append(self.get_ignition_config(request).compile())
+        ignconfig.write_configs_json(layers, out)
+
+
+for signal in (models.signals.post_save, models.signals.post_delete):
+    signal.connect(caching.version_bumper("device"), sender=Device, weak=False)
+    signal.connect(caching.version_bumper("user"), sender=User, weak=False)
+
+
+class Rollout(RulesModel):
+    """Assigns a runreq to a set of devices in waves.
+
+    A wave is only assigned once enough devices of the previous wave reported
+    in at postboot, which caps the number of devices installing at once.
+    """
+
+    class Meta:
+        rules_permissions = {
+            "add": rules.rules.is_staff,
+            "view": rules.owns_rollout,
+            "change": rules.owns_rollout,
+            "delete": rules.owns_rollout,
+        }
+
+    owner: models.ForeignKey = models.ForeignKey(
+        User, on_delete=models.PROTECT, default=None, blank=True, null=True
+    )
+    run_request: models.ForeignKey = models.ForeignKey(
+        RunRequest, on_delete=models.PROTECT
+    )
+    wave_size: models.PositiveIntegerField = models.PositiveIntegerField(
+        "Devices per wave", null=True, blank=True
+    )
+    wave_percent: models.PositiveSmallIntegerField = models.PositiveSmallIntegerField(
+        "Percentage of the devices per wave", null=True, blank=True
+    )
+    advance_percent: models.PositiveSmallIntegerField = (
+        models.PositiveSmallIntegerField(
+            "Percentage of a wave that must reach postboot", default=90
+        )
+    )
+    # 0 until the first wave is assigned
+    current_wave: models.PositiveIntegerField = models.PositiveIntegerField(
+        "Current wave", default=0
+    )
+    created: models.DateTimeField = models.DateTimeField(auto_now_add=True)
+
+    objects = OwnedQuerySet.as_manager()
+
+    def __str__(self):
+        return "Rollout %s of %s" % (self.pk, self.run_request)
+
+    def clean(self):
+        if (self.wave_size is None) == (self.wave_percent is None):
+            raise ValidationError(_("Either a wave size or percentage is required"))
+        if self.wave_size is not None and self.wave_size < 1:
+            raise ValidationError(_("The wave size must be at least 1"))
+        if self.wave_percent is not None and not 1 <= self.wave_percent <= 100:
+            raise ValidationError(_("The wave percentage must be from 1 to 100"))
+        if not 0 <= self.advance_percent <= 100:
+            raise ValidationError(_("The advance percentage must be from 0 to 100"))
+
+    def plan(self, devices: Iterable[Device]):
+        """Splits devices into the waves of this rollout."""
+        devices = sorted(set(devices), key=lambda device: device.pk)
+        size = self.wave_size
+        if size is None:
+            size = max(1, math.ceil(len(devices) * self.wave_percent / 100))
+        RolloutDevice.objects.bulk_create(
+            RolloutDevice(rollout=self, device=device, wave=i // size + 1)
+            for i, device in enumerate(devices)
+        )
+
+    @property
+    def wave_count(self) -> int:
+        entries = RolloutDevice.objects.filter(rollout=self)
+        return entries.aggregate(models.Max("wave"))["wave__max"] or 0
+
+    @property
+    def is_finished(self) -> bool:
+        return bool(self.current_wave >= self.wave_count)
+
+    def wave_completed(self, wave: int) -> bool:
+        """Returns whether enough devices of wave reached postboot."""
+        counts = RolloutDevice.objects.filter(rollout=self, wave=wave).aggregate(
+            total=models.Count("pk"),
+            completed=models.Count("pk", filter=models.Q(completed__isnull=False)),
+        )
+        return bool(
+            counts["completed"]
+            >= math.ceil(counts["total"] * self.advance_percent / 100)
+        )
+
+    def advance(self) -> bool:
+        """Assigns the next wave if the current one is far enough along.
+
+        Returns whether a wave was assigned.
+        """
+        wave = self.current_wave
+        if wave > 0 and not self.wave_completed(wave):
+            return False
+        if not RolloutDevice.objects.filter(rollout=self, wave=wave + 1).exists():
+            return False
+
+        with transaction.atomic():
+            # Only one of any concurrent calls gets to assign the wave
+            if not Rollout.objects.filter(pk=self.pk, current_wave=wave).update(
+                current_wave=wave + 1
+            ):
+                self.refresh_from_db(fields=["current_wave"])
+                return False
+            self.current_wave = wave + 1
+            entries = RolloutDevice.objects.filter(rollout=self, wave=self.current_wave)
+            entries.update(assigned=timezone.now())
+            device_ids = list(entries.values_list("device_id", flat=True))
+            Device.objects.filter(pk__in=device_ids).update(
+                run_request=self.run_request
+            )
+        # Updates do not send post_save
+        caching.bump_versions("device", device_ids)
+        return True
+
+    @classmethod
+    def record_postboot(cls, device: Device, run_request: RunRequest) -> List[int]:
+        """Marks device as completed in rollouts of run_request, and advances them.
+
+        Returns the ids of the rollouts that were advanced.
+        """
+        entries = RolloutDevice.objects.filter(
+            device=device,
+            rollout__run_request=run_request,
+            assigned__isnull=False,
+            completed__isnull=True,
+        )
+        rollout_ids = list(entries.values_list("rollout_id", flat=True))
+        if not rollout_ids:
+            return []
+        entries.update(completed=timezone.now())
+        return [
+            rollout.pk
+            for rollout in cls.objects.filter(pk__in=rollout_ids)
+            if rollout.advance()
+        ]
+
+
+class RolloutDevice(models.Model):
+    class Meta:
+        unique_together = [("rollout", "device")]
+        indexes = [models.Index(fields=["rollout", "wave"])]
+
+    rollout: models.ForeignKey = models.ForeignKey(
+        Rollout, on_delete=models.CASCADE, related_name="devices"
+    )
+    device: models.ForeignKey = models.ForeignKey(
+        Device, on_delete=models.CASCADE, related_name="rollouts"
+    )
+    wave: models.PositiveIntegerField = models.PositiveIntegerField("Wave")
+    assigned: models.DateTimeField = models.DateTimeField(
+        "Runreq assigned", null=True, blank=True
+    )
+    completed: models.DateTimeField = models.DateTimeField(
+        "Reached postboot", null=True, blank=True
+    )
+
 
 def device_getter(request, mac_addr):
-    return get_object_or_404(Device, mac_address=mac_addr.upper())
+    return get_object_or_404(Device.objects.by_mac(mac_addr))
 
 
 class UnownedDeviceSerializer(serializers.HyperlinkedModelSerializer):
@@ -0,0 +1,213 @@
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import os.path
+import threading
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = ".manifest.json"
+CHUNK_SIZE = 1024 * 1024
+
+STATUS_VERIFIED = "verified"
+STATUS_DOWNLOADED = "downloaded"
+STATUS_RESUMED = "resumed"
+STATUS_FAILED = "failed"
+
+
+class SyncError(Exception):
+    pass
+
+
+class SyncResult(NamedTuple):
+    destination: str
+    status: str
+    error: Optional[str] = None
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_json(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, "r") as f:
+            value: Dict[str, Any] = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return value
+
+
+def _write_json(path: str, value: Mapping[str, Any]):
+    tmppath = path + ".tmp"
+    with open(tmppath, "w") as f:
+        json.dump(value, f, indent=2, sort_keys=True)
+    os.replace(tmppath, path)
+
+
+class Manifest(object):
+    """The checksums of the files downloaded in a directory.
+
+    Each entry records the URL, size and SHA256 of a completed download.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = _read_json(path)
+        self._lock = threading.Lock()
+
+    def get(self, destination: str) -> Optional[Dict[str, Any]]:
+        return self.entries.get(destination)
+
+    def update(self, destination: str, entry: Dict[str, Any]):
+        with self._lock:
+            self.entries[destination] = entry
+            _write_json(self.path, self.entries)
+
+
+class NetbootFileSync(object):
+    """Downloads netboot files in parallel into destdir.
+
+    Downloads go to a .part file that is resumed with a Range request when a
+    previous run was interrupted, and is only moved into place after its size
+    and checksum are verified.
+    """
+
+    def __init__(
+        self,
+        destdir: str,
+        concurrency: int = 4,
+        full_verify: bool = False,
+        chunk_size: int = CHUNK_SIZE,
+        timeout: int = 60,
+    ):
+        self.destdir = destdir
+        self.concurrency = concurrency
+        self.full_verify = full_verify
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.manifest = Manifest(os.path.join(destdir, MANIFEST_NAME))
+
+    def sync(self, files: Iterable[Mapping[str, str]]) -> List[SyncResult]:
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(self.sync_file, files))
+
+    def sync_file(self, file: Mapping[str, str]) -> SyncResult:
+        destination = file["destination"]
+        try:
+            if self.is_current(file):
+                return SyncResult(destination, STATUS_VERIFIED)
+            resumed = self.download(file)
+            return SyncResult(
+                destination, STATUS_RESUMED if resumed else STATUS_DOWNLOADED
+            )
+        except (SyncError, requests.RequestException, OSError) as ex:
+            logger.error("Error syncing %s: %s", destination, ex)
+            return SyncResult(destination, STATUS_FAILED, str(ex))
+
+    def is_current(self, file: Mapping[str, str]) -> bool:
+        path = os.path.join(self.destdir, file["destination"])
+        entry = self.manifest.get(file["destination"])
+        if entry is None or entry["url"] != file["url"]:
+            return False
+        if file.get("sha256") and entry["sha256"] != file["sha256"]:
+            return False
+        try:
+            if os.path.getsize(path) != entry["size"]:
+                return False
+        except FileNotFoundError:
+            return False
+        if self.full_verify:
+            expected: str = entry["sha256"]
+            return file_sha256(path) == expected
+        return True
+
+    def download(self, file: Mapping[str, str]) -> bool:
+        """Downloads file, returns whether a partial download was resumed."""
+        path = os.path.join(self.destdir, file["destination"])
+        partpath = path + ".part"
+        metapath = partpath + ".json"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        meta = _read_json(metapath)
+        offset = 0
+        if meta.get("url") == file["url"] and os.path.exists(partpath):
+            offset = os.path.getsize(partpath)
+
+        headers = {}
+        if offset:
+            headers["Range"] = "bytes=%d-" % offset
+            if meta.get("validator"):
+                headers["If-Range"] = meta["validator"]
+
+        with requests.get(
+            file["url"], headers=headers, stream=True, timeout=self.timeout
+        ) as resp:
+            if resp.status_code == 416 and offset:
+                # The part file might already be complete
+                total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+                if total != str(offset):
+                    os.unlink(partpath)
+                    return self.download(file)
+                size = offset
+            else:
+                resp.raise_for_status()
+                if resp.status_code == 206:
+                    start, size = self._parse_content_range(resp)
+                    if start != offset:
+                        raise SyncError("Server resumed at unexpected offset")
+                else:
+                    offset = 0
+                    size = int(resp.headers.get("Content-Length", -1))
+
+                _write_json(
+                    metapath,
+                    {
+                        "url": file["url"],
+                        "validator": resp.headers.get("ETag")
+                        or resp.headers.get("Last-Modified"),
+                    },
+                )
+                with open(partpath, "ab" if offset else "wb") as f:
+                    for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+        actual_size = os.path.getsize(partpath)
+        if size >= 0 and actual_size != size:
+            raise SyncError("Download incomplete: %d of %d bytes" % (actual_size, size))
+        checksum = file_sha256(partpath)
+        if file.get("sha256") and checksum != file["sha256"]:
+            os.unlink(partpath)
+            os.unlink(metapath)
+            raise SyncError("Checksum mismatch: got %s" % checksum)
+
+        os.replace(partpath, path)
+        os.unlink(metapath)
+        self.manifest.update(
+            file["destination"],
+            {"url": file["url"], "size": actual_size, "sha256": checksum},
+        )
+        return offset > 0
+
+    @staticmethod
+    def _parse_content_range(resp: requests.Response):
+        value = resp.headers.get("Content-Range", "")
+        try:
+            _, _, rangespec = value.partition(" ")
+            byterange, _, total = rangespec.partition("/")
+            start = int(byterange.split("-")[0])
+            return start, int(total) if total != "*" else -1
+        except ValueError:
+            raise SyncError("Invalid Content-Range: %s" % value)
@@ -0,0 +1,73 @@
+from typing import Callable, Dict, Mapping, Tuple, Union
+
+from functools import lru_cache
+import re
+
+# Placeholders that can be used in templates and runreq strings.
+# They are replaced with the values for the device being rendered for.
+PLACEHOLDERS = ("urls.base", "urls.kickstart", "arch", "mac_addr")
+
+PLACEHOLDER_RE = re.compile(
+    ":(%s):" % "|".join(re.escape(name) for name in PLACEHOLDERS)
+)
+
+Value = Union[str, Callable[[], str]]
+
+
+def split_placeholders(value: str) -> Tuple[str, ...]:
+    """Splits value into alternating literal and placeholder name segments.
+
+    Even indexes are literal text, odd indexes are placeholder names.
+    """
+    return tuple(PLACEHOLDER_RE.split(value))
+
+
+# Runreq strings are the same for many devices, so they are split only once
+compile_placeholders = lru_cache(maxsize=256)(split_placeholders)
+
+
+def fill_placeholders(
+    value: str, values: Mapping[str, Value], memoize: bool = True
+) -> str:
+    """Replaces all placeholders in value in a single pass.
+
+    Values can be callables, which are only called if the placeholder is used.
+    Placeholders without a value are left in place. Pass memoize=False for
+    values that are unlikely to be filled again, like rendered templates.
+    """
+    if memoize:
+        segments = compile_placeholders(value)
+    else:
+        segments = split_placeholders(value)
+    if len(segments) == 1:
+        return value
+
+    resolved: Dict[str, str] = {}
+    output = list(segments)
+    for i in range(1, len(output), 2):
+        name = output[i]
+        text = resolved.get(name)
+        if text is None:
+            val = values.get(name)
+            if val is None:
+                text = f":{name}:"
+            elif callable(val):
+                text = val()
+            else:
+                text = val
+            resolved[name] = text
+        output[i] = text
+    return "".join(output)
+
+
+def device_placeholders(request, device, base: bool = True):
+    values: Dict[str, Value] = {}
+    if base:
+        values["urls.base"] = lambda: request.build_absolute_uri("/")
+    if device:
+        values["urls.kickstart"] = lambda: request.build_absolute_uri(
+            f"/netboot/kickstart/{device.mac_address}"
+        )
+        values["arch"] = device.architecture
+        values["mac_addr"] = device.mac_address
+    return values
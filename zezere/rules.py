@@ -1,15 +1,32 @@
+from django.db.models import Q
+
 import rules
 
 
+# The owner predicates below as queryset filters, used by the querysets in
+# models.py to check whole tables at once. The predicates compare owner ids,
+# so that checks do not load the owner row.
+def is_owner_filter(user):
+    return Q(owner_id=user.pk)
+
+
+def is_owned_filter():
+    return Q(owner_id__isnull=False)
+
+
+def _is_owner(user, obj):
+    return obj.owner_id is not None and obj.owner_id == user.pk
+
+
 # Rules and predicates for Devices
 @rules.predicate
 def is_device_owner(user, device):
-    return device.owner == user
+    return _is_owner(user, device)
 
 
 @rules.predicate
 def is_owned_device(user, device):
-    return device.owner is not None
+    return device.owner_id is not None
 
 
 owns_device = rules.is_authenticated & is_owned_device & is_device_owner
@@ -19,7 +36,7 @@ can_claim = rules.is_authenticated & ~is_owned_device
 # Rules and predicates for SSHKeys
 @rules.predicate
 def is_sshkey_owner(user, sshkey):
-    return sshkey.owner == user
+    return _is_owner(user, sshkey)
 
 
 owns_sshkey = rules.is_authenticated & is_sshkey_owner
@@ -28,13 +45,22 @@ owns_sshkey = rules.is_authenticated & is_sshkey_owner
 # Rules and predicates for RunRequests
 @rules.predicate
 def is_runreq_owner(user, runreq):
-    return runreq.owner == user
+    return _is_owner(user, runreq)
 
 
 @rules.predicate
 def is_public_runreq(user, runreq):
-    return runreq.owner is None
+    return runreq.owner_id is None
 
 
 owns_runreq = rules.is_authenticated & is_runreq_owner
 can_use_runreq = rules.is_authenticated & (is_runreq_owner | is_public_runreq)
+
+
+# Rules and predicates for Rollouts
+@rules.predicate
+def is_rollout_owner(user, rollout):
+    return _is_owner(user, rollout)
+
+
+owns_rollout = rules.is_authenticated & is_rollout_owner
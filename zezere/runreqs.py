@@ -1,12 +1,15 @@
+from typing import Any, Dict, Mapping, NamedTuple, Optional
+
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 
 from . import models
+from .placeholders import device_placeholders, fill_placeholders
 
 
 KOJI_ROOT = "https://kojipkgs.fedoraproject.org/compose"
 
-AUTO_RUNREQS = {
+AUTO_RUNREQS: Dict[str, Dict[str, Any]] = {
     "fedora-iot-stable": {
         "type": "ok",
         "next": "fedora-installed",
@@ -46,29 +49,18 @@ def validate_runreq_autoid(autoid):
         )
 
 
-def generate_auto_runreq(sender, instance, **kwargs):
-    if not instance.auto_generated_id:
-        # Nothing to auto-generate
-        return
-    info = AUTO_RUNREQS[instance.auto_generated_id]
-    instance.type = info["type"]
+class AutoRunRequest(NamedTuple):
+    """The fields derived from an entry of AUTO_RUNREQS."""
+
+    type: str
+    settings: "models.FrozenSettings"
+    # Only set for runreqs booting a compose, others keep their stored values
+    kernel_url: Optional[str] = None
+    kernel_cmd: Optional[str] = None
+    initrd_url: Optional[str] = None
 
-    if "compose_root" in info:
-        compose_url = f"{info['compose_root']}/compose/{info['compose_name']}/:arch:/os"
-        instance.kernel_url = f"{compose_url}/isolinux/vmlinuz"
-        instance.kernel_cmd = " ".join(
-            [
-                f"inst.repo={compose_url}",
-                "inst.ks=:urls.kickstart:",
-                "inst.ks.sendmac",
-                "noshell",
-                "inst.cmdline",
-                "inst.sshd=0",
-                "ip=dhcp",
-            ]
-        )
-        instance.initrd_url = f"{compose_url}/isolinux/initrd.img"
 
+def build_auto_runreq(info: Mapping[str, Any]) -> AutoRunRequest:
     settings = {"clear_parts": info.get("clear_parts"), "raw": info}
 
     if "next" in info:
@@ -81,24 +73,64 @@ def generate_auto_runreq(sender, instance, **kwargs):
     if info["type"] == models.RunRequest.TYPE_EFI:
         settings["efi_path"] = info["efi_path"]
 
-    instance._settings = settings
+    autoreq = AutoRunRequest(info["type"], models.FrozenSettings(settings))
+    if "compose_root" in info:
+        compose_url = f"{info['compose_root']}/compose/{info['compose_name']}/:arch:/os"
+        autoreq = autoreq._replace(
+            kernel_url=f"{compose_url}/isolinux/vmlinuz",
+            kernel_cmd=" ".join(
+                [
+                    f"inst.repo={compose_url}",
+                    "inst.ks=:urls.kickstart:",
+                    "inst.ks.sendmac",
+                    "noshell",
+                    "inst.cmdline",
+                    "inst.sshd=0",
+                    "ip=dhcp",
+                ]
+            ),
+            initrd_url=f"{compose_url}/isolinux/initrd.img",
+        )
+    return autoreq
 
 
-def replace_device_strings(request, value, device):
-    value = value.replace(
-        ":urls.kickstart:",
-        request.build_absolute_uri(f"/netboot/kickstart/{device.mac_address}"),
-    )
-    value = value.replace(":arch:", device.architecture)
-    value = value.replace(":mac_addr:", device.mac_address)
+# Built on first use, as building needs the models module to be loaded
+_auto_runreqs: Dict[str, AutoRunRequest] = {}
+
+
+def get_auto_runreq(autoid: str) -> AutoRunRequest:
+    autoreq = _auto_runreqs.get(autoid)
+    if autoreq is None:
+        autoreq = _auto_runreqs[autoid] = build_auto_runreq(AUTO_RUNREQS[autoid])
+    return autoreq
 
-    return value
+
+def generate_auto_runreq(sender, instance, **kwargs):
+    if not instance.auto_generated_id:
+        # Nothing to auto-generate
+        return
+    autoreq = get_auto_runreq(instance.auto_generated_id)
+    instance.type = autoreq.type
+    if autoreq.kernel_url is not None:
+        instance.kernel_url = autoreq.kernel_url
+        instance.kernel_cmd = autoreq.kernel_cmd
+        instance.initrd_url = autoreq.initrd_url
+    instance._settings = autoreq.settings
+
+
+def replace_device_strings(request, value, device):
+    return fill_placeholders(value, device_placeholders(request, device, base=False))
 
 
 def generate_runreq_grubcfg(request, device, runreq):
     if runreq.type == models.RunRequest.TYPE_ONLINE_KERNEL:
-        proxy_kernel_url = "static/netboot/:arch:/vmlinuz"
-        proxy_initrd_url = "static/netboot/:arch:/initrd"
+        if runreq.kernel_url and runreq.initrd_url:
+            # Relative to the netboot directory of the architecture
+            proxy_kernel_url = f"runreq/{runreq.id}/kernel"
+            proxy_initrd_url = f"runreq/{runreq.id}/initrd"
+        else:
+            proxy_kernel_url = "static/netboot/:arch:/vmlinuz"
+            proxy_initrd_url = "static/netboot/:arch:/initrd"
 
         return f"""
 linux {proxy_kernel_url} {runreq.kernel_cmd}
@@ -1,9 +1,9 @@
-from typing import Dict
+from typing import Any, Dict
 
 import os
 
 
-from .settings_external import get, getboolean
+from .settings_external import get, getboolean, getint
 from .settings_auth import AUTH_INFO
 
 from .settings_auth import *
@@ -97,6 +97,33 @@ for default_key in ("engine", "name", "user", "password", "host", "port"):
     if val:
         DATABASES["default"][default_key.upper()] = val
 
+# Cache
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+
+CACHES: Dict[str, Dict[str, Any]] = {"default": {}}
+
+for default_key in ("backend", "location"):
+    val = get("cache", default_key, "CACHE_%s" % default_key)
+    if val:
+        CACHES["default"][default_key.upper()] = val
+
+# Only these backends limit their own number of entries, memcached and redis
+#  have their own limits and do not accept the option.
+CULLING_CACHE_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.filebased.FileBasedCache",
+    "django.core.cache.backends.db.DatabaseCache",
+)
+if (
+    CACHES["default"].get("BACKEND", "django.core.cache.backends.locmem.LocMemCache")
+    in CULLING_CACHE_BACKENDS
+):
+    CACHES["default"]["OPTIONS"] = {
+        "MAX_ENTRIES": getint("cache", "max_entries", "CACHE_MAX_ENTRIES")
+    }
+
+RENDER_CACHE_TIMEOUT = getint("cache", "render_timeout", "RENDER_CACHE_TIMEOUT")
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -144,6 +171,28 @@ secheadervalue = get(
 )
 SECURE_PROXY_SSL_HEADER = (secheadername, secheadervalue) if secheadername else None
 
+# Caching proxy for run request kernels and initrds
+ARTIFACT_CACHE_DIR = get("storage", "artifact_cache_dir", "ARTIFACT_CACHE_DIR")
+ARTIFACT_CACHE_TTL = getint("storage", "artifact_cache_ttl", "ARTIFACT_CACHE_TTL")
+
+# Content-addressed store of large Ignition file contents
+IGNITION_BLOB_DIR = get("storage", "ignition_blob_dir", "IGNITION_BLOB_DIR")
+IGNITION_BLOB_THRESHOLD = getint(
+    "storage", "ignition_blob_threshold", "IGNITION_BLOB_THRESHOLD"
+)
+
+# Server-side resolving of Ignition config merges
+IGNITION_FLATTEN_MERGES = getboolean(
+    "ignition", "flatten_merges", "IGNITION_FLATTEN_MERGES"
+)
+IGNITION_MERGE_CACHE_TTL = getint(
+    "ignition", "merge_cache_ttl", "IGNITION_MERGE_CACHE_TTL"
+)
+
+# Write-behind buffering of device check-ins
+CHECKIN_BUFFER_SIZE = getint("checkin", "buffer_size", "CHECKIN_BUFFER_SIZE")
+CHECKIN_FLUSH_INTERVAL = getint("checkin", "flush_interval", "CHECKIN_FLUSH_INTERVAL")
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -25,3 +25,12 @@ def getboolean(section, key, envvar=None):
             return varval.lower() == "yes"
 
     return parser.getboolean(section, key)
+
+
+def getint(section, key, envvar=None):
+    if envvar:
+        varval = os.environ.get(envvar, None)
+        if varval is not None:  # pragma: no cover
+            return int(varval)
+
+    return parser.getint(section, key)
@@ -23,6 +23,11 @@ urlpatterns = [
     path("portal/", views_portal.index, name="portal_index"),
     path("portal/claim/", views_portal.claim, name="portal_claim"),
     path("portal/devices/", views_portal.devices, name="portal_devices"),
+    path(
+        "portal/devices/runreq/",
+        views_portal.bulk_runreq,
+        name="portal_bulkrunreq",
+    ),
     path(
         "portal/devices/runreq/<str:mac_addr>/",
         views_portal.new_runreq,
@@ -41,6 +46,7 @@ urlpatterns = [
         name="portal_sshkeys_remove",
     ),
     # API
+    path("api/devices/import/", views.DeviceImportView.as_view(), name="api_import"),
     path("api/", include(router.urls), name="apis"),
     path(
         "api-auth/",
@@ -79,6 +85,16 @@ urlpatterns = [
         views_netboot.postboot,
         name="netboot_postboot",
     ),
+    path(
+        "netboot/blobs/sha512/<str:digest>",
+        views_netboot.ignition_blob,
+        name="netboot_ignition_blob",
+    ),
+    path(
+        "netboot/<str:arch>/runreq/<int:runreq_id>/<str:artifact>",
+        views_netboot.runreq_artifact,
+        name="netboot_runreq_artifact",
+    ),
     path(
         "netboot/<str:arch>/<str:filetype>",
         views_netboot.arch_file,
@@ -100,6 +116,11 @@ urlpatterns = [
         views_netboot.dynamic_grub_cfg,
         name="netboot_grubcfg_dynamic",
     ),
+    path(
+        "netboot/<str:flags>/<str:arch>/runreq/<int:runreq_id>/<str:artifact>",
+        views_netboot.runreq_artifact,
+        name="netboot_runreq_artifact",
+    ),
     path(
         "netboot/<str:flags>/<str:arch>/<str:filetype>",
         views_netboot.arch_file,
@@ -4,11 +4,21 @@ from django.http import HttpResponse
 from django.shortcuts import redirect
 from django.urls import reverse_lazy
 from django.views import generic
-from rest_framework import viewsets
+from rest_framework import exceptions, permissions, viewsets
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
+from zezere.device_import import FORMAT_CSV, FORMAT_NDJSON, import_devices
 from zezere.models import Device, UnownedDeviceSerializer
 
 
+IMPORT_CONTENT_TYPES = {
+    "text/csv": FORMAT_CSV,
+    "application/x-ndjson": FORMAT_NDJSON,
+    "application/jsonl": FORMAT_NDJSON,
+}
+
+
 def index(request):
     return redirect("/portal/")
 
@@ -39,3 +49,29 @@ class UnownedDevicesViewSet(viewsets.ModelViewSet):
 
     queryset = Device.objects.filter(owner__isnull=True)
     serializer_class = UnownedDeviceSerializer
+
+
+class DeviceImportView(APIView):
+    """
+    API endpoint that pre-registers devices from a CSV or NDJSON manifest.
+
+    The manifest is streamed from the request body, the response reports the
+    rows that could not be imported.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        if not request.user.has_perm(Device.get_perm("add")):
+            raise exceptions.PermissionDenied()
+        content_type = request.content_type.split(";")[0].strip()
+        fmt = IMPORT_CONTENT_TYPES.get(content_type)
+        if fmt is None:
+            raise exceptions.UnsupportedMediaType(content_type)
+
+        stream = request.stream or []
+        try:
+            result = import_devices((line.decode("utf-8") for line in stream), fmt)
+        except UnicodeDecodeError:
+            raise exceptions.ParseError("Manifests must be encoded in UTF-8")
+        return Response(result.as_dict())
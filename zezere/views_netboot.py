@@ -1,31 +1,56 @@
-from typing import Dict, Any
+from typing import Dict, Any, FrozenSet, NamedTuple, Optional, Union
 
+from functools import lru_cache
+import hashlib
+import itertools
 import logging
 import os
 
+from django.conf import settings
 from django.http import (
-    HttpRequest,
-    JsonResponse,
     FileResponse,
+    HttpRequest,
     HttpResponse,
     Http404,
     StreamingHttpResponse,
 )
 from django.shortcuts import get_object_or_404
 from django.template import loader
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 import requests
 
 from ipware import get_client_ip
 
-from .models import Device, RunRequest
+from . import caching, checkin
+from .artifact_proxy import ArtifactUnavailable, get_proxy
+from .artifacts import ArtifactTable, RangeNotSatisfiable, parse_range
+from .contentstore import ContentStore
+from .ignconfig import offload_blobs
+from .ignmerge import flatten_document
+from .models import Device, Rollout, RunRequest
+from .placeholders import device_placeholders, fill_placeholders
 from .runreqs import replace_device_strings
 
 
+grubcfg_cache = caching.VersionedCache("grubcfg")
+ignition_cache = caching.VersionedCache("ignition")
+
+
 ARCHES = {
     "x86_64": {"initial": "shimx64.efi", "grubx64.efi": "grubx64.efi"},
     "aarch64": {"initial": "BOOTAA64.EFI"},
 }
 
+efi_binaries = ArtifactTable(
+    os.path.join(os.path.abspath(os.path.dirname(__file__)), "efi_binaries")
+)
+efi_binaries.preload(
+    f"{arch}/{filename}"
+    for arch, archfiles in ARCHES.items()
+    for filename in set(archfiles.values())
+)
+
 
 def render_for_device(
     device: Device,
@@ -38,15 +63,10 @@ def render_for_device(
 
     content = loader.render_to_string(template_name, context, request)
 
-    # Make replacements
-    content = content.replace(":urls.base:", request.build_absolute_uri("/"))
-    if device:
-        content = content.replace(
-            ":urls.kickstart:",
-            request.build_absolute_uri(f"/netboot/kickstart/{device.mac_address}"),
-        )
-        content = content.replace(":arch:", device.architecture)
-        content = content.replace(":mac_addr:", device.mac_address)
+    # Make replacements, the output differs per device so is not memoized
+    content = fill_placeholders(
+        content, device_placeholders(request, device), memoize=False
+    )
 
     return HttpResponse(content, content_type, status)
 
@@ -66,54 +86,103 @@ def arch_file(request, arch, filetype, flags=None):
     filename = archfiles.get(filetype)
     if not filename:
         raise Http404("File not found for architecture")
-    app_root = os.path.abspath(os.path.dirname(__file__))
-    path = os.path.join(app_root, "efi_binaries", arch, filename)
-    if request.method == "HEAD":
-        resp = HttpResponse(b"", content_type="application/efi")
-        resp["Content-Length"] = os.path.getsize(path)
-        return resp
-    return FileResponse(open(path, "rb"), content_type="application/efi")
+    artifact = efi_binaries.get(f"{arch}/{filename}")
 
+    headers = {
+        "ETag": artifact.etag,
+        "Last-Modified": http_date(artifact.mtime),
+        "Accept-Ranges": "bytes",
+    }
+    resp = HttpResponse(content_type="application/efi")
+    for header, value in headers.items():
+        resp[header] = value
+    cond_resp = get_conditional_response(
+        request, etag=artifact.etag, last_modified=int(artifact.mtime), response=resp
+    )
+    if cond_resp is not resp:
+        return cond_resp
+
+    status = 200
+    start, end = 0, artifact.size - 1
+    if request.META.get("HTTP_IF_RANGE", artifact.etag) == artifact.etag:
+        try:
+            byte_range = parse_range(request.META.get("HTTP_RANGE"), artifact.size)
+        except RangeNotSatisfiable:
+            resp = HttpResponse(status=416)
+            resp["Content-Range"] = "bytes */%d" % artifact.size
+            return resp
+        if byte_range is not None:
+            start, end = byte_range
+            status = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, artifact.size)
 
-def static_grub_cfg(request, arch, flags=None):
-    if flags:
-        flags = flags.split("+")
+    if request.method == "HEAD":
+        resp.status_code = status
+    elif status == 206:
+        resp = StreamingHttpResponse(
+            artifact.iter_range(start, end), status=206, content_type="application/efi"
+        )
     else:
-        flags = []
+        # Goes through wsgi.file_wrapper, and so sendfile where enabled
+        resp = FileResponse(artifact.open(), content_type="application/efi")
+    for header, value in headers.items():
+        resp[header] = value
+    resp["Content-Length"] = end - start + 1
+    return resp
+
+
+STATIC_GRUBCFG_FLAGS = ("debug",)
+STATIC_GRUBCFG_MAX_AGE = 3600
+
+
+class PrecomputedBody(NamedTuple):
+    body: bytes
+    etag: str
+
+
+def precompute_body(body: Union[str, bytes]) -> PrecomputedBody:
+    encoded = body.encode("utf-8") if isinstance(body, str) else body
+    return PrecomputedBody(encoded, '"%s"' % hashlib.sha256(encoded).hexdigest())
 
+
+def generate_static_grub_cfg(flags: FrozenSet[str]) -> str:
     contents = 'configfile "${http_path}/grubcfg/${net_default_mac}"'
     if "debug" in flags:
         contents += "\nset debug=all"
-    content_len = len(contents)
-    if request.method == "HEAD":
-        contents = b""
+    return contents
+
+
+# The static config does not depend on the architecture, only on the flags
+STATIC_GRUBCFGS = {
+    frozenset(flags): precompute_body(generate_static_grub_cfg(frozenset(flags)))
+    for count in range(len(STATIC_GRUBCFG_FLAGS) + 1)
+    for flags in itertools.combinations(STATIC_GRUBCFG_FLAGS, count)
+}
+
+
+@lru_cache(maxsize=64)
+def get_static_grub_cfg(flags: Optional[str]) -> PrecomputedBody:
+    flagset = frozenset(flags.split("+")) if flags else frozenset()
+    return STATIC_GRUBCFGS[flagset.intersection(STATIC_GRUBCFG_FLAGS)]
+
+
+def static_grub_cfg(request, arch, flags=None):
+    cfg = get_static_grub_cfg(flags)
 
     resp = HttpResponse(
-        contents,
+        b"" if request.method == "HEAD" else cfg.body,
         content_type="text/plain",
     )
-    resp["Content-Length"] = content_len
-    return resp
+    resp["Content-Length"] = len(cfg.body)
+    resp["ETag"] = cfg.etag
+    resp["Cache-Control"] = "public, max-age=%d" % STATIC_GRUBCFG_MAX_AGE
+    return get_conditional_response(request, etag=cfg.etag, response=resp)
 
 
 def get_or_create_device(request, arch, mac_addr):
     remote_ip, _ = get_client_ip(request)
-
-    try:
-        device = Device.objects.get(mac_address=mac_addr.upper(), architecture=arch)
-        if device.last_ip_address != remote_ip:
-            device.last_ip_address = remote_ip
-            device.save()
-    except Device.DoesNotExist:
-        # Create new Device
-        device = Device(
-            mac_address=mac_addr.upper(),
-            architecture=arch,
-            last_ip_address=remote_ip,
-        )
-        device.full_clean()
-        device.save()
-
+    device = Device.objects.register(mac_addr, arch, remote_ip)
+    checkin.buffer.record(device, remote_ip)
     return device
 
 
@@ -130,10 +199,25 @@ def dynamic_grub_cfg(request, arch, mac_addr, flags=None):
     try:
         device = get_or_create_device(request, arch, mac_addr)
 
+        content, token = grubcfg_cache.lookup(
+            (
+                device.pk,
+                device.owner_id,
+                device.run_request_id,
+                "+".join(sorted(set(flags))),
+                context["service_url"],
+            ),
+            caching.device_dependencies(device),
+        )
+        if content is not None:
+            return HttpResponse(content, content_type="text/plain")
+
         context["device"] = device
-        return render_for_device(
+        resp = render_for_device(
             device, request, "netboot/grubcfg", context, content_type="text/plain"
         )
+        grubcfg_cache.store(token, resp.content)
+        return resp
 
     except Exception:
         logging.getLogger(__name__).error(
@@ -151,7 +235,7 @@ def dynamic_grub_cfg(request, arch, mac_addr, flags=None):
 
 
 def kickstart(request, mac_addr):
-    device = get_object_or_404(Device, mac_address=mac_addr.upper())
+    device = get_object_or_404(Device.objects.by_mac(mac_addr))
     context = {"device": device}
 
     if device.run_request is None:
@@ -167,16 +251,98 @@ def kickstart(request, mac_addr):
 def ignition_cfg(request, arch, mac_addr):
     device = get_or_create_device(request, arch, mac_addr)
 
-    if device.run_request is None:
+    if device.run_request_id is None:
+        raise Http404()
+
+    cfg, token = ignition_cache.lookup(
+        (device.pk, request.build_absolute_uri("/")),
+        caching.device_dependencies(device),
+    )
+    if cfg is None:
+        resp = HttpResponse(content_type="application/json")
+        with offload_blobs(
+            get_blob_store(),
+            request.build_absolute_uri("/netboot/blobs/sha512/"),
+            settings.IGNITION_BLOB_THRESHOLD,
+        ):
+            device.write_ignition_config(request, resp)
+        if settings.IGNITION_FLATTEN_MERGES:
+            resp.content = flatten_document(resp.content)
+            cfg = precompute_body(resp.content)
+            # Pick up changes of the merged configs
+            ignition_cache.store(token, cfg, settings.IGNITION_MERGE_CACHE_TTL)
+        else:
+            cfg = precompute_body(resp.content)
+            ignition_cache.store(token, cfg)
+    else:
+        resp = HttpResponse(cfg.body, content_type="application/json")
+    resp["ETag"] = cfg.etag
+    resp["Cache-Control"] = "no-cache"
+    return get_conditional_response(request, etag=cfg.etag, response=resp)
+
+
+BLOB_MAX_AGE = 365 * 24 * 3600
+
+
+@lru_cache(maxsize=None)
+def _blob_store(root: str) -> ContentStore:
+    return ContentStore(root, "sha512")
+
+
+def get_blob_store() -> ContentStore:
+    return _blob_store(settings.IGNITION_BLOB_DIR)
+
+
+def ignition_blob(request, digest):
+    store = get_blob_store()
+    if not store.is_valid_digest(digest) or not store.has(digest):
         raise Http404()
 
-    return JsonResponse(device.get_ignition_config(request).generate_config())
+    # Blobs are addressed by their contents, so they never change
+    etag = '"%s"' % digest
+    resp = get_conditional_response(request, etag=etag)
+    if resp is None:
+        resp = FileResponse(store.open(digest), content_type="application/octet-stream")
+    resp["ETag"] = etag
+    resp["Cache-Control"] = "public, max-age=%d, immutable" % BLOB_MAX_AGE
+    return resp
+
+
+RUNREQ_ARTIFACT_FIELDS = {"kernel": "kernel_url", "initrd": "initrd_url"}
+
+
+def runreq_artifact(request, arch, runreq_id, artifact, flags=None):
+    if arch not in ARCHES or artifact not in RUNREQ_ARTIFACT_FIELDS:
+        raise Http404()
+    runreq = get_object_or_404(RunRequest, id=runreq_id)
+    url = getattr(runreq, RUNREQ_ARTIFACT_FIELDS[artifact])
+    if runreq.type != RunRequest.TYPE_ONLINE_KERNEL or not url:
+        raise Http404()
+    url = fill_placeholders(url, {"arch": arch})
+
+    try:
+        if request.method == "HEAD":
+            size = get_proxy().size(url)
+            resp = HttpResponse(b"", content_type="application/octet-stream")
+        else:
+            size, contents = get_proxy().open(url)
+            resp = StreamingHttpResponse(
+                contents, content_type="application/octet-stream"
+            )
+    except ArtifactUnavailable:
+        return HttpResponse("Unable to fetch artifact", status=502)
+
+    if size is not None:
+        resp["Content-Length"] = size
+    return resp
 
 
 def postboot(request, mac_addr):
-    device = get_object_or_404(Device, mac_address=mac_addr.upper())
+    device = get_object_or_404(Device.objects.by_mac(mac_addr))
     if not device.run_request:
         raise Http404()
+    # Lets rollouts of this runreq continue with their next wave
+    Rollout.record_postboot(device, device.run_request)
     if "next" not in device.run_request.settings:
         raise Http404()
 
@@ -1,3 +1,5 @@
+from typing import Any, Dict, List
+
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
 from django.http import Http404, HttpResponseBadRequest
@@ -8,7 +10,42 @@ from django.views.decorators.http import require_POST
 from rules.contrib.views import permission_required
 from ipware import get_client_ip
 
-from zezere.models import Device, RunRequest, device_getter, SSHKey
+from zezere import caching, checkin
+from zezere.macaddr import mac_to_int
+from zezere.models import Device, DeviceQuerySet, RunRequest, device_getter, SSHKey
+
+
+# Number of devices changed per UPDATE by the bulk actions
+BULK_BATCH_SIZE = 500
+DEVICES_PAGE_SIZE = 100
+
+
+def selected_mac_ints(request) -> List[int]:
+    try:
+        return sorted({mac_to_int(mac) for mac in request.POST.getlist("mac_address")})
+    except ValueError:
+        raise Http404()
+
+
+def bulk_update_devices(allowed: DeviceQuerySet, mac_ints: List[int], **changes):
+    """Applies changes to the selected devices, with one UPDATE per batch.
+
+    All selected devices must be in the allowed queryset. This must be called
+    in a transaction, so that nothing is changed if any device is not allowed.
+    """
+    for start in range(0, len(mac_ints), BULK_BATCH_SIZE):
+        batch = mac_ints[start : start + BULK_BATCH_SIZE]
+        pks = list(allowed.filter(mac_int__in=batch).values_list("pk", flat=True))
+        if len(pks) != len(batch):
+            if Device.objects.filter(mac_int__in=batch).count() != len(batch):
+                raise Http404()
+            raise PermissionDenied()
+        # The allowed filter is applied again in case a concurrent request
+        #  changed any of these devices since they were selected.
+        if allowed.filter(pk__in=pks).update(**changes) != len(pks):
+            raise PermissionDenied()
+        # Updates do not send post_save
+        caching.bump_versions("device", pks)
 
 
 @login_required
@@ -20,44 +57,104 @@ def index(request):
 def claim(request):
     if request.method == "POST":
         with transaction.atomic():
-            device = get_object_or_404(Device, mac_address=request.POST["mac_address"])
-            if not request.user.has_perm(Device.get_perm("claim"), device):
-                raise PermissionDenied()
-
-            device.owner = request.user
-            device.save()
+            bulk_update_devices(
+                Device.objects.claimable_by(request.user),
+                selected_mac_ints(request),
+                owner=request.user,
+            )
         return redirect("/portal/claim/")
 
-    if request.user.is_superuser:
-        unclaimed = Device.objects.filter(owner__isnull=True)
-    else:
+    # Make sure pending check-ins are visible to the IP address match below
+    checkin.buffer.flush()
+    unclaimed = Device.objects.claimable_by(request.user)
+    if not request.user.is_superuser:
         remote_ip, _ = get_client_ip(request)
-        unclaimed = Device.objects.filter(owner__isnull=True, last_ip_address=remote_ip)
+        unclaimed = unclaimed.filter(last_ip_address=remote_ip)
     context = {"unclaimed_devices": unclaimed, "super": request.user.is_superuser}
     return render(request, "portal/claim.html", context)
 
 
+def device_page(devices: DeviceQuerySet, request) -> Dict[str, Any]:
+    """Returns a page of devices ordered by MAC address.
+
+    Pages start after or end before the MAC address in the "after" or "before"
+    parameter, so every page is a range scan of the MAC index.
+    """
+    try:
+        after = mac_to_int(request.GET["after"]) if "after" in request.GET else None
+        before = mac_to_int(request.GET["before"]) if "before" in request.GET else None
+    except ValueError:
+        raise Http404()
+
+    if before is not None:
+        devices = devices.filter(mac_int__lt=before).order_by("-mac_int")
+    else:
+        if after is not None:
+            devices = devices.filter(mac_int__gt=after)
+        devices = devices.order_by("mac_int")
+    page = list(devices[: DEVICES_PAGE_SIZE + 1])
+    has_more = len(page) > DEVICES_PAGE_SIZE
+    page = page[:DEVICES_PAGE_SIZE]
+    if before is not None:
+        page.reverse()
+        has_previous, has_next = has_more, True
+    else:
+        has_previous, has_next = after is not None, has_more
+
+    return {
+        "devices": page,
+        "previous_before": page[0].mac_address if page and has_previous else None,
+        "next_after": page[-1].mac_address if page and has_next else None,
+    }
+
+
 @login_required
 def devices(request):
-    devices = Device.objects.filter(owner=request.user)
-    return render(request, "portal/devices.html", {"devices": devices})
+    # Owned devices are the ones the user can view and provision
+    devices = Device.objects.provisionable_by(request.user).select_related(
+        "run_request"
+    )
+    context = device_page(devices, request)
+    context["runreqs"] = RunRequest.objects.usable_by(request.user).filter(
+        auto_generated_id__isnull=False
+    )
+    return render(request, "portal/devices.html", context)
+
+
+@login_required
+@require_POST
+def bulk_runreq(request):
+    if request.POST.get("action") == "clear":
+        runreq = None
+    else:
+        runreq = get_object_or_404(
+            RunRequest.objects.usable_by(request.user), id=request.POST["runrequest"]
+        )
+
+    with transaction.atomic():
+        bulk_update_devices(
+            Device.objects.provisionable_by(request.user),
+            selected_mac_ints(request),
+            run_request=runreq,
+        )
+    return redirect("portal_devices")
 
 
 @permission_required(Device.get_perm("provision"), fn=device_getter)
 def new_runreq(request, mac_addr):
-    device = get_object_or_404(Device, mac_address=mac_addr.upper())
+    device = get_object_or_404(Device.objects.by_mac(mac_addr))
 
     if request.method == "POST":
         rrid = request.POST["runrequest"]
-        runreq = get_object_or_404(RunRequest, id=rrid)
-        if not request.user.has_perm(RunRequest.get_perm("use"), runreq):
-            raise Http404()
+        runreq = get_object_or_404(RunRequest.objects.usable_by(request.user), id=rrid)
         device.run_request = runreq
         device.full_clean()
         device.save()
         return redirect("portal_devices")
 
-    runreqs = RunRequest.objects.filter(auto_generated_id__isnull=False)
+    runreqs = RunRequest.objects.usable_by(request.user).filter(
+        auto_generated_id__isnull=False
+    )
 
     return render(request, "portal/runreq.html", {"device": device, "runreqs": runreqs})
 
@@ -65,7 +162,7 @@ def new_runreq(request, mac_addr):
 @permission_required(Device.get_perm("provision"), fn=device_getter)
 @require_POST
 def clean_runreq(request, mac_addr):
-    device = get_object_or_404(Device, mac_address=mac_addr.upper())
+    device = get_object_or_404(Device.objects.by_mac(mac_addr))
 
     if device.run_request is None:
         return HttpResponseBadRequest()
@@ -78,7 +175,7 @@ def clean_runreq(request, mac_addr):
 
 @login_required
 def sshkeys(request):
-    sshkeys = SSHKey.objects.filter(owner=request.user)
+    sshkeys = SSHKey.objects.owned_by(request.user)
     return render(request, "portal/sshkeys.html", {"sshkeys": sshkeys})
 
 
@@ -86,9 +183,7 @@ def sshkeys(request):
 @require_POST
 def remove_ssh_key(request):
     keyid = request.POST["sshkey_id"]
-    sshkey = get_object_or_404(SSHKey, id=keyid)
-    if not request.user.has_perm(SSHKey.get_perm("delete"), sshkey):
-        raise Http404()
+    sshkey = get_object_or_404(SSHKey.objects.manageable_by(request.user), id=keyid)
     sshkey.delete()
     return redirect("portal_sshkeys")
 
@@ -2,15 +2,20 @@
 from typing import Optional, List
 
 import argparse
-import json
 import platform
 from subprocess import run as sp_run
-from tempfile import NamedTemporaryFile
 import sys
 import os
+import urllib.error
+import urllib.parse
+import urllib.request
 
 
 IGNITION_BINARY_PATH = "/usr/lib/dracut/modules.d/30ignition/ignition"
+STATE_DIR = "/var/lib/zezere-ignition"
+CONFIG_FILENAME = "config.ign"
+ETAG_FILENAME = "config.etag"
+FETCH_TIMEOUT = 60
 
 
 def get_primary_interface() -> Optional[str]:
@@ -74,7 +79,8 @@ def get_zezere_url():
                 return urlfile.read().strip()
 
 
-def run_ignition_stage(config_file: str, stage: str):
+def run_ignition_stage(config_file: str, stage: str) -> bool:
+    """Runs one Ignition stage, returns whether it succeeded."""
     print("Running stage %s with config file %s" % (stage, config_file))
     cmd = [
         IGNITION_BINARY_PATH,
@@ -88,23 +94,80 @@ def run_ignition_stage(config_file: str, stage: str):
     procenv["IGNITION_CONFIG_FILE"] = config_file
     procenv["IGNITION_WRITE_AUTHORIZED_KEYS_FRAGMENT"] = "false"
 
-    sp_run(cmd, env=procenv)
+    return sp_run(cmd, env=procenv).returncode == 0
 
 
-def run_ignition(config_url: str):
-    with NamedTemporaryFile(
-        "w", encoding="utf-8", prefix="zezere-ignition-config-", suffix=".ign"
-    ) as ignfile:
-        cfgobj = {
-            "ignition": {
-                "version": "3.0.0",
-                "config": {"replace": {"source": config_url}},
-            }
-        }
-        ignfile.write(json.dumps(cfgobj))
-        ignfile.flush()
-        for stage in ["fetch", "disks", "mount", "files", "umount"]:
-            run_ignition_stage(ignfile.name, stage)
+def read_state_file(state_dir: str, filename: str) -> Optional[bytes]:
+    try:
+        with open(os.path.join(state_dir, filename), "rb") as statefile:
+            return statefile.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_state_file(state_dir: str, filename: str, contents: bytes):
+    path = os.path.join(state_dir, filename)
+    with open(path + ".tmp", "wb") as statefile:
+        statefile.write(contents)
+    os.replace(path + ".tmp", path)
+
+
+def fetch_config(config_url: str, etag: Optional[bytes]):
+    """Fetches the config, returns (config, etag) or None if it is unchanged."""
+    scheme = urllib.parse.urlsplit(config_url).scheme
+    if scheme not in ("http", "https"):
+        raise urllib.error.URLError("Unsupported URL scheme %s" % scheme)
+    request = urllib.request.Request(config_url)
+    if etag:
+        request.add_header("If-None-Match", etag.decode("ascii"))
+    try:
+        # nosec justification: The URL scheme is checked to be http(s) above.
+        with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as resp:  # nosec
+            return resp.read(), resp.headers.get("ETag")
+    except urllib.error.HTTPError as ex:
+        if ex.code == 304:
+            return None
+        raise
+
+
+def run_ignition(config_url: str, state_dir: str = STATE_DIR, force: bool = False):
+    os.makedirs(state_dir, exist_ok=True)
+    old_config = read_state_file(state_dir, CONFIG_FILENAME)
+    old_etag = read_state_file(state_dir, ETAG_FILENAME)
+    if force or old_config is None:
+        old_etag = None
+
+    try:
+        fetched = fetch_config(config_url, old_etag)
+    except (urllib.error.URLError, OSError) as ex:
+        print("Unable to fetch config from %s: %s" % (config_url, ex), file=sys.stderr)
+        return
+    if fetched is None:
+        print("Config not modified, skipping Ignition")
+        return
+    config, etag = fetched
+
+    if config != old_config or force:
+        # The config is only recorded as applied once all stages ran, so an
+        #  interrupted run is retried on the next invocation
+        new_config_file = os.path.join(state_dir, CONFIG_FILENAME + ".new")
+        with open(new_config_file, "wb") as ignfile:
+            ignfile.write(config)
+        results = [
+            run_ignition_stage(new_config_file, stage)
+            for stage in ["fetch", "disks", "mount", "files", "umount"]
+        ]
+        if not all(results):
+            print("Ignition failed, will retry on the next run", file=sys.stderr)
+            return
+        os.replace(new_config_file, os.path.join(state_dir, CONFIG_FILENAME))
+    else:
+        print("Config unchanged, skipping Ignition")
+
+    if etag:
+        write_state_file(state_dir, ETAG_FILENAME, etag.encode("ascii"))
+    elif old_etag is not None:
+        os.unlink(os.path.join(state_dir, ETAG_FILENAME))
 
 
 def update_banner(url: str, device_id: Optional[str]):
@@ -143,7 +206,7 @@ def main(args: argparse.Namespace):
 
     url = "%s/netboot/%s/ignition/%s" % (zezere_url, arch, def_intf_mac)
 
-    run_ignition(url)
+    run_ignition(url, args.state_dir, args.force)
 
 
 def get_args(argv: List[str]) -> argparse.Namespace:
@@ -161,6 +224,16 @@ def get_args(argv: List[str]) -> argparse.Namespace:
         action="store_true",
         help="Stop after updating TTY banner",
     )
+    parser.add_argument(
+        "--state-dir",
+        default=STATE_DIR,
+        help="Directory to keep the last applied config in",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Run Ignition even if the config did not change",
+    )
 
     return parser.parse_args(argv)
 